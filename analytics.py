@@ -0,0 +1,279 @@
+"""对局日志离线统计
+
+从对局日志目录 (server.py --journal) 回放已结束的对局, 按块装入 NumPy
+数组批量统计: 对局长度分布、先手胜率、开局频率 (按棋盘 8 种对称归并)
+以及终局的棋型 (五连、活四、冲四、活三)。
+
+棋型用线形卷积核一次扫描整块棋盘: 对每个方向把棋盘按步长错位相加, 得到
+所有 5 格 (或 6 格) 窗口内的棋子数。五连的判定与 Board.check_win 相同:
+自由规则下长连也算, 标准规则和连珠规则的黑棋要求恰好五子 (窗口两端外侧
+不是己方棋子), 统计时用它核对日志中记录的胜负。
+只统计 15 路、一种规则的对局 (默认自由规则), 不同规则的开局和棋型不混在一起。
+
+日志按块流式读取, 内存占用只与块大小有关。需要安装 numpy。
+
+    python analytics.py journal
+    python analytics.py journal/shard-0 journal/shard-1 --openings 3 --top 20
+    python analytics.py journal --chunk 8192 --output stats.json
+    python analytics.py journal --rule renju
+"""
+import argparse
+import json
+import sys
+import time
+
+import numpy as np
+
+from board import BLACK, WHITE, DIRECTIONS, SIZE, FREESTYLE, RENJU, RULES
+from journal import NO_WINNER, replay
+
+CHUNK = 4096           # 每块的对局数
+MAX_MOVES = SIZE * SIZE
+OPENING_MOVES = 3      # 开局统计的手数
+CELLS = SIZE * SIZE
+MAX_OPENING_MOVES = 8  # 开局编码为 CELLS 进制的 int64, 225 ** 9 超出范围
+
+
+def games_from(paths, rule=FREESTYLE):
+    """依次回放多个日志目录中已结束的 15 路 rule 规则对局, 产出 (moves, winner), 其他对局跳过"""
+    for path in paths:
+        for _, moves, winner, size, game_rule in replay(path, with_rules=True):
+            if size == SIZE and game_rule == rule:
+                yield moves, winner
+
+
+def chunks(games, size=CHUNK):
+    """把对局流打包成数组块 (moves, lengths, winners)
+
+    moves 形状为 (n, MAX_MOVES, 2), 未用的位置为 -1。
+    """
+    moves = np.full((size, MAX_MOVES, 2), -1, dtype=np.int16)
+    lengths = np.zeros(size, dtype=np.int16)
+    winners = np.zeros(size, dtype=np.int8)
+    n = 0
+    for game, winner in games:
+        length = min(len(game), MAX_MOVES)
+        if length:
+            moves[n, :length] = game[:length]
+        lengths[n] = length
+        winners[n] = winner
+        n += 1
+        if n == size:
+            yield moves, lengths, winners
+            moves = np.full((size, MAX_MOVES, 2), -1, dtype=np.int16)
+            lengths = np.zeros(size, dtype=np.int16)
+            winners = np.zeros(size, dtype=np.int8)
+            n = 0
+    if n:
+        yield moves[:n], lengths[:n], winners[:n]
+
+
+def boards(moves, lengths):
+    """由落子序列得到终局棋盘, 返回形状 (n, SIZE, SIZE) 的 int8 数组, 0 空 1 黑 2 白"""
+    n = len(lengths)
+    out = np.zeros((n, CELLS), dtype=np.int8)
+    valid = np.arange(MAX_MOVES) < lengths[:, None]
+    game, index = np.nonzero(valid)
+    cells = moves[game, index, 1] * SIZE + moves[game, index, 0]
+    out[game, cells] = np.where(index % 2 == 0, BLACK, WHITE)
+    return out.reshape(n, SIZE, SIZE)
+
+
+def _cell(stones, k, dx, dy, length):
+    """所有 length 格窗口中第 k 格组成的视图, 按窗口起点排列"""
+    size = stones.shape[-1]
+    span = length - 1
+    x0 = span if dx < 0 else 0
+    width = size - span * abs(dx)
+    height = size - span * dy
+    x = x0 + k * dx
+    y = k * dy
+    return stones[:, y:y + height, x:x + width]
+
+
+def line_sums(stones, length, first=0, last=None):
+    """线形卷积: 每个方向上所有 length 格窗口内 (第 first 到 last 格) 的棋子数
+
+    stones 为 (n, size, size) 的 0/1 数组, 返回各方向的 (n, h, w) 数组,
+    下标为窗口起点。
+    """
+    last = length - 1 if last is None else last
+    sums = []
+    for dx, dy in DIRECTIONS:
+        total = _cell(stones, first, dx, dy, length).astype(np.int8)
+        for k in range(first + 1, last + 1):
+            total += _cell(stones, k, dx, dy, length)
+        sums.append(total)
+    return sums
+
+
+def fives(board, color, rule=FREESTYLE):
+    """每局 color 是否有五连, 与 Board.check_win 的规则一致"""
+    found = np.zeros(board.shape[0], dtype=bool)
+    own = (board == color).astype(np.int8)
+    if rule == FREESTYLE or (rule == RENJU and color == WHITE):
+        for total in line_sums(own, 5):
+            found |= (total == 5).any(axis=(1, 2))
+        return found
+    # 不算长连: 四周补一圈空位后看 7 格窗口, 中间 5 格全是己方且两端不是
+    padded = np.pad(own, ((0, 0), (1, 1), (1, 1)))
+    for (dx, dy), total in zip(DIRECTIONS, line_sums(padded, 7, 1, 5)):
+        ends = _cell(padded, 0, dx, dy, 7) | _cell(padded, 6, dx, dy, 7)
+        found |= ((total == 5) & (ends == 0)).any(axis=(1, 2))
+    return found
+
+
+def threats(board, color):
+    """按局统计 color 的棋型窗口数
+
+    冲四: 5 格中 4 子 1 空; 活四: _XXXX_; 活三: 6 格两端空、中间 3 子 1 空。
+    """
+    own = (board == color).astype(np.int8)
+    other = (board == 3 - color).astype(np.int8)
+    empty = board == 0
+    n = board.shape[0]
+    four = np.zeros(n, dtype=np.int32)
+    for own5, other5 in zip(line_sums(own, 5), line_sums(other, 5)):
+        four += ((own5 == 4) & (other5 == 0)).sum(axis=(1, 2))
+
+    open_four = np.zeros(n, dtype=np.int32)
+    open_three = np.zeros(n, dtype=np.int32)
+    inner_own = line_sums(own, 6, 1, 4)
+    inner_other = line_sums(other, 6, 1, 4)
+    for (dx, dy), own4, other4 in zip(DIRECTIONS, inner_own, inner_other):
+        clear = _cell(empty, 0, dx, dy, 6) & _cell(empty, 5, dx, dy, 6) & (other4 == 0)
+        open_four += (clear & (own4 == 4)).sum(axis=(1, 2))
+        open_three += (clear & (own4 == 3)).sum(axis=(1, 2))
+    return four, open_four, open_three
+
+
+def _symmetries(x, y):
+    """棋盘的 8 种对称变换"""
+    m = SIZE - 1
+    return ((x, y), (m - x, y), (x, m - y), (m - x, m - y),
+            (y, x), (m - y, x), (y, m - x), (m - y, m - x))
+
+
+def opening_keys(moves, k):
+    """前 k 手在对称变换下的规范编码 (各变换编码中的最小值), k 不超过 MAX_OPENING_MOVES"""
+    x = moves[:, :k, 0].astype(np.int64)
+    y = moves[:, :k, 1].astype(np.int64)
+    weights = CELLS ** np.arange(k - 1, -1, -1, dtype=np.int64)
+    keys = None
+    for sx, sy in _symmetries(x, y):
+        key = (sy * SIZE + sx) @ weights
+        keys = key if keys is None else np.minimum(keys, key)
+    return keys
+
+
+def decode_opening(key, k):
+    cells = []
+    for _ in range(k):
+        key, cell = divmod(key, CELLS)
+        cells.append((cell % SIZE, cell // SIZE))
+    return cells[::-1]
+
+
+class Stats:
+    """按块累加的统计结果"""
+
+    def __init__(self, opening_moves=OPENING_MOVES, rule=FREESTYLE):
+        self.opening_moves = opening_moves
+        self.rule = rule
+        self.games = 0
+        self.lengths = np.zeros(MAX_MOVES + 1, dtype=np.int64)
+        self.results = np.zeros(3, dtype=np.int64)   # 按 winner: 未分胜负、黑胜、白胜
+        self.openings = {}   # 规范编码 -> [局数, 黑胜, 白胜]
+        self.fives = np.zeros(3, dtype=np.int64)     # 终局有五连的局数, 按颜色
+        self.without_five = 0  # 分出胜负但胜者终局没有五连的局数 (超时、断线判负等)
+        self.threats = {name: np.zeros(3, dtype=np.int64) for name in ('four', 'open_four', 'open_three')}
+
+    def add(self, moves, lengths, winners):
+        self.games += len(lengths)
+        self.lengths += np.bincount(lengths, minlength=MAX_MOVES + 1)
+        self.results += np.bincount(winners, minlength=3)
+
+        k = self.opening_moves
+        opened = lengths >= k
+        if k and opened.any():
+            keys, inverse = np.unique(opening_keys(moves[opened], k), return_inverse=True)
+            w = winners[opened]
+            count = np.bincount(inverse)
+            black = np.bincount(inverse, weights=w == BLACK)
+            white = np.bincount(inverse, weights=w == WHITE)
+            for key, c, b, wh in zip(keys.tolist(), count.tolist(), black.tolist(), white.tolist()):
+                entry = self.openings.setdefault(key, [0, 0, 0])
+                entry[0] += c
+                entry[1] += int(b)
+                entry[2] += int(wh)
+
+        board = boards(moves, lengths)
+        five = {color: fives(board, color, self.rule) for color in (BLACK, WHITE)}
+        for color in (BLACK, WHITE):
+            self.fives[color] += int(five[color].sum())
+            four, open_four, open_three = threats(board, color)
+            self.threats['four'][color] += int(four.sum())
+            self.threats['open_four'][color] += int(open_four.sum())
+            self.threats['open_three'][color] += int(open_three.sum())
+        # 日志不记录结束原因, 超时、断线和禁手判负的胜者终局没有五连, 也计入这一项
+        decided = winners != NO_WINNER
+        has_five = np.where(winners == BLACK, five[BLACK], five[WHITE])
+        self.without_five += int((decided & ~has_five).sum())
+
+    def report(self, top=10):
+        total = int(self.lengths.sum())
+        cumulative = np.cumsum(self.lengths)
+
+        def percentile(q):
+            return int(np.searchsorted(cumulative, q * total)) if total else 0
+
+        decided = int(self.results[BLACK] + self.results[WHITE])
+        openings = sorted(self.openings.items(), key=lambda item: -item[1][0])[:top]
+        return {
+            'games': self.games,
+            'length_mean': round(float(self.lengths @ np.arange(MAX_MOVES + 1)) / total, 2) if total else 0.0,
+            'length_p50': percentile(0.5),
+            'length_p90': percentile(0.9),
+            'black_wins': int(self.results[BLACK]),
+            'white_wins': int(self.results[WHITE]),
+            'undecided': int(self.results[NO_WINNER]),
+            'black_win_rate': round(int(self.results[BLACK]) / decided, 4) if decided else None,
+            'final_fives': {'black': int(self.fives[BLACK]), 'white': int(self.fives[WHITE])},
+            'decided_without_five': self.without_five,
+            'threats': {name: {'black': int(v[BLACK]), 'white': int(v[WHITE])}
+                        for name, v in self.threats.items()},
+            'openings': [
+                {'moves': decode_opening(key, self.opening_moves), 'games': c, 'black_wins': b, 'white_wins': w}
+                for key, (c, b, w) in openings
+            ],
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='对局日志离线统计')
+    parser.add_argument('paths', nargs='+', metavar='DIR', help='对局日志目录')
+    parser.add_argument('--chunk', type=int, default=CHUNK, help='每块的对局数')
+    parser.add_argument('--openings', type=int, default=OPENING_MOVES, help='开局统计的手数, 0 表示不统计')
+    parser.add_argument('--rule', default=FREESTYLE, choices=RULES, help='只统计这个规则的对局')
+    parser.add_argument('--top', type=int, default=10, help='输出最常见的开局数')
+    parser.add_argument('--output', help='把结果写入 JSON 文件')
+    args = parser.parse_args()
+    if not 0 <= args.openings <= MAX_OPENING_MOVES:
+        parser.error(f'--openings 应在 0 到 {MAX_OPENING_MOVES} 之间')
+
+    stats = Stats(args.openings, args.rule)
+    start = time.perf_counter()
+    for chunk in chunks(games_from(args.paths, args.rule), args.chunk):
+        stats.add(*chunk)
+    result = stats.report(args.top)
+    result['seconds'] = round(time.perf_counter() - start, 3)
+
+    json.dump(result, sys.stdout, indent=2, ensure_ascii=False)
+    print()
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    main()
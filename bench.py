@@ -0,0 +1,320 @@
+"""本地压测工具
+
+在子进程中启动 server.py, 用真实的 join_room / move / exit_room 协议
+模拟大量客户端并发对局, 统计吞吐、落子往返延迟和每连接内存,
+并可与保存的基线结果比较, 发现性能回退。
+
+    python bench.py --games 500 --rounds 2
+    python bench.py --games 500 --save-baseline
+    python bench.py --games 500 --baseline bench_baseline.json
+    python bench.py --games 500 -- --workers 4
+    python bench.py --games 500 --gateway 4
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+
+import websockets
+
+from board import Board
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BASELINE_FILE = os.path.join(HERE, 'bench_baseline.json')
+BOARD_SIZE = 15
+# 压测客户端按往返节奏尽快落子, 默认放宽服务器的限流, 命令行传入的参数在后面, 可以覆盖
+BENCH_LIMITS = ('--rate-limit', '10000/20000', '--action-limit', 'move=10000/20000',
+                '--action-limit', 'join_room=10000/20000')
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+def rss_kb(pid):
+    """读取进程及其子进程 (多进程模式下的工作进程) 的常驻内存之和, 单位 KB"""
+    total = 0
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                total += int(line.split()[1])
+                break
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as f:
+            children = f.read().split()
+    except OSError:
+        children = []
+    for child in children:
+        total += rss_kb(int(child))
+    return total
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    idx = min(len(sorted_values) - 1, int(len(sorted_values) * p))
+    return sorted_values[idx]
+
+
+async def start_server(port, server_args=(), script='server.py'):
+    if script == 'server.py':
+        server_args = [*BENCH_LIMITS, *server_args]
+    proc = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, script), '--port', str(port), *server_args],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    # 等待端口可连接
+    for _ in range(100):
+        try:
+            _, writer = await asyncio.open_connection('localhost', port)
+            writer.close()
+            return proc
+        except OSError:
+            await asyncio.sleep(0.1)
+    proc.kill()
+    raise RuntimeError('server did not start')
+
+
+class BenchClient:
+    """一个模拟玩家连接, 收到的消息按 action 放入队列"""
+
+    def __init__(self, uri):
+        self.uri = uri
+        self.ws = None
+        self.inbox = asyncio.Queue()
+        self.reader = None
+
+    async def connect(self):
+        self.ws = await websockets.connect(self.uri, max_queue=None)
+        self.reader = asyncio.create_task(self._read())
+
+    async def _read(self):
+        try:
+            async for message in self.ws:
+                data = json.loads(message)
+                if data.get('action') != 'room_status':
+                    self.inbox.put_nowait(data)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    async def join(self, room_id):
+        """加入房间, 多进程服务器返回 join_redirect 时改连对应的工作进程"""
+        while True:
+            await self.send({'action': 'join_room', 'room_id': room_id})
+            data = await self.expect('join_success', 'join_redirect', 'join_failed', 'error')
+            if data['action'] == 'join_success':
+                return
+            if data['action'] in ('join_failed', 'error'):
+                raise RuntimeError(f'join {room_id} failed')
+            await self.close()
+            self.uri = data['uri']
+            self.inbox = asyncio.Queue()
+            await self.connect()
+
+    async def send(self, message):
+        await self.ws.send(json.dumps(message))
+
+    async def expect(self, *actions, timeout=30):
+        """等待指定动作的消息, 丢弃其他消息"""
+        while True:
+            data = await asyncio.wait_for(self.inbox.get(), timeout)
+            if data.get('action') in actions:
+                return data
+
+    def drain(self):
+        while not self.inbox.empty():
+            self.inbox.get_nowait()
+
+    async def close(self):
+        await self.ws.close()
+        if self.reader:
+            await self.reader
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = []
+        self.moves = 0
+        self.games = 0
+        self.errors = 0
+
+
+async def play_game(room_id, black, white, stats, rng, max_moves):
+    """两个客户端在 room_id 中下完一局然后退出"""
+    await black.join(room_id)
+    await white.join(room_id)
+    await black.expect('game_start')
+
+    cells = [(x, y) for y in range(BOARD_SIZE) for x in range(BOARD_SIZE)]
+    rng.shuffle(cells)
+    board = Board()
+    seats = [black, white]
+    turn = 0
+    while cells and stats.moves < max_moves:
+        x, y = cells[-1]
+        mover = seats[turn]
+        start = time.perf_counter()
+        await mover.send({'action': 'move', 'room_id': room_id, 'x': x, 'y': y})
+        data = await mover.expect('move', 'move_failed', 'game_over', 'error')
+        # 队列里可能还有对手上一步的广播, 跳过, 等到自己这一步的确认
+        while data['action'] == 'move' and (data['x'], data['y']) != (x, y):
+            data = await mover.expect('move', 'move_failed', 'game_over', 'error')
+        if data['action'] in ('move_failed', 'error'):
+            stats.errors += 1
+            break
+        stats.latencies.append(time.perf_counter() - start)
+        stats.moves += 1
+        cells.pop()
+        # 本地同步棋盘, 胜负已分时等待服务器的 game_over
+        if board.place(x, y, turn + 1):
+            await mover.expect('game_over')
+            break
+        turn ^= 1
+
+    for client in (black, white):
+        await client.send({'action': 'exit_room', 'room_id': room_id})
+        await client.expect('exit_success', 'error')
+    for client in (black, white):
+        client.drain()
+    stats.games += 1
+
+
+async def run(args):
+    port = free_port()
+    gateway = None
+    if args.gateway:
+        # 客户端连网关, 内存仍只统计游戏服务器进程
+        key = os.urandom(8).hex()
+        proc = await start_server(port, [*args.server_args, '--gateway-key', key])
+        gateway_port = free_port()
+        gateway = await start_server(gateway_port, ['--upstream', f'ws://localhost:{port}',
+                                                    '--links', str(args.gateway), '--gateway-key', key],
+                                     script='gateway.py')
+        uri = f'ws://localhost:{gateway_port}'
+    else:
+        proc = await start_server(port, args.server_args)
+        uri = f'ws://localhost:{port}'
+    try:
+        await asyncio.sleep(0.2)
+        rss_before = rss_kb(proc.pid)
+
+        clients = [BenchClient(uri) for _ in range(args.games * 2)]
+        sem = asyncio.Semaphore(200)
+
+        async def connect(client):
+            async with sem:
+                await client.connect()
+
+        await asyncio.gather(*(connect(c) for c in clients))
+        await asyncio.sleep(0.5)
+        rss_connected = rss_kb(proc.pid)
+
+        stats = Stats()
+        rng = random.Random(args.seed)
+        max_moves = args.max_moves or float('inf')
+
+        async def pair(i):
+            black, white = clients[2 * i], clients[2 * i + 1]
+            for r in range(args.rounds):
+                try:
+                    await play_game(f'bench-{i}', black, white, stats, random.Random(rng.random()), max_moves)
+                except asyncio.TimeoutError:
+                    stats.errors += 1
+                    return
+
+        start = time.perf_counter()
+        await asyncio.gather(*(pair(i) for i in range(args.games)))
+        elapsed = time.perf_counter() - start
+        rss_peak = rss_kb(proc.pid)
+
+        await asyncio.gather(*(c.close() for c in clients), return_exceptions=True)
+    finally:
+        for p in (gateway, proc):
+            if p is not None:
+                p.terminate()
+                p.wait()
+
+    lat = sorted(stats.latencies)
+    connections = len(clients)
+    return {
+        'connections': connections,
+        'games': stats.games,
+        'moves': stats.moves,
+        'errors': stats.errors,
+        'elapsed_s': round(elapsed, 3),
+        'moves_per_s': round(stats.moves / elapsed, 1) if elapsed else 0.0,
+        'p50_ms': round(percentile(lat, 0.50) * 1000, 3),
+        'p99_ms': round(percentile(lat, 0.99) * 1000, 3),
+        'p999_ms': round(percentile(lat, 0.999) * 1000, 3),
+        'kb_per_connection': round((rss_connected - rss_before) / connections, 2),
+        'server_rss_kb': rss_peak,
+    }
+
+
+def compare(result, baseline, tolerance):
+    """与基线比较, 返回回退项列表"""
+    regressions = []
+    limit = 1 + tolerance
+    if result['moves_per_s'] * limit < baseline['moves_per_s']:
+        regressions.append('moves_per_s')
+    for key in ('p50_ms', 'p99_ms', 'kb_per_connection'):
+        if result[key] > baseline[key] * limit:
+            regressions.append(key)
+    if result['errors'] > baseline.get('errors', 0):
+        regressions.append('errors')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='五子棋服务器本地压测')
+    parser.add_argument('--games', type=int, default=200, help='并发对局数, 连接数为其两倍')
+    parser.add_argument('--rounds', type=int, default=1, help='每对玩家连续下的局数')
+    parser.add_argument('--max-moves', type=int, default=0, help='总落子数上限, 0 表示不限')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='把结果写入 JSON 文件')
+    parser.add_argument('--baseline', help='与指定的基线文件比较')
+    parser.add_argument('--save-baseline', action='store_true', help=f'把结果保存为 {os.path.basename(BASELINE_FILE)}')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='允许的相对回退幅度')
+    parser.add_argument('--gateway', type=int, default=0, metavar='LINKS',
+                        help='经 gateway.py 连接, 网关与服务器之间用 LINKS 条上游连接')
+    parser.add_argument('server_args', nargs='*', help='传给 server.py 的额外参数')
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    result['params'] = {'games': args.games, 'rounds': args.rounds, 'seed': args.seed}
+    if args.gateway:
+        result['params']['gateway'] = args.gateway
+
+    for key, value in result.items():
+        print(f'{key:>20}: {value}')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+    if args.save_baseline:
+        with open(BASELINE_FILE, 'w') as f:
+            json.dump(result, f, indent=2)
+            f.write('\n')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('params') != result['params']:
+            print('警告: 基线参数与本次运行不同, 比较结果仅供参考')
+        regressions = compare(result, baseline, args.tolerance)
+        if regressions:
+            print('性能回退: ' + ', '.join(regressions))
+            sys.exit(1)
+        print('未发现性能回退')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,235 @@
+"""五子棋棋盘引擎
+
+棋盘按格子下标 y * size + x 存放在 bytearray 中。每种尺寸第一次使用时
+预先计算两张表, 之后所有同尺寸的棋盘共用:
+- 线表: 每个格子在四个方向上、以它为中心前后各 REACH 格的下标, 出界为 -1;
+- 邻域表: 每个格子周围两格内的格子, 供搜索生成候选点。
+判断胜负和禁手只查看落子点所在的四条线段, 每步的开销与棋盘大小无关。
+
+规则:
+- freestyle: 五连或长连获胜;
+- standard: 只有正好五连获胜, 长连不算;
+- renju: 黑棋只有正好五连获胜, 并且不能下长连、双四、双三 (禁手);
+  白棋五连或长连获胜。活三按一步能否成活四判断, 不再递归检查那一步
+  本身是否为禁手。
+"""
+
+SIZE = 15      # 默认尺寸
+MIN_SIZE = 9
+MAX_SIZE = 25
+REACH = 5      # 线表在落子点两侧各取的格数, 足以判断长连
+
+# 横、竖、右下斜、左下斜四个方向
+DIRECTIONS = ((1, 0), (0, 1), (1, 1), (-1, 1))
+
+EMPTY = 0
+BLACK = 1
+WHITE = 2
+EDGE = 3  # 线段中出界的位置
+
+FREESTYLE = 'freestyle'
+STANDARD = 'standard'
+RENJU = 'renju'
+RULES = (FREESTYLE, STANDARD, RENJU)
+
+OVERLINE = 'overline'
+DOUBLE_FOUR = 'double_four'
+DOUBLE_THREE = 'double_three'
+
+
+class Tables:
+    __slots__ = ('size', 'lines', 'neighbours')
+
+    def __init__(self, size):
+        self.size = size
+        self.lines = []
+        self.neighbours = []
+        for idx in range(size * size):
+            x, y = idx % size, idx // size
+            lines = []
+            for dx, dy in DIRECTIONS:
+                line = []
+                for k in range(-REACH, REACH + 1):
+                    nx, ny = x + k * dx, y + k * dy
+                    line.append(ny * size + nx if 0 <= nx < size and 0 <= ny < size else -1)
+                lines.append(tuple(line))
+            self.lines.append(tuple(lines))
+            self.neighbours.append(tuple(
+                ny * size + nx
+                for ny in range(max(y - 2, 0), min(y + 3, size))
+                for nx in range(max(x - 2, 0), min(x + 3, size))
+                if (nx, ny) != (x, y)
+            ))
+
+
+_tables = {}
+
+
+def tables(size):
+    """尺寸为 size 的线表和邻域表, 第一次使用时计算"""
+    t = _tables.get(size)
+    if t is None:
+        t = _tables[size] = Tables(size)
+    return t
+
+
+def valid_size(size):
+    return isinstance(size, int) and not isinstance(size, bool) and MIN_SIZE <= size <= MAX_SIZE
+
+
+def _run(values, pos, player):
+    """values 中经过 pos 的 player 连子的起止位置"""
+    start = pos
+    while start > 0 and values[start - 1] == player:
+        start -= 1
+    end = pos
+    last = len(values) - 1
+    while end < last and values[end + 1] == player:
+        end += 1
+    return start, end
+
+
+def _completions(values):
+    """线段上再落一颗黑子就能与中心的子组成正好五连的空位"""
+    points = []
+    for p in range(1, 2 * REACH):
+        if values[p] != EMPTY:
+            continue
+        values[p] = BLACK
+        start, end = _run(values, p, BLACK)
+        if end - start == 4 and start <= REACH <= end:
+            points.append(p)
+        values[p] = EMPTY
+    return points
+
+
+def _fours(values):
+    """这一方向上的四的个数, 活四 (两个成五点相距 5) 算一个"""
+    points = _completions(values)
+    if len(points) == 2 and points[1] - points[0] == 5:
+        return 1
+    return len(points)
+
+
+def _open_three(values):
+    """这一方向上是否为活三: 再落一子能成活四"""
+    for q in range(REACH - 4, REACH + 5):
+        if values[q] != EMPTY:
+            continue
+        values[q] = BLACK
+        points = _completions(values)
+        values[q] = EMPTY
+        if len(points) == 2 and points[1] - points[0] == 5:
+            return True
+    return False
+
+
+class Board:
+    """对局状态: 棋盘、落子顺序和规则"""
+
+    __slots__ = ('size', 'rule', 'grid', 'moves', 'lines')
+
+    def __init__(self, size=SIZE, rule=FREESTYLE):
+        self.moves = []        # 落子顺序, 元素为 (x, y)
+        self.configure(size, rule)
+
+    def configure(self, size=SIZE, rule=FREESTYLE):
+        """清空棋盘并换成给定的尺寸和规则, 尺寸不变时不分配新对象"""
+        self.rule = rule
+        if getattr(self, 'size', None) != size:
+            self.size = size
+            self.grid = bytearray(size * size)
+            self.lines = tables(size).lines
+        self.reset()
+
+    def reset(self):
+        """清空棋盘"""
+        self.grid[:] = bytes(len(self.grid))
+        self.moves.clear()
+
+    @property
+    def current_player(self):
+        return BLACK if len(self.moves) % 2 == 0 else WHITE
+
+    @property
+    def last_move(self):
+        return self.moves[-1] if self.moves else None
+
+    def in_bounds(self, x, y):
+        return 0 <= x < self.size and 0 <= y < self.size
+
+    def get(self, x, y):
+        return self.grid[y * self.size + x]
+
+    def is_empty(self, x, y):
+        return not self.grid[y * self.size + x]
+
+    def place(self, x, y, player):
+        """落子并返回该子是否获胜, 调用方需先校验坐标、空位和禁手"""
+        self.grid[y * self.size + x] = player
+        self.moves.append((x, y))
+        return self.check_win(x, y, player)
+
+    def undo(self):
+        """撤销最后一步, 供搜索使用"""
+        x, y = self.moves.pop()
+        self.grid[y * self.size + x] = EMPTY
+        return x, y
+
+    def _overline_wins(self, player):
+        return self.rule == FREESTYLE or (self.rule == RENJU and player == WHITE)
+
+    def check_win(self, x, y, player):
+        """判断 player 在 (x, y) 落子后是否获胜, 只查看线表中的四条线段"""
+        grid = self.grid
+        overline = self._overline_wins(player)
+        for line in self.lines[y * self.size + x]:
+            count = 1
+            for step in (1, -1):
+                k = REACH + step
+                while 0 <= k <= 2 * REACH:
+                    idx = line[k]
+                    if idx < 0 or grid[idx] != player:
+                        break
+                    count += 1
+                    k += step
+            if count == 5 or (count > 5 and overline):
+                return True
+        return False
+
+    def forbidden(self, x, y, player):
+        """连珠规则下黑棋在空位 (x, y) 落子是否为禁手, 是则返回禁手类型, 否则返回 None"""
+        if self.rule != RENJU or player != BLACK:
+            return None
+        grid = self.grid
+        idx = y * self.size + x
+        grid[idx] = BLACK
+        try:
+            segments = [[EDGE if i < 0 else grid[i] for i in line] for line in self.lines[idx]]
+        finally:
+            grid[idx] = EMPTY
+
+        overline = False
+        for values in segments:
+            start, end = _run(values, REACH, BLACK)
+            length = end - start + 1
+            if length == 5:
+                return None  # 成五优先于禁手
+            if length > 5:
+                overline = True
+        if overline:
+            return OVERLINE
+        if sum(_fours(values) for values in segments) >= 2:
+            return DOUBLE_FOUR
+        if sum(1 for values in segments if not _fours(values) and _open_three(values)) >= 2:
+            return DOUBLE_THREE
+        return None
+
+    def is_full(self):
+        return len(self.moves) >= self.size * self.size
+
+    def to_rows(self):
+        """转换成 size x size 的嵌套列表, 供 JSON 消息使用"""
+        size = self.size
+        grid = self.grid
+        return [list(grid[y * size:(y + 1) * size]) for y in range(size)]
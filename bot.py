@@ -0,0 +1,303 @@
+"""人机对战 AI
+
+迭代加深的 alpha-beta (negamax) 搜索:
+- 候选点限定在已有棋子周围两格内, 按威胁程度排序 (先成五、挡五,
+  再活四、冲四、活三), 每层只展开最有威胁的若干个点;
+- 局面用 Zobrist 哈希, 结果存入固定大小的置换表, 按深度优先替换;
+- 胜负判断复用 Board.check_win。
+
+search() 是无状态的顶层函数, 由服务器放进进程池执行, 置换表是
+每个工作进程内的全局对象, 在多盘对局之间共用。
+"""
+import random
+import time
+
+from board import Board, SIZE, BLACK, WHITE, tables
+
+TIME_BUDGET = 1.0   # 每步默认思考时间, 单位秒
+MAX_DEPTH = 8
+BRANCH = 10         # 每层最多展开的候选点数
+TT_BITS = 18        # 置换表大小为 2 ** TT_BITS
+
+WIN_SCORE = 10000000
+
+# SCORES[连子数][开放端数]
+SCORES = (
+    (0, 0, 0),
+    (0, 1, 10),
+    (0, 10, 100),
+    (0, 100, 1000),
+    (0, 1000, 10000),
+    (100000, 100000, 100000),
+)
+
+EXACT, LOWER, UPPER = 0, 1, 2
+
+_DIRS = ((1, 0), (0, 1), (1, 1), (1, -1))
+
+
+def _build_lines():
+    """所有长度不小于 5 的直线, 以及每个格子所在的直线编号"""
+    lines = []
+    for dx, dy in _DIRS:
+        for y0 in range(SIZE):
+            for x0 in range(SIZE):
+                # 只从直线的起点出发
+                px, py = x0 - dx, y0 - dy
+                if 0 <= px < SIZE and 0 <= py < SIZE:
+                    continue
+                cells = []
+                x, y = x0, y0
+                while 0 <= x < SIZE and 0 <= y < SIZE:
+                    cells.append(y * SIZE + x)
+                    x += dx
+                    y += dy
+                if len(cells) >= 5:
+                    lines.append(tuple(cells))
+    cell_lines = [[] for _ in range(SIZE * SIZE)]
+    for i, cells in enumerate(lines):
+        for idx in cells:
+            cell_lines[idx].append(i)
+    return lines, [tuple(ids) for ids in cell_lines]
+
+
+LINES, CELL_LINES = _build_lines()
+
+_NEIGHBOURS = tables(SIZE).neighbours
+
+_rng = random.Random(20240601)
+ZOBRIST = [
+    (0, _rng.getrandbits(64), _rng.getrandbits(64))
+    for _ in range(SIZE * SIZE)
+]
+SIDE_TO_MOVE = _rng.getrandbits(64)
+
+
+def line_score(cells, grid, player):
+    """一条直线上 player 各段连子的得分"""
+    score = 0
+    run = 0
+    open_start = False
+    for idx in cells:
+        v = grid[idx]
+        if v == player:
+            run += 1
+            continue
+        if run:
+            score += SCORES[min(run, 5)][open_start + (v == 0)]
+            run = 0
+        open_start = v == 0
+    if run:
+        score += SCORES[min(run, 5)][open_start]
+    return score
+
+
+def cell_threat(grid, idx, player):
+    """在 idx 落 player 的子能形成的威胁分"""
+    x, y = idx % SIZE, idx // SIZE
+    score = 0
+    for dx, dy in _DIRS:
+        count = 1
+        opens = 0
+        for sign in (1, -1):
+            nx, ny = x + dx * sign, y + dy * sign
+            while 0 <= nx < SIZE and 0 <= ny < SIZE and grid[ny * SIZE + nx] == player:
+                count += 1
+                nx += dx * sign
+                ny += dy * sign
+            if 0 <= nx < SIZE and 0 <= ny < SIZE and grid[ny * SIZE + nx] == 0:
+                opens += 1
+        score += SCORES[min(count, 5)][opens]
+    return score
+
+
+class TranspositionTable:
+    """固定大小的置换表, 同一槽位按深度和搜索代数替换"""
+
+    __slots__ = ('mask', 'slots', 'generation')
+
+    def __init__(self, bits=TT_BITS):
+        self.mask = (1 << bits) - 1
+        self.slots = [None] * (1 << bits)
+        self.generation = 0
+
+    def get(self, key):
+        entry = self.slots[key & self.mask]
+        if entry is not None and entry[0] == key:
+            return entry
+        return None
+
+    def put(self, key, depth, flag, value, move):
+        i = key & self.mask
+        old = self.slots[i]
+        # 旧代的条目或深度更浅的条目可以被覆盖
+        if old is None or old[5] != self.generation or depth >= old[1]:
+            self.slots[i] = (key, depth, flag, value, move, self.generation)
+
+
+_table = TranspositionTable()
+
+
+class SearchTimeout(Exception):
+    pass
+
+
+class Searcher:
+    def __init__(self, moves, deadline, table):
+        self.board = Board()
+        self.grid = [0] * (SIZE * SIZE)
+        self.line_values = [[0, 0, 0] for _ in LINES]
+        self.key = 0
+        self.deadline = deadline
+        self.table = table
+        self.nodes = 0
+        player = BLACK
+        for x, y in moves:
+            self.make(y * SIZE + x, player)
+            player = 3 - player
+
+    def make(self, idx, player):
+        self.grid[idx] = player
+        self.board.place(idx % SIZE, idx // SIZE, player)
+        self.key ^= ZOBRIST[idx][player] ^ SIDE_TO_MOVE
+        self._update_lines(idx)
+
+    def unmake(self, idx, player):
+        self.grid[idx] = 0
+        self.board.undo()
+        self.key ^= ZOBRIST[idx][player] ^ SIDE_TO_MOVE
+        self._update_lines(idx)
+
+    def _update_lines(self, idx):
+        grid = self.grid
+        for i in CELL_LINES[idx]:
+            values = self.line_values[i]
+            values[BLACK] = line_score(LINES[i], grid, BLACK)
+            values[WHITE] = line_score(LINES[i], grid, WHITE)
+
+    def evaluate(self, player):
+        own = opp = 0
+        other = 3 - player
+        for values in self.line_values:
+            own += values[player]
+            opp += values[other]
+        return own - opp
+
+    def candidates(self, player, first=None):
+        """按威胁排序的候选点"""
+        grid = self.grid
+        seen = set()
+        for x, y in self.board.moves:
+            for n in _NEIGHBOURS[y * SIZE + x]:
+                if grid[n] == 0:
+                    seen.add(n)
+        other = 3 - player
+        scored = sorted(
+            seen,
+            key=lambda idx: cell_threat(grid, idx, player) + cell_threat(grid, idx, other) * 0.9,
+            reverse=True
+        )[:BRANCH]
+        if first is not None and first in seen:
+            if first in scored:
+                scored.remove(first)
+            scored.insert(0, first)
+        return scored
+
+    def negamax(self, depth, alpha, beta, player, ply):
+        self.nodes += 1
+        if self.nodes & 255 == 0 and time.perf_counter() > self.deadline:
+            raise SearchTimeout
+
+        if depth == 0:
+            return self.evaluate(player)
+
+        alpha_orig = alpha
+        entry = self.table.get(self.key)
+        hint = None
+        if entry is not None:
+            hint = entry[4]
+            if entry[1] >= depth:
+                flag, value = entry[2], entry[3]
+                if flag == EXACT:
+                    return value
+                if flag == LOWER:
+                    alpha = max(alpha, value)
+                elif flag == UPPER:
+                    beta = min(beta, value)
+                if alpha >= beta:
+                    return value
+
+        moves = self.candidates(player, hint)
+        if not moves:
+            return 0
+
+        best = -WIN_SCORE * 2
+        best_move = moves[0]
+        for idx in moves:
+            self.make(idx, player)
+            if self.board.check_win(idx % SIZE, idx // SIZE, player):
+                value = WIN_SCORE - ply
+            else:
+                try:
+                    value = -self.negamax(depth - 1, -beta, -alpha, 3 - player, ply + 1)
+                except SearchTimeout:
+                    self.unmake(idx, player)
+                    raise
+            self.unmake(idx, player)
+            if value > best:
+                best = value
+                best_move = idx
+            alpha = max(alpha, value)
+            if alpha >= beta:
+                break
+
+        if best <= alpha_orig:
+            flag = UPPER
+        elif best >= beta:
+            flag = LOWER
+        else:
+            flag = EXACT
+        self.table.put(self.key, depth, flag, best, best_move)
+        return best
+
+
+def search(moves, player, budget=TIME_BUDGET, max_depth=MAX_DEPTH):
+    """根据落子序列为 player 选一步棋, 返回 (x, y), 无处可下时返回 None
+
+    在给定时间内逐层加深, 超时返回最后一个完整深度的结果。
+    """
+    if not moves:
+        return SIZE // 2, SIZE // 2
+
+    deadline = time.perf_counter() + budget
+    _table.generation = (_table.generation + 1) & 0xFFFF
+    searcher = Searcher(moves, deadline, _table)
+
+    first = searcher.candidates(player)
+    if not first:
+        return None
+    best = first[0]
+    for depth in range(1, max_depth + 1):
+        try:
+            alpha = -WIN_SCORE * 2
+            beta = WIN_SCORE * 2
+            depth_best = None
+            for idx in searcher.candidates(player, best):
+                searcher.make(idx, player)
+                if searcher.board.check_win(idx % SIZE, idx // SIZE, player):
+                    searcher.unmake(idx, player)
+                    return idx % SIZE, idx // SIZE
+                try:
+                    value = -searcher.negamax(depth - 1, -beta, -alpha, 3 - player, 1)
+                finally:
+                    searcher.unmake(idx, player)
+                if value > alpha:
+                    alpha = value
+                    depth_best = idx
+        except SearchTimeout:
+            break
+        if depth_best is not None:
+            best = depth_best
+        if alpha >= WIN_SCORE - MAX_DEPTH:
+            break  # 已找到必胜
+    return best % SIZE, best // SIZE
@@ -2,10 +2,215 @@ import tkinter as tk
 from tkinter import ttk, messagebox
 import websockets
 import asyncio
-import json
 import threading
+import time
+import queue
+import uuid
 from enum import Enum
 
+import log
+import protocol
+from board import SIZE, MIN_SIZE, MAX_SIZE, RULES, FREESTYLE
+
+SERVER_URI = "ws://localhost:8765"
+POLL_INTERVAL = 20      # Tk 主循环取网络消息的间隔 (毫秒)
+RECONNECT_DELAY = 1.0   # 大厅连接断开后的重连间隔 (秒), 逐次加倍
+MAX_RECONNECT_DELAY = 30.0
+BOARD_PIXELS = 600      # 棋盘画布边长
+MAX_CELL = 40           # 格子最大边长, 大棋盘按画布缩小
+RULE_NAMES = {'freestyle': '自由规则', 'standard': '标准规则', 'renju': '连珠规则'}
+FORBIDDEN_NAMES = {'overline': '长连禁手', 'double_four': '四四禁手', 'double_three': '三三禁手'}
+
+async def send_message(websocket, message):
+    """按连接协商的协议发送消息, 服务器不支持二进制协议时使用 JSON"""
+    binary = websocket.subprotocol == protocol.BINARY_SUBPROTOCOL
+    await websocket.send(protocol.encode(message, binary), text=not binary)
+
+class NetworkService:
+    """客户端唯一的网络线程
+
+    整个客户端只有一个后台线程和一个常驻事件循环, 大厅和所有对局窗口共用
+    同一条连接, 收到的消息按 room_id 分发。Tk 线程通过 send() 投递消息,
+    网络线程把收到的消息放入 inbox, 由 Tk 主循环定时取出处理。
+    多进程服务器把房间重定向到其他工作进程时, 每个工作进程也只建一条连接。
+
+    连接断开后自动重连, 并凭座位令牌恢复所在的对局, 服务器只补发
+    断线期间错过的落子。
+    """
+
+    def __init__(self, uri=SERVER_URI):
+        self.uri = uri
+        self.inbox = queue.Queue()
+        self.loop = asyncio.new_event_loop()
+        self.outgoing = {}   # uri -> 待发送消息队列, 每个地址一条连接
+        self.room_uris = {}  # room_id -> 房间所在连接的地址
+        self.joins = {}      # room_id -> 加入、观战或恢复座位的请求, 重定向后重发
+        self.sessions = {}   # room_id -> {"token", "seq", "resume"}, 断线后据此恢复座位
+        self.match_uri = None      # 多进程服务器负责匹配的工作进程地址, 收到 match_redirect 后才有
+        self.match_request = None  # 排队请求, 重定向后重发
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def send(self, message):
+        """可在任意线程调用, 消息交给网络线程发送"""
+        self.loop.call_soon_threadsafe(self._send_now, message)
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self._link(self.uri)
+        self.loop.run_forever()
+
+    def _send_now(self, message):
+        room_id = message.get("room_id")
+        action = message.get("action")
+        if action in ("join_room", "spectate"):
+            self.joins[room_id] = message
+            self.room_uris.setdefault(room_id, self.uri)
+        uri = self.room_uris.get(room_id, self.uri)
+        if action in ("find_match", "cancel_match"):
+            if action == "find_match":
+                self.match_request = message
+            uri = self.match_uri or self.uri
+        if action in ("exit_room", "unspectate"):
+            self.joins.pop(room_id, None)
+            self.room_uris.pop(room_id, None)
+            self.sessions.pop(room_id, None)
+        self._link(uri).put_nowait(message)
+
+    def _link(self, uri):
+        """取到某个地址的发送队列, 没有连接时建立连接"""
+        outgoing = self.outgoing.get(uri)
+        if outgoing is None:
+            outgoing = self.outgoing[uri] = asyncio.Queue()
+            self.loop.create_task(self._connection(uri, outgoing))
+        return outgoing
+
+    async def _connection(self, uri, outgoing):
+        primary = uri == self.uri
+        delay = RECONNECT_DELAY
+        while True:
+            try:
+                async with websockets.connect(uri, subprotocols=[protocol.BINARY_SUBPROTOCOL]) as websocket:
+                    delay = RECONNECT_DELAY
+                    if primary:
+                        self.inbox.put({"action": "connection_status", "connected": True})
+                        # 显式订阅, 进入房间后仍能收到大厅状态
+                        await send_message(websocket, {"action": "subscribe_lobby"})
+                    # 先恢复断线前的座位, 再发送排队中的消息
+                    for room_id, session in self.sessions.items():
+                        if session["resume"] and self.room_uris.get(room_id) == uri:
+                            session["resume"] = False
+                            resume = {
+                                "action": "resume",
+                                "room_id": room_id,
+                                "token": session["token"],
+                                "since": session["seq"]
+                            }
+                            # 公共端口可能连到其他工作进程, 重定向后改发恢复请求
+                            self.joins[room_id] = resume
+                            await send_message(websocket, resume)
+                    writer = asyncio.create_task(self._writer(websocket, outgoing))
+                    try:
+                        async for frame in websocket:
+                            self._dispatch(uri, protocol.decode(frame))
+                    finally:
+                        writer.cancel()
+            except Exception as e:
+                log.warning('connection_error', uri=uri, error=e)
+
+            resuming = self._connection_lost(uri, outgoing)
+            if not primary and not resuming:
+                # 工作进程的连接只为其中的房间服务, 没有要恢复的座位时不再重连
+                del self.outgoing[uri]
+                return
+            self.inbox.put({"action": "connection_status", "connected": False})
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+    async def _writer(self, websocket, outgoing):
+        while True:
+            message = await outgoing.get()
+            try:
+                await send_message(websocket, message)
+            except Exception:
+                self._send_failed(message)
+                raise
+
+    def _send_failed(self, message):
+        if "room_id" in message:
+            self.inbox.put({"action": "send_failed", "room_id": message["room_id"], "request": message.get("action")})
+
+    def _connection_lost(self, uri, outgoing):
+        """通知这条连接上的房间: 有座位令牌的等重连后恢复, 其余的已被服务器清理
+
+        返回是否有要恢复的座位。
+        """
+        while not outgoing.empty():
+            self._send_failed(outgoing.get_nowait())
+        if uri == self.match_uri:
+            # 服务器在断线时取消排队
+            self.inbox.put({"action": "match_cancelled"})
+        resuming = False
+        for room_id, room_uri in list(self.room_uris.items()):
+            if room_uri != uri:
+                continue
+            session = self.sessions.get(room_id)
+            if session is not None:
+                session["resume"] = True
+                resuming = True
+                self.inbox.put({"action": "connection_interrupted", "room_id": room_id})
+            else:
+                del self.room_uris[room_id]
+                self.joins.pop(room_id, None)
+                self.inbox.put({"action": "connection_lost", "room_id": room_id})
+        return resuming
+
+    def _track(self, uri, data):
+        """记录座位令牌和已收到的手数"""
+        action = data.get("action")
+        room_id = data.get("room_id")
+        if action in ("join_success", "resume_success") and "token" in data:
+            self.room_uris.setdefault(room_id, uri)
+            seq = data.get("seq")
+            if seq is None:
+                seq = sum(1 for row in data["game_state"]["board"] for v in row if v)
+            self.sessions[room_id] = {"token": data["token"], "seq": seq, "resume": False}
+            return
+        session = self.sessions.get(room_id)
+        if session is None:
+            return
+        if action == "move" and "seq" in data:
+            session["seq"] = data["seq"]
+        elif action in ("game_start", "game_state"):
+            state = data.get("game_state") or data.get("state")
+            session["seq"] = sum(1 for row in state["board"] for v in row if v)
+        elif action == "resume_failed":
+            # 座位已过期, 窗口按连接丢失处理
+            del self.sessions[room_id]
+            self.room_uris.pop(room_id, None)
+            self.joins.pop(room_id, None)
+            data["action"] = "connection_lost"
+
+    def _dispatch(self, uri, data):
+        self._track(uri, data)
+        if data.get("action") == "join_redirect":
+            # 多进程服务器: 房间在其他工作进程, 改走到该进程的连接
+            room_id = data.get("room_id")
+            join = self.joins.get(room_id)
+            if join is not None and data.get("uri"):
+                self.room_uris[room_id] = data["uri"]
+                self._link(data["uri"]).put_nowait(join)
+            return
+        if data.get("action") == "match_redirect":
+            # 多进程服务器: 匹配队列在固定的工作进程上
+            if self.match_request is not None and data.get("uri"):
+                self.match_uri = data["uri"]
+                self._link(self.match_uri).put_nowait(self.match_request)
+            return
+        self.inbox.put(data)
+
 class GameState(Enum):
     PLAYING = 0
     GAME_OVER = 1
@@ -53,7 +258,10 @@ class LobbyWindow(tk.Tk):
         
         self.setup_lobby_ui()
         self.game_windows = {}  # 存储游戏窗口实例
-        self.start_websocket()  # 添加websocket连接
+        # 所有窗口共用一个网络线程和一条连接
+        self.network = NetworkService()
+        self.network.start()
+        self.poll_network()
     
     def setup_lobby_ui(self):
         # Logo和标题
@@ -136,12 +344,59 @@ class LobbyWindow(tk.Tk):
             )
             exit_btn.pack(side=tk.LEFT)
             
+            ttk.Button(
+                button_frame,
+                text="观战",
+                style="Exit.TButton",
+                command=lambda x=i+1: self.watch_room(str(x))
+            ).pack(side=tk.LEFT, padx=5)
+            
             self.room_buttons.append((join_btn, exit_btn, status_label))
             
             # 分隔线
             if i < 4:
                 separator = ttk.Separator(rooms_frame, orient='horizontal')
                 separator.pack(fill=tk.X, pady=10)
+        
+        # 人机对战
+        bot_frame = ttk.Frame(self)
+        bot_frame.pack(fill=tk.X, padx=20, pady=20)
+        ttk.Button(
+            bot_frame,
+            text="人机对战",
+            style="Room.TButton",
+            command=self.join_bot_room
+        ).pack(side=tk.LEFT, expand=True)
+        
+        # 快速匹配: 服务器按等级分配对手并分配房间
+        self.match_btn = ttk.Button(
+            bot_frame,
+            text="快速匹配",
+            style="Room.TButton",
+            command=self.find_match
+        )
+        self.match_btn.pack(side=tk.LEFT, expand=True)
+        
+        # 创建房间时的棋盘尺寸和规则, 房间已有人时沿用房间的设置
+        variant_frame = ttk.Frame(self)
+        variant_frame.pack(fill=tk.X, padx=20, pady=(0, 20))
+        ttk.Label(variant_frame, text="棋盘").pack(side=tk.LEFT)
+        self.size_var = tk.IntVar(value=SIZE)
+        ttk.Spinbox(
+            variant_frame, from_=MIN_SIZE, to=MAX_SIZE, width=4,
+            textvariable=self.size_var, state="readonly"
+        ).pack(side=tk.LEFT, padx=5)
+        ttk.Label(variant_frame, text="规则").pack(side=tk.LEFT, padx=(20, 0))
+        self.rule_var = tk.StringVar(value=RULE_NAMES[FREESTYLE])
+        ttk.Combobox(
+            variant_frame, values=[RULE_NAMES[rule] for rule in RULES], width=10,
+            textvariable=self.rule_var, state="readonly"
+        ).pack(side=tk.LEFT, padx=5)
+
+    def variant(self):
+        """大厅中选择的棋盘尺寸和规则"""
+        names = {name: rule for rule, name in RULE_NAMES.items()}
+        return self.size_var.get(), names.get(self.rule_var.get(), FREESTYLE)
 
     def join_room(self, room_id):
         # 创建新的游戏窗口
@@ -154,10 +409,34 @@ class LobbyWindow(tk.Tk):
         join_btn.config(state=tk.DISABLED)
         exit_btn.config(state=tk.NORMAL)
 
+    def watch_room(self, room_id):
+        # 同一房间只开一个窗口
+        if room_id not in self.game_windows:
+            self.game_windows[room_id] = GameWindow(self, room_id, mode="watch")
+
+    def find_match(self):
+        if self.match_btn.cget("text") == "取消匹配":
+            self.network.send({"action": "cancel_match"})
+            return
+        self.network.send({"action": "find_match"})
+
+    def join_bot_room(self):
+        # 每局人机对战使用一个独立的房间
+        room_id = f"bot-{uuid.uuid4().hex[:8]}"
+        self.game_windows[room_id] = GameWindow(self, room_id, mode="bot")
+
     def exit_room(self, room_id):
+        """退出房间或停止观战, 窗口关闭和大厅的退出按钮都走这里"""
         if room_id in self.game_windows:
-            self.game_windows[room_id].destroy()
-            del self.game_windows[room_id]
+            game_window = self.game_windows.pop(room_id)
+            # 所有窗口共用一条连接, 关窗口不会断开, 必须通知服务器让出座位
+            self.network.send({
+                "action": "unspectate" if game_window.mode == "watch" else "exit_room",
+                "room_id": room_id
+            })
+            game_window.destroy()
+            if not room_id.isdigit() or game_window.mode == "watch":
+                return
             
             # 更新按钮状态
             idx = int(room_id) - 1
@@ -165,39 +444,44 @@ class LobbyWindow(tk.Tk):
             join_btn.config(state=tk.NORMAL)
             exit_btn.config(state=tk.DISABLED)
 
-    def start_websocket(self):
-        self.ws = None
-        threading.Thread(target=self.websocket_thread, daemon=True).start()
-    
-    def websocket_thread(self):
-        async def connect():
-            uri = "ws://localhost:8765"
+    def poll_network(self):
+        """在 Tk 主线程中处理网络线程收到的消息"""
+        while True:
             try:
-                async with websockets.connect(uri) as websocket:
-                    self.ws = websocket
-                    self.status_label.config(text="状态: 已连接")
-                    while True:
-                        try:
-                            message = await websocket.recv()
-                            data = json.loads(message)
-                            await self.handle_lobby_message(data)
-                        except Exception as e:
-                            print(f"Error in lobby websocket: {e}")
-                            break
-            except Exception as e:
-                print(f"Connection error: {e}")
-                self.status_label.config(text="状态: 连接失败")
-            finally:
-                self.ws = None
-                self.status_label.config(text="状态: 未连接")
-        
-        asyncio.run(connect())
+                data = self.network.inbox.get_nowait()
+            except queue.Empty:
+                break
+            room_id = data.get('room_id')
+            if data.get('action') == 'match_found':
+                # 匹配成功, 服务器已让我们进入房间, 窗口不再发送 join_room
+                self.match_btn.config(text="快速匹配")
+                self.game_windows[room_id] = GameWindow(self, room_id, mode="match")
+            elif room_id is not None:
+                game_window = self.game_windows.get(room_id)
+                if game_window is not None:
+                    game_window.handle_message(data)
+            else:
+                self.handle_lobby_message(data)
+        self.after(POLL_INTERVAL, self.poll_network)
 
-    async def handle_lobby_message(self, data):
+    def handle_lobby_message(self, data):
         action = data.get('action')
-        if action == 'room_status':
+        if action == 'match_queued':
+            self.match_btn.config(text="取消匹配")
+        elif action == 'match_cancelled':
+            self.match_btn.config(text="快速匹配")
+        elif action == 'error' and data.get('message') in ('rate_limited', 'message_too_large'):
+            # 解析前被拒绝的请求不带房间号, 撤回所有等待确认的落子
+            for game_window in self.game_windows.values():
+                game_window.handle_move_failed()
+        elif action == 'connection_status':
+            self.status_label.config(text="状态: 已连接" if data.get('connected') else "状态: 未连接")
+        elif action == 'room_status':
             rooms = data.get('rooms', {})
             for room_id, status in rooms.items():
+                # 服务器按需创建房间, 大厅只显示固定编号的房间
+                if not room_id.isdigit():
+                    continue
                 idx = int(room_id) - 1
                 if 0 <= idx < len(self.room_buttons):
                     _, _, status_label = self.room_buttons[idx]
@@ -206,24 +490,38 @@ class LobbyWindow(tk.Tk):
                     status_label.config(text=status_text)
 
 class GameWindow(tk.Toplevel):
-    def __init__(self, master, room_id):
+    def __init__(self, master, room_id, mode=None):
         super().__init__(master)
-        self.title(f"五子棋 - 房间 {room_id}")
+        if mode == "bot":
+            self.title("五子棋 - 人机对战")
+        elif mode == "match":
+            self.title("五子棋 - 匹配对战")
+        elif mode == "watch":
+            self.title(f"五子棋 - 观战 房间 {room_id}")
+        else:
+            self.title(f"五子棋 - 房间 {room_id}")
         self.configure(bg='#F5F5F5')
         
         # 初始化游戏状态
         self.room_id = room_id
+        self.mode = mode
         self.game_state = GameState.PLAYING
-        self.board = [[0]*15 for _ in range(15)]
+        self.size = SIZE
+        self.board = self.empty_board()
         self.is_my_turn = False
         self.my_role = None
-        self.cell_size = 40  # 调整格子大小
-        self.board_padding = 50  # 调整边距
+        self.rule = FREESTYLE
+        self.layout()
         self.pending_move = None  # 添加等待确认的移动
         self.current_player = None  # 添加当前玩家标记
-        self._ws_lock = threading.Lock()  # 添加线程锁
         self._cleanup_needed = False  # 添加清理标记
         self.last_move = None  # 添加最后一步记录
+        self.clock = None  # 服务器给出的 [黑方剩余, 白方剩余, 本步剩余] 毫秒
+        self.clock_turn = None  # 正在计时的一方
+        self.clock_at = 0.0  # 收到计时状态的本地时间
+        self.clock_job = None
+        self.version = None  # 本地棋盘对应的房间版本, 断档时凭它请求补发
+        self.seq = 0  # 本地棋盘的手数
         
         # 窗口设置
         window_width = 600
@@ -240,7 +538,6 @@ class GameWindow(tk.Toplevel):
         
         # 关闭窗口时退出房间
         self.protocol("WM_DELETE_WINDOW", self.on_closing)
-        print("初始化游戏窗口")  # 添加调试信息
     
     def setup_game_ui(self):
         # 添加玩家信息面板
@@ -256,6 +553,8 @@ class GameWindow(tk.Toplevel):
             font=('Microsoft YaHei UI', 14, 'bold'),
             foreground=self.master.theme['black_piece']
         ).pack()
+        self.black_clock = ttk.Label(black_frame, text="", font=('Microsoft YaHei UI', 11))
+        self.black_clock.pack()
 
         # 状态信息
         self.status_label = ttk.Label(
@@ -265,6 +564,15 @@ class GameWindow(tk.Toplevel):
             foreground=self.master.theme['primary']
         )
         self.status_label.pack(side=tk.LEFT, expand=True)
+        
+        # 按开局库提示下一手
+        if self.mode != "watch":
+            ttk.Button(
+                player_frame,
+                text="提示",
+                style="Exit.TButton",
+                command=self.request_hint
+            ).pack(side=tk.LEFT)
 
         # 白方信息
         white_frame = ttk.Frame(player_frame)
@@ -275,6 +583,8 @@ class GameWindow(tk.Toplevel):
             font=('Microsoft YaHei UI', 14, 'bold'),
             foreground=self.master.theme['text_light']
         ).pack()
+        self.white_clock = ttk.Label(white_frame, text="", font=('Microsoft YaHei UI', 11))
+        self.white_clock.pack()
 
         # 棋盘容器（添加阴影效果）
         board_container = ttk.Frame(self)
@@ -297,46 +607,96 @@ class GameWindow(tk.Toplevel):
         # 绑定鼠标事件
         self.canvas.bind("<Button-1>", self.on_canvas_click)
         
-        # 启动websocket连接
-        self.start_websocket()
+        # 通过大厅的网络线程加入房间
+        if self.mode == "watch":
+            self.master.network.send({"action": "spectate", "room_id": self.room_id})
+            return
+        if self.mode == "match":
+            return
+        join = {"action": "join_room", "room_id": self.room_id}
+        if self.mode:
+            join["mode"] = self.mode
+        else:
+            join["size"], join["rule"] = self.master.variant()
+        self.master.network.send(join)
     
+    def empty_board(self):
+        return [[0] * self.size for _ in range(self.size)]
+
+    def layout(self):
+        """按棋盘尺寸计算格子大小和边距, 棋盘在画布中居中"""
+        self.cell_size = min(MAX_CELL, (BOARD_PIXELS - 60) // (self.size - 1))
+        self.board_padding = (BOARD_PIXELS - self.cell_size * (self.size - 1)) // 2
+
+    def resize(self, size):
+        """换成 size 路的空棋盘, 尺寸变化时重画静态棋盘"""
+        self.board = [[0] * size for _ in range(size)]
+        if size != self.size:
+            self.size = size
+            self.layout()
+            self.draw_board()
+
+    def set_board(self, state):
+        """采用服务器给出的棋盘"""
+        board = state.get("board")
+        self.rule = state.get("rule", self.rule)
+        self.resize(len(board) if board else self.size)
+        if board:
+            self.board = board
+
     def draw_board(self):
+        """完整重绘: 静态棋盘只在这里绘制一次, 之后按标签增量更新"""
         self.canvas.delete("all")
-        
+        self.draw_static_board()
+        self.redraw_pieces()
+
+    def draw_static_board(self):
         # 绘制棋盘背景
         self.canvas.create_rectangle(
-            0, 0, 600, 600,
+            0, 0, BOARD_PIXELS, BOARD_PIXELS,
             fill=self.master.theme['board_bg'],
-            outline=""
+            outline="",
+            tags="static"
         )
         
         # 绘制网格线
-        for i in range(15):
+        end = self.board_padding + (self.size - 1) * self.cell_size
+        for i in range(self.size):
             # 横线
             self.canvas.create_line(
                 self.board_padding, self.board_padding + i * self.cell_size,
-                self.board_padding + 14 * self.cell_size, self.board_padding + i * self.cell_size,
+                end, self.board_padding + i * self.cell_size,
                 fill=self.master.theme['board_line'],
-                width=1
+                width=1,
+                tags="static"
             )
             # 竖线
             self.canvas.create_line(
                 self.board_padding + i * self.cell_size, self.board_padding,
-                self.board_padding + i * self.cell_size, self.board_padding + 14 * self.cell_size,
+                self.board_padding + i * self.cell_size, end,
                 fill=self.master.theme['board_line'],
-                width=1
+                width=1,
+                tags="static"
             )
 
-        # 绘制天元和星点
-        star_points = [(3,3), (11,3), (7,7), (3,11), (11,11)]
+        # 绘制天元和星点, 19 路以上另加四边中点
+        edge = 3 if self.size >= 13 else 2
+        far = self.size - 1 - edge
+        mid = self.size // 2
+        star_points = [(edge, edge), (far, edge), (mid, mid), (edge, far), (far, far)]
+        if self.size >= 19:
+            star_points += [(mid, edge), (edge, mid), (far, mid), (mid, far)]
         for x, y in star_points:
             self.draw_star_point(x, y)
-        
-        # 绘制棋子
-        for y in range(15):
-            for x in range(15):
+
+    def redraw_pieces(self):
+        """重新同步棋盘时重画全部棋子, 静态部分保留"""
+        self.canvas.delete("piece", "last_move", "hint")
+        for y in range(self.size):
+            for x in range(self.size):
                 if self.board[y][x] != 0:
                     self.draw_piece(x, y, self.board[y][x])
+        self.draw_last_move_marker()
 
     def draw_star_point(self, x, y):
         """绘制星点"""
@@ -345,28 +705,32 @@ class GameWindow(tk.Toplevel):
         r = 4
         self.canvas.create_oval(
             cx-r, cy-r, cx+r, cy+r,
-            fill=self.master.theme['board_line']
+            fill=self.master.theme['board_line'],
+            tags="static"
         )
 
     def draw_piece(self, x, y, player):
         """绘制棋子带光泽效果"""
         cx = self.board_padding + x * self.cell_size
         cy = self.board_padding + y * self.cell_size
-        r = 16
+        r = self.cell_size * 2 // 5
 
         color = self.master.theme['black_piece'] if player == 1 else self.master.theme['white_piece']
+        tags = ("piece", f"piece_{x}_{y}")
         
         # 绘制阴影
         self.canvas.create_oval(
             cx-r+2, cy-r+2, cx+r+2, cy+r+2,
-            fill='gray', outline='gray'
+            fill='gray', outline='gray',
+            tags=tags
         )
         
         # 绘制棋子本体
         self.canvas.create_oval(
             cx-r, cy-r, cx+r, cy+r,
             fill=color,
-            outline='gray'
+            outline='gray',
+            tags=tags
         )
         
         # 添加高光效果
@@ -374,71 +738,66 @@ class GameWindow(tk.Toplevel):
             self.canvas.create_oval(
                 cx-r/2, cy-r/2, cx, cy,
                 fill='white',
-                stipple='gray50'
+                stipple='gray50',
+                tags=tags
             )
+
+    def draw_last_move_marker(self):
+        """在最后一步上画标记, 只移动这一个图元"""
+        self.canvas.delete("last_move")
+        if not self.last_move:
+            return
+        x, y = self.last_move
+        cx = self.board_padding + x * self.cell_size
+        cy = self.board_padding + y * self.cell_size
+        r = 4
+        self.canvas.create_rectangle(
+            cx-r, cy-r, cx+r, cy+r,
+            fill=self.master.theme['warning'],
+            outline="",
+            tags="last_move"
+        )
     
+    def request_hint(self):
+        if self.is_my_turn and self.game_state == GameState.PLAYING and not self.pending_move:
+            self.master.network.send({"action": "hint", "room_id": self.room_id})
+
+    def draw_hint(self, x, y):
+        """在开局库建议的位置画空心圆, 下一次落子时清除"""
+        self.canvas.delete("hint")
+        cx = self.board_padding + x * self.cell_size
+        cy = self.board_padding + y * self.cell_size
+        r = self.cell_size * 2 // 5
+        self.canvas.create_oval(
+            cx-r, cy-r, cx+r, cy+r,
+            outline=self.master.theme['primary'],
+            width=2,
+            tags="hint"
+        )
+
     def on_canvas_click(self, event):
-        print(f"点击事件: x={event.x}, y={event.y}, is_my_turn={self.is_my_turn}, my_role={self.my_role}")
-        
         if not self.is_my_turn or self.game_state != GameState.PLAYING or self.pending_move:
-            print(f"不能下棋: is_my_turn={self.is_my_turn}, game_state={self.game_state}")
             return
         
         # 修正坐标计算逻辑
         x = round((event.x - self.board_padding) / self.cell_size)
         y = round((event.y - self.board_padding) / self.cell_size)
         
-        print(f"尝试落子: x={x}, y={y}, my_role={self.my_role}")
-        
         # 验证坐标是否有效
-        if 0 <= x < 15 and 0 <= y < 15 and self.board[y][x] == 0:
+        if 0 <= x < self.size and 0 <= y < self.size and self.board[y][x] == 0:
             # 不预先在本地显示棋子，等服务器确认
             self.pending_move = (x, y)
             self.send_move(x, y)
             self.is_my_turn = False  # 暂时禁用落子
             self.update_status()
     
-    def start_websocket(self):
-        self.ws = None
-        threading.Thread(target=self.websocket_thread, daemon=True).start()
-    
-    def websocket_thread(self):
-        async def connect():
-            uri = "ws://localhost:8765"
-            async with websockets.connect(uri) as websocket:
-                self.ws = websocket
-                # 加入房间
-                await websocket.send(json.dumps({
-                    "action": "join_room",
-                    "room_id": self.room_id
-                }))
-                
-                while True:
-                    try:
-                        message = await websocket.recv()
-                        data = json.loads(message)
-                        self.handle_message(data)
-                    except:
-                        break
-        
-        asyncio.run(connect())
-    
     def send_move(self, x, y):
-        async def send():
-            with self._ws_lock:  # 使用线程锁保护websocket访问
-                if self.ws:
-                    try:
-                        await self.ws.send(json.dumps({
-                            "action": "move",
-                            "room_id": self.room_id,
-                            "x": x,
-                            "y": y
-                        }))
-                    except Exception as e:
-                        print(f"发送移动消息失败: {e}")
-                        self.handle_move_failed()
-
-        asyncio.run(send())
+        self.master.network.send({
+            "action": "move",
+            "room_id": self.room_id,
+            "x": x,
+            "y": y
+        })
 
     def handle_move_failed(self):
         """处理移动失败的情况"""
@@ -447,56 +806,113 @@ class GameWindow(tk.Toplevel):
             self.board[y][x] = 0
             self.pending_move = None
             self.is_my_turn = True
-            self.draw_board()
             self.update_status()
             self.after(0, lambda: messagebox.showwarning("提示", "落子失败: 网络错误"))
 
     def handle_message(self, data):
-        # 使用after方法确保在主线程中处理UI更新
-        self.after(0, lambda: self._handle_message_impl(data))
+        # 大厅已在主线程中分发, 直接处理
+        self._handle_message_impl(data)
 
     def _handle_message_impl(self, data):
         """在主线程中处理消息"""
         action = data.get("action")
-        print(f"收到消息: {action}, data={data}")
+        log.debug('message', room=self.room_id, action=action)
         
         if action == "join_success":
             self.my_role = data.get("role")
             self.is_my_turn = data.get("is_first", False)
             self.current_player = 1  # 游戏开始时黑棋先行
             game_state = data.get("game_state", {})
-            self.board = game_state.get("board", [[0]*15 for _ in range(15)])
+            self.set_board(game_state)
+            self.last_move = game_state.get("last_move")
             self.pending_move = None
-            self.draw_board()
+            if "clock" in game_state:
+                self.set_clock(game_state["clock"], game_state.get("current_player"))
+            self.set_version(game_state.get("version"))
+            self.redraw_pieces()
+            self.update_status()
+        
+        elif action == "spectate_success":
+            # 服务器只补发缺少的落子, 或者直接给出完整棋盘
+            if "game_state" in data:
+                game_state = data["game_state"]
+                self.set_board(game_state)
+                self.last_move = game_state.get("last_move")
+                if "clock" in game_state:
+                    self.set_clock(game_state["clock"], game_state.get("current_player"))
+            else:
+                self.resize(data.get("size", self.size))
+                self.rule = data.get("rule", self.rule)
+                self.last_move = None
+                for move in data.get("moves", []):
+                    self.board[move["y"]][move["x"]] = move["player"]
+                    self.last_move = (move["x"], move["y"])
+                    if "clock" in move:
+                        self.set_clock(move["clock"], 3 - move["player"])
+            self.set_version(data.get("version"))
+            self.redraw_pieces()
+            self.status_label.config(text="观战中")
+        
+        elif action == "sync":
+            # 补发的落子接在本地棋盘之后, 或者是完整棋盘
+            if "game_state" in data:
+                game_state = data["game_state"]
+                self.set_board(game_state)
+                self.last_move = game_state.get("last_move")
+                self.current_player = game_state.get("current_player", self.current_player)
+            for move in data.get("moves", []):
+                self.board[move["y"]][move["x"]] = move["player"]
+                self.last_move = (move["x"], move["y"])
+                self.current_player = 3 - move["player"]
+            self.set_version(data.get("version"))
+            if self.my_role is not None:
+                self.is_my_turn = self.my_role == ("black" if self.current_player == 1 else "white")
+            self.redraw_pieces()
             self.update_status()
-            print(f"加入成功: role={self.my_role}, is_first={self.is_my_turn}")
+        
+        elif action == "spectate_failed":
+            self.status_label.config(text="房间不存在")
         
         elif action == "game_start":
             game_state = data.get("game_state", {})
-            self.board = game_state.get("board", [[0]*15 for _ in range(15)])
+            self.set_board(game_state)
+            self.last_move = game_state.get("last_move")
             self.game_state = GameState.PLAYING
             self.pending_move = None  # 重置等待移动
-            self.draw_board()
+            if "clock" in game_state:
+                self.set_clock(game_state["clock"], game_state.get("current_player"))
+            self.set_version(game_state.get("version"))
+            self.redraw_pieces()
             self.update_status()
         
         elif action == "game_state":
             # 处理游戏状态更新
             state = data.get("state", {})
-            self.board = state.get("board", [[0]*15 for _ in range(15)])
-            self.draw_board()
+            self.set_board(state)
+            self.last_move = state.get("last_move")
+            if "clock" in state:
+                self.set_clock(state["clock"], state.get("current_player"))
+            self.set_version(state.get("version"))
+            self.redraw_pieces()
             self.update_status()
         
         elif action == "game_over":
             self.game_state = GameState.GAME_OVER
             winner = data.get("winner")
-            messagebox.showinfo("游戏结束", f"{winner}获胜！")
+            self.update_clock()
+            if data.get("reason") == "timeout":
+                messagebox.showinfo("游戏结束", f"超时判负, {winner}获胜！")
+            elif data.get("reason") == "bot_error":
+                messagebox.showinfo("游戏结束", f"AI 出错, {winner}获胜！")
+            else:
+                messagebox.showinfo("游戏结束", f"{winner}获胜！")
             self.pending_move = None  # 重置等待移动
             self.update_status()
         
         elif action == "player_disconnected":
             if not self._cleanup_needed:  # 避免重复显示消息
                 self._cleanup_needed = True
-                messagebox.showinfo("提示", "对手已断开连接")
+                messagebox.showinfo("提示", "玩家已离开" if self.mode == "watch" else "对手已断开连接")
                 self.game_state = GameState.GAME_OVER
                 self.pending_move = None  # 重置等待移动
                 self.update_status()
@@ -505,9 +921,16 @@ class GameWindow(tk.Toplevel):
             x = data.get("x")
             y = data.get("y")
             player = data.get("player")
-            print(f"收到移动: x={x}, y={y}, player={player}, my_role={self.my_role}")
+            seq = data.get("seq")
+            if self.version is not None and seq is not None and seq > self.seq + 1:
+                # 中间漏了落子, 只请求缺少的部分
+                self.master.network.send({"action": "sync", "room_id": self.room_id, "version": self.version})
+                return
+            if self.version is not None and seq is not None:
+                self.version += seq - self.seq
+                self.seq = seq
             
-            if 0 <= x < 15 and 0 <= y < 15:
+            if 0 <= x < self.size and 0 <= y < self.size:
                 self.board[y][x] = player
                 self.last_move = (x, y)
                 
@@ -520,39 +943,122 @@ class GameWindow(tk.Toplevel):
                     (self.my_role == "white" and self.current_player == 2)
                 )
                 
+                if "clock" in data:
+                    self.set_clock(data["clock"], self.current_player)
                 if self.pending_move == (x, y):
                     self.pending_move = None
-                
-                print(f"移动后状态: current_player={self.current_player}, is_my_turn={self.is_my_turn}")
-                self.draw_board()
+                # 只画新棋子并移动最后一步标记
+                self.canvas.delete("hint")
+                self.draw_piece(x, y, player)
+                self.draw_last_move_marker()
                 self.update_status()
         
         elif action == "move_failed":
-            print(f"Move failed: {data.get('reason')}")  # 添加调试信息
+            log.debug('move_failed', room=self.room_id, reason=data.get('reason'))
             if self.pending_move:
                 self.board[self.pending_move[1]][self.pending_move[0]] = 0
                 self.pending_move = None
                 self.is_my_turn = True  # 恢复落子权限
-                self.draw_board()
                 self.update_status()
-                messagebox.showwarning("提示", "落子失败: " + data.get("reason", "未知原因"))
+                reason = data.get("reason", "未知原因")
+                if reason == "forbidden":
+                    reason = FORBIDDEN_NAMES.get(data.get("forbidden"), "禁手")
+                messagebox.showwarning("提示", "落子失败: " + reason)
         
-        elif action == "game_over":
-            self.game_state = GameState.GAME_OVER
-            winner = data.get("winner")
-            messagebox.showinfo("游戏结束", f"{winner}获胜！")
+        elif action == "hint":
+            self.draw_hint(data["x"], data["y"])
+            self.status_label.config(text=f"开局库: {data.get('games', 0)} 局中胜 {data.get('wins', 0)} 局")
+        
+        elif action == "hint_failed":
+            if data.get("reason") == "not_in_book":
+                self.status_label.config(text="开局库中没有这个局面")
+        
+        elif action == "send_failed":
+            if data.get("request") == "move":
+                self.handle_move_failed()
+        
+        elif action == "connection_interrupted":
+            self.status_label.config(text="连接中断, 正在重连...")
+        
+        elif action == "resume_success":
+            # 重连后服务器只补发错过的落子, 或者给出完整棋盘
+            self.my_role = data.get("role")
+            if "game_state" in data:
+                game_state = data["game_state"]
+                self.set_board(game_state)
+                self.last_move = game_state.get("last_move")
+                if "clock" in game_state:
+                    self.set_clock(game_state["clock"], game_state.get("current_player"))
+            for move in data.get("moves", []):
+                self.board[move["y"]][move["x"]] = move["player"]
+                self.last_move = (move["x"], move["y"])
+                if "clock" in move:
+                    self.set_clock(move["clock"], 3 - move["player"])
+            self.current_player = 1 if data.get("seq", 0) % 2 == 0 else 2
+            self.set_version(data.get("version"))
+            self.is_my_turn = self.my_role == ("black" if self.current_player == 1 else "white")
+            self.pending_move = None
+            self.redraw_pieces()
             self.update_status()
         
-        elif action == "player_disconnected":
-            messagebox.showinfo("提示", "对手已断开连接")
+        elif action == "player_away":
+            self.status_label.config(text=f"对手断线, 等待重连 ({data.get('grace', 0)} 秒)...")
+        
+        elif action == "player_returned":
+            self.update_status()
+        
+        elif action == "connection_lost":
             self.game_state = GameState.GAME_OVER
+            self.pending_move = None
             self.update_status()
+            messagebox.showinfo("提示", "与服务器断开连接")
     
+    def set_version(self, version):
+        """本地棋盘与服务器的某个版本一致时记下版本和手数"""
+        if version is not None:
+            self.version = version
+            self.seq = sum(1 for row in self.board for v in row if v)
+
+    def set_clock(self, clock, turn):
+        """记下服务器的计时状态, 之后在本地倒计时显示"""
+        self.clock = clock
+        self.clock_turn = turn
+        self.clock_at = time.monotonic()
+        self.update_clock()
+
+    def update_clock(self):
+        if self.clock_job is not None:
+            self.after_cancel(self.clock_job)
+            self.clock_job = None
+        if self.clock is None:
+            return
+        black, white, turn = self.clock
+        if self.game_state == GameState.PLAYING:
+            spent = int((time.monotonic() - self.clock_at) * 1000)
+            turn = max(0, turn - spent)
+            if self.clock_turn == 1:
+                black = max(0, black - spent)
+            elif self.clock_turn == 2:
+                white = max(0, white - spent)
+            self.clock_job = self.after(200, self.update_clock)
+
+        def fmt(ms, side):
+            text = f"{ms // 60000:02d}:{ms // 1000 % 60:02d}"
+            if side == self.clock_turn and self.game_state == GameState.PLAYING:
+                text += f"  本步 {turn // 1000}"
+            return text
+
+        self.black_clock.config(text=fmt(black, 1))
+        self.white_clock.config(text=fmt(white, 2))
+
     def update_ui(self):
-        self.draw_board()
+        self.redraw_pieces()
         self.update_status()
     
     def update_status(self):
+        if self.mode == "watch":
+            self.status_label.config(text="观战中" if self.game_state == GameState.PLAYING else "游戏结束")
+            return
         status = "游戏结束"
         if self.game_state == GameState.PLAYING:
             if self.my_role is None:
@@ -569,24 +1075,8 @@ class GameWindow(tk.Toplevel):
     
     def on_closing(self):
         """处理窗口关闭事件"""
-        async def close():
-            with self._ws_lock:
-                if self.ws:
-                    try:
-                        await self.ws.send(json.dumps({
-                            "action": "exit_room",
-                            "room_id": self.room_id
-                        }))
-                    except:
-                        pass
-        
-        try:
-            asyncio.run(close())
-        except:
-            pass
-        finally:
-            self.master.exit_room(self.room_id)
-            self.destroy()
+        self.master.exit_room(self.room_id)
+        self.destroy()
 
 if __name__ == "__main__":
     app = LobbyWindow()
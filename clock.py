@@ -0,0 +1,76 @@
+"""对局计时
+
+每方有总用时, 每步另有步时上限, 轮到一方时的截止时间为两者中先到的一个。
+所有对局的截止时间挂在服务器的时间轮上, 一局同时只有一个定时器: 落子时
+取消旧定时器并为对方挂上新的, 不为每局创建协程。到期回调由服务器判负。
+
+计时状态以 [黑方剩余毫秒, 白方剩余毫秒, 当前一步剩余毫秒] 放在消息中。
+"""
+import time
+
+TOTAL_TIME = 600.0  # 每方总用时, 单位秒
+MOVE_TIME = 60.0    # 每步用时上限
+
+
+class GameClock:
+    __slots__ = ('wheel', 'move_time', 'remaining', 'turn', 'turn_start', 'timer', 'on_timeout', 'args')
+
+    def __init__(self, wheel, total_time, move_time, on_timeout, *args):
+        self.wheel = wheel
+        self.move_time = move_time
+        self.remaining = [0.0, total_time, total_time]  # 按颜色下标, 1 黑 2 白
+        self.turn = None        # 正在计时的一方, 停止时为 None
+        self.turn_start = 0.0
+        self.timer = None
+        self.on_timeout = on_timeout  # on_timeout(*args, color)
+        self.args = args
+
+    def turn_left(self, now):
+        """当前一方这一步还剩的秒数"""
+        if self.turn is None:
+            return 0.0
+        spent = now - self.turn_start
+        return max(0.0, min(self.move_time - spent, self.remaining[self.turn] - spent))
+
+    def start(self, color, now=None):
+        """开始为 color 计时"""
+        now = time.monotonic() if now is None else now
+        self.stop(now)
+        self.turn = color
+        self.turn_start = now
+        self.timer = self.wheel.schedule(self.turn_left(now), self._expire, color)
+
+    def switch(self, now=None):
+        """当前一方落子, 扣除用时并开始为对方计时"""
+        now = time.monotonic() if now is None else now
+        color = self.turn
+        if color is not None:
+            self.start(3 - color, now)
+
+    def stop(self, now=None):
+        """扣除当前一方的用时并停止计时"""
+        if self.turn is None:
+            return
+        now = time.monotonic() if now is None else now
+        self.remaining[self.turn] = max(0.0, self.remaining[self.turn] - (now - self.turn_start))
+        self.turn = None
+        self.timer.cancel()
+        self.timer = None
+
+    def state(self, now=None):
+        """[黑方剩余毫秒, 白方剩余毫秒, 当前一步剩余毫秒]"""
+        now = time.monotonic() if now is None else now
+        black, white = self.remaining[1], self.remaining[2]
+        if self.turn is not None:
+            spent = now - self.turn_start
+            if self.turn == 1:
+                black = max(0.0, black - spent)
+            else:
+                white = max(0.0, white - spent)
+        return [int(black * 1000), int(white * 1000), int(self.turn_left(now) * 1000)]
+
+    def _expire(self, color):
+        if self.turn != color:
+            return
+        self.stop()
+        self.on_timeout(*self.args, color)
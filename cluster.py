@@ -0,0 +1,170 @@
+"""多进程分片模式
+
+主进程启动 N 个工作进程, 每个工作进程运行一个 GameServer, 按房间号的
+哈希负责一部分房间。所有工作进程通过 SO_REUSEPORT 共同监听公共端口,
+另外各自监听一个专用端口 (公共端口 + 1 + 分片号)。在公共端口上加入
+不属于本分片的房间或观战时, 服务器返回 join_redirect, 客户端改连专用端口。
+
+大厅状态通过管道汇总: 工作进程把本分片的房间变化发给主进程,
+主进程转发给其他工作进程, 再由它们推送给各自的大厅订阅者。管道写入
+都在后台线程中进行, 对端慢时变化按房间合并等待, 事件循环和主进程的
+转发循环都不会因为某个进程读得慢而阻塞。
+
+快速匹配只在 MATCH_SHARD 上排队: 其他工作进程收到 find_match 时返回
+match_redirect, 客户端改到该分片排队, 不同进程上的玩家也能互相配对。
+"""
+import asyncio
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import zlib
+from multiprocessing.connection import wait
+
+import log
+from board import SIZE, FREESTYLE
+from clock import TOTAL_TIME, MOVE_TIME
+
+
+MATCH_SHARD = 0  # 负责快速匹配队列的分片
+
+
+def shard_of(room_id, shards):
+    """房间所属的分片, 各进程结果一致"""
+    return zlib.crc32(room_id.encode('utf-8')) % shards
+
+
+def shard_port(port, shard):
+    return port + 1 + shard
+
+
+class DeltaSender:
+    """在后台线程中把大厅变化写入管道, send() 从不阻塞
+
+    还没写出的变化合并在一个字典里, 同一房间只保留最新状态, 对端读得慢时
+    积压的只是房间数量级的字典, 不会无限增长。
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def send(self, changed):
+        with self.lock:
+            self.pending.update(changed)
+        self.ready.set()
+
+    def _run(self):
+        while True:
+            self.ready.wait()
+            with self.lock:
+                self.ready.clear()
+                changed, self.pending = self.pending, {}
+            if not changed:
+                continue
+            try:
+                self.conn.send(changed)
+            except (OSError, ValueError):
+                return  # 对端已退出
+
+
+def _worker(shard, shards, host, port, conn, journal_dir, metrics_dump, time_control, limits, variant, book):
+    asyncio.run(_serve_worker(shard, shards, host, port, conn, journal_dir, metrics_dump, time_control, limits,
+                              variant, book))
+
+
+async def _serve_worker(shard, shards, host, port, conn, journal_dir, metrics_dump, time_control, limits,
+                        variant, book):
+    import websockets
+    import protocol
+    from server import GameServer, open_journal
+
+    shard_uris = [f"ws://{host}:{shard_port(port, i)}" for i in range(shards)]
+    server = GameServer(shard=shard, shards=shards, shard_uris=shard_uris, time_control=time_control,
+                        limits=limits, variant=variant, book=book)
+    server.lobby.on_flush = DeltaSender(conn).send
+    # 每个分片写自己的日志目录
+    if journal_dir:
+        open_journal(os.path.join(journal_dir, f"shard-{shard}"), server)
+
+    loop = asyncio.get_running_loop()
+    stopped = loop.create_future()
+
+    def stop():
+        if not stopped.done():
+            stopped.set_result(None)
+
+    def on_remote_status():
+        try:
+            changed = conn.recv()
+        except EOFError:
+            loop.remove_reader(conn.fileno())
+            stop()
+            return
+        server.lobby.apply_remote(changed)
+
+    loop.add_reader(conn.fileno(), on_remote_status)
+    # 主进程退出时随之退出, 不留下孤儿进程
+    loop.add_reader(multiprocessing.parent_process().sentinel, stop)
+    # 主进程用 SIGTERM 结束工作进程, 先写完日志再退出
+    loop.add_signal_handler(signal.SIGTERM, stop)
+
+    options = dict(ping_timeout=None, ping_interval=None, select_subprotocol=protocol.select_subprotocol,
+                   process_request=server.process_request)
+    async with websockets.serve(server.handle_connection, host, port, reuse_port=True, **options), \
+            websockets.serve(server.handle_connection, host, shard_port(port, shard), **options):
+        log.info('worker_started', shard=shard, uri=f"ws://{host}:{port}", shard_uri=shard_uris[shard])
+        server.start(metrics_dump)
+        try:
+            await stopped
+        finally:
+            await server.close()
+
+
+def run(host, port, workers, journal_dir=None, metrics_dump=None, time_control=(TOTAL_TIME, MOVE_TIME),
+        limits=None, variant=(SIZE, FREESTYLE), book=None):
+    """启动工作进程并在主进程中转发大厅状态"""
+    conns = []
+    procs = []
+    for shard in range(workers):
+        parent_conn, child_conn = multiprocessing.Pipe()
+        proc = multiprocessing.Process(
+            target=_worker,
+            args=(shard, workers, host, port, child_conn, journal_dir, metrics_dump, time_control, limits, variant,
+                  book),
+            daemon=True
+        )
+        proc.start()
+        child_conn.close()
+        conns.append(parent_conn)
+        procs.append(proc)
+
+    # SIGTERM 时也走 finally, 结束工作进程
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    log.info('server_started', uri=f"ws://{host}:{port}", workers=workers)
+    senders = {conn: DeltaSender(conn) for conn in conns}
+    live = list(conns)
+    try:
+        while live:
+            for conn in wait(live):
+                try:
+                    changed = conn.recv()
+                except EOFError:
+                    live.remove(conn)
+                    continue
+                for other in live:
+                    if other is not conn:
+                        senders[other].send(changed)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for proc in procs:
+            proc.terminate()
+        for proc in procs:
+            proc.join()
@@ -0,0 +1,169 @@
+"""消息扇出
+
+每条消息对每种协议 (JSON / 二进制) 只序列化一次, 得到的字节被所有接收者共用。
+每个连接有一个有界发送队列和独立的写协程, 所有接收者并发写出,
+慢连接只会堆积自己的队列, 不会拖慢其他玩家。
+
+观战消息另有处理: 某个房间积压的观战消息过多时, 不再逐条排队, 只放一个
+占位, 写到它时再取房间最新的快照发送, 慢观众直接跳到最新局面。
+"""
+import asyncio
+
+import log
+import protocol
+
+OUTBOX_SIZE = 256
+WATCH_BACKLOG = 32  # 每个连接每个观战房间最多积压的消息数
+
+# 队列满时的处理策略
+DROP_OLDEST = 'drop_oldest'  # 丢弃最旧的一条
+DISCONNECT = 'disconnect'    # 断开慢连接
+
+
+class Outbox:
+    """单个连接的发送队列"""
+
+    __slots__ = ('websocket', 'binary', 'queue', 'policy', 'task', 'dropped',
+                 'resync', 'watch_pending', 'behind')
+
+    def __init__(self, websocket, maxsize=OUTBOX_SIZE, policy=DISCONNECT, binary=False, resync=None):
+        self.websocket = websocket
+        self.binary = binary
+        self.queue = asyncio.Queue(maxsize)
+        self.policy = policy
+        self.dropped = 0
+        self.resync = resync      # room_id -> 最新快照消息, 用于慢观众
+        self.watch_pending = {}   # 观战房间 -> 队列中该房间的消息数
+        self.behind = set()       # 已放入快照占位、跳过后续消息的房间
+        self.task = asyncio.create_task(self._writer())
+
+    def put(self, frame):
+        """把已编码的消息放入队列, 从不等待"""
+        try:
+            self.queue.put_nowait(frame)
+            return True
+        except asyncio.QueueFull:
+            pass
+
+        self.dropped += 1
+        if self.policy == DROP_OLDEST:
+            old = self.queue.get_nowait()
+            if type(old) is tuple:
+                self._settle(*old)
+            self.queue.put_nowait(frame)
+            return True
+
+        # 队列满说明对端长期不读, 直接断开
+        self.close()
+        return False
+
+    def put_watch(self, room_id, frame):
+        """放入观战消息, 积压过多时改为等写出时发送最新快照"""
+        if room_id in self.behind:
+            return
+        pending = self.watch_pending.get(room_id, 0)
+        if pending < WATCH_BACKLOG and self.queue.qsize() < self.queue.maxsize // 2:
+            # 观战消息最多占一半队列, 给对局消息留出空间
+            self.watch_pending[room_id] = pending + 1
+            self.queue.put_nowait((room_id, frame))
+            return
+        self.dropped += 1
+        self.behind.add(room_id)
+        self.watch_pending[room_id] = pending + 1
+        self.put((room_id, None))
+
+    def close(self):
+        if not self.task.done():
+            self.task.cancel()
+            asyncio.ensure_future(self.websocket.close(1013, 'slow consumer'))
+
+    async def _writer(self):
+        websocket = self.websocket
+        queue = self.queue
+        text = not self.binary  # JSON 协议的字节以文本帧发送
+        try:
+            while True:
+                frame = await queue.get()
+                if type(frame) is tuple:
+                    frame = self._watch_frame(*frame)
+                    if frame is None:
+                        continue
+                await websocket.send(frame, text=text)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            log.warning('send_failed', error=e)
+
+
+    def _settle(self, room_id, frame):
+        """观战消息出队时的计数, frame 为 None 表示快照占位"""
+        pending = self.watch_pending[room_id] - 1
+        if pending:
+            self.watch_pending[room_id] = pending
+        else:
+            del self.watch_pending[room_id]
+        if frame is None:
+            self.behind.discard(room_id)
+
+    def _watch_frame(self, room_id, frame):
+        self._settle(room_id, frame)
+        if frame is not None:
+            return frame
+        # 快照占位: 此刻取最新局面, 之后的消息恢复逐条发送
+        message = self.resync(room_id) if self.resync is not None else None
+        return None if message is None else protocol.encode(message, self.binary)
+
+
+class Fanout:
+    """按连接管理发送队列, 负责单播和广播"""
+
+    def __init__(self, maxsize=OUTBOX_SIZE, policy=DISCONNECT, resync=None):
+        self.maxsize = maxsize
+        self.policy = policy
+        self.resync = resync  # 慢观众跳过消息后, 用它取房间的最新快照
+        self.outboxes = {}
+
+    def open(self, client_id, websocket, binary=False):
+        outbox = Outbox(websocket, self.maxsize, self.policy, binary, self.resync)
+        self.outboxes[client_id] = outbox
+        return outbox
+
+    def close(self, client_id):
+        outbox = self.outboxes.pop(client_id, None)
+        if outbox is not None:
+            outbox.task.cancel()
+
+    def send(self, client_id, message):
+        outbox = self.outboxes.get(client_id)
+        if outbox is not None:
+            outbox.put(protocol.encode(message, outbox.binary))
+
+    def publish(self, client_ids, message, exclude=None):
+        """每种协议编码一次, 放入每个接收者的队列"""
+        frames = [None, None]  # 下标 0 为 JSON, 1 为二进制
+        outboxes = self.outboxes
+        for client_id in client_ids:
+            if client_id == exclude:
+                continue
+            outbox = outboxes.get(client_id)
+            if outbox is None:
+                continue
+            binary = outbox.binary
+            frame = frames[binary]
+            if frame is None:
+                frame = frames[binary] = protocol.encode(message, binary)
+            outbox.put(frame)
+
+    def watch(self, client_ids, room_id, message):
+        """向观众广播, 与 publish 一样每种协议只编码一次"""
+        frames = [None, None]
+        outboxes = self.outboxes
+        for client_id in client_ids:
+            outbox = outboxes.get(client_id)
+            if outbox is None:
+                continue
+            binary = outbox.binary
+            frame = frames[binary]
+            if frame is None:
+                frame = frames[binary] = protocol.encode(message, binary)
+            outbox.put_watch(room_id, frame)
@@ -0,0 +1,435 @@
+"""连接网关
+
+网关是可选的前置进程: 客户端的 websocket 连到网关, 由网关负责握手、
+permessage-deflate 压缩和心跳, 再把每个客户端的消息加上连接号
+转发到游戏服务器。网关与游戏服务器之间只有少数几条上游连接 (子协议
+gobang.gw1, 不压缩), 所有客户端多路复用在这几条连接上, 游戏服务器只处理
+对局逻辑, 连接数可以靠增加网关进程扩展。
+
+上游连接上的每条 websocket 消息包含一个或多个帧:
+类型 (1 字节)、连接号 (4 字节)、负载长度 (4 字节)、负载。
+- OPEN: 新客户端, 负载 1 字节, 最低位表示使用二进制协议;
+- DATA: 客户端消息或发给客户端的消息, 负载原样转发, 不重新编码;
+- CLOSE: 网关发出表示客户端已断开, 服务器发出表示要关闭该客户端,
+  负载为关闭码 (2 字节) 和原因。
+写协程发送期间产生的帧合并到下一条消息中, 负载高时一条消息带很多帧。
+
+上游连接需要游戏服务器以相同的 --gateway-key 启动, 网关在握手时带上
+这个密钥, 否则任何客户端都可以冒充网关。
+
+    python server.py --gateway-key SECRET
+    python gateway.py --port 8000 --upstream ws://localhost:8765 --links 4 --gateway-key SECRET
+"""
+import argparse
+import asyncio
+import os
+import signal
+import struct
+from collections import deque
+from http import HTTPStatus
+
+import websockets
+
+import log
+import protocol
+from fanout import Outbox, OUTBOX_SIZE
+from heartbeat import Heartbeat
+from metrics import Metrics
+from timerwheel import TimerWheel
+
+LINKS = 4                   # 默认上游连接数
+BATCH_BYTES = 256 * 1024    # 一条上游消息合并的帧达到这么多字节后另起一条
+MAX_PENDING = 16            # 积压这么多条整批消息时, 发送方等待写出
+CLIENT_MAX_BYTES = 65536    # 客户端单条消息的上限, 更长的直接断开
+RECONNECT_MIN = 0.5         # 上游断开后的重连间隔, 单位秒, 逐次加倍
+RECONNECT_MAX = 10.0
+KEY_HEADER = 'X-Gobang-Gateway-Key'
+KEY_ENV = 'GOBANG_GATEWAY_KEY'
+
+OPEN = 1
+DATA = 2
+CLOSE = 3
+
+FLAG_BINARY = 0x01
+
+_FRAME = struct.Struct('>BII')  # 类型, 连接号, 负载长度
+_CODE = struct.Struct('>H')
+
+
+def frames(message):
+    """解析一条上游消息, 逐个产出 (类型, 连接号, 负载)"""
+    pos = 0
+    end = len(message)
+    while pos < end:
+        kind, conn_id, length = _FRAME.unpack_from(message, pos)
+        pos += _FRAME.size
+        yield kind, conn_id, message[pos:pos + length]
+        pos += length
+
+
+def close_payload(code, reason=''):
+    return _CODE.pack(code) + reason.encode('utf-8')
+
+
+def parse_close(payload):
+    if len(payload) < _CODE.size:
+        return 1000, ''
+    (code,) = _CODE.unpack_from(payload, 0)
+    return code, payload[_CODE.size:].decode('utf-8', 'replace')
+
+
+def select_subprotocol(connection, subprotocols):
+    """网关公共端口的协商: 只接受二进制子协议, 客户端不能在网关上再开上游连接"""
+    if protocol.BINARY_SUBPROTOCOL in subprotocols:
+        return protocol.BINARY_SUBPROTOCOL
+    return None
+
+
+class Writer:
+    """上游连接的写端: 帧先追加到缓冲区, 由写协程合并发送"""
+
+    __slots__ = ('websocket', 'buffer', 'full', 'ready', 'drained', 'closed', 'task')
+
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self.buffer = bytearray()
+        self.full = deque()          # 已满 BATCH_BYTES、等待发送的批
+        self.ready = asyncio.Event()
+        self.drained = asyncio.Event()
+        self.closed = False
+        self.task = asyncio.create_task(self._run())
+
+    def send(self, kind, conn_id, payload=b''):
+        """追加一帧, 从不等待"""
+        if self.closed:
+            return
+        if len(self.buffer) >= BATCH_BYTES:
+            self.full.append(self.buffer)
+            self.buffer = bytearray()
+        self.buffer += _FRAME.pack(kind, conn_id, len(payload))
+        self.buffer += payload
+        self.ready.set()
+
+    @property
+    def congested(self):
+        return len(self.full) >= MAX_PENDING
+
+    async def drain(self):
+        """积压过多时等待写出, 把上游的背压传给发送方"""
+        while self.congested and not self.closed:
+            self.drained.clear()
+            await self.drained.wait()
+
+    def close(self):
+        self.closed = True
+        self.task.cancel()
+        self.drained.set()
+
+    async def _run(self):
+        websocket = self.websocket
+        try:
+            while True:
+                if self.full:
+                    data = self.full.popleft()
+                elif self.buffer:
+                    data, self.buffer = self.buffer, bytearray()
+                else:
+                    self.ready.clear()
+                    await self.ready.wait()
+                    continue
+                await websocket.send(data)
+                if not self.congested:
+                    self.drained.set()
+        except asyncio.CancelledError:
+            pass
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            self.closed = True
+            self.drained.set()
+
+
+class VirtualSocket:
+    """游戏服务器一侧由网关转发的客户端连接, 提供 GameServer 用到的 websocket 接口"""
+
+    __slots__ = ('writer', 'id', 'subprotocol', 'queue', 'closed')
+
+    def __init__(self, writer, conn_id, binary):
+        self.writer = writer
+        self.id = conn_id
+        self.subprotocol = protocol.BINARY_SUBPROTOCOL if binary else None
+        self.queue = asyncio.Queue()
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        message = await self.queue.get()
+        if message is None:
+            raise StopAsyncIteration
+        return message
+
+    def feed(self, message):
+        self.queue.put_nowait(message)
+
+    def end(self):
+        """网关报告客户端已断开, 或上游连接断开"""
+        self.closed = True
+        self.queue.put_nowait(None)
+
+    async def send(self, message, text=False):
+        if self.closed:
+            return
+        writer = self.writer
+        writer.send(DATA, self.id, message)
+        if writer.congested:
+            await writer.drain()
+
+    async def close(self, code=1000, reason=''):
+        if not self.closed:
+            self.writer.send(CLOSE, self.id, close_payload(code, reason))
+            self.end()
+
+
+async def serve_link(websocket, handle_connection):
+    """游戏服务器一侧: 按连接号把上游连接上的帧分给各个 VirtualSocket
+
+    每个 OPEN 启动一个 handle_connection(socket, relayed=True), 上游连接
+    断开时其上所有客户端按断线处理。
+    """
+    writer = Writer(websocket)
+    sockets = {}
+    tasks = set()
+    try:
+        async for message in websocket:
+            for kind, conn_id, payload in frames(message):
+                if kind == DATA:
+                    socket = sockets.get(conn_id)
+                    if socket is not None:
+                        socket.feed(payload)
+                elif kind == OPEN:
+                    socket = sockets[conn_id] = VirtualSocket(writer, conn_id, payload[0] & FLAG_BINARY)
+                    task = asyncio.create_task(handle_connection(socket, relayed=True))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                elif kind == CLOSE:
+                    socket = sockets.pop(conn_id, None)
+                    if socket is not None:
+                        socket.end()
+    except websockets.exceptions.ConnectionClosed:
+        pass
+    finally:
+        for socket in sockets.values():
+            socket.end()
+        writer.close()
+
+
+class Client:
+    """网关上的一个客户端连接"""
+
+    __slots__ = ('id', 'websocket', 'outbox', 'link')
+
+    def __init__(self, id, websocket, outbox, link):
+        self.id = id
+        self.websocket = websocket
+        self.outbox = outbox
+        self.link = link
+
+
+class Link:
+    """网关到游戏服务器的一条上游连接, 断开后自动重连"""
+
+    __slots__ = ('index', 'writer', 'clients', 'task')
+
+    def __init__(self, index):
+        self.index = index
+        self.writer = None     # 连接建立后才有
+        self.clients = set()   # 固定在这条连接上的客户端连接号
+        self.task = None
+
+
+class Gateway:
+    def __init__(self, upstream, key, links=LINKS, outbox_size=OUTBOX_SIZE):
+        self.upstream = upstream
+        self.key = key
+        self.links = [Link(i) for i in range(links)]
+        self.outbox_size = outbox_size
+        self.clients = {}
+        self.next_id = 0
+        self.wheel = TimerWheel()
+        # 网关不解析消息, 不知道客户端是否在座或观战, 只做心跳不做空闲回收
+        self.heartbeat = Heartbeat(self.wheel, on_reap=self.on_reap, idle_timeout=0)
+        self.setup_metrics()
+
+    def setup_metrics(self):
+        metrics = self.metrics = Metrics()
+        metrics.gauge('gateway_connections', '网关上的客户端连接数', lambda: len(self.clients))
+        metrics.gauge('gateway_links_up', '已连接的上游连接数',
+                      lambda: sum(1 for link in self.links if link.writer is not None))
+        self.relayed = metrics.counter('gateway_messages_total', '转发的消息数', 'direction')
+        self.link_failures = metrics.counter('gateway_link_failures_total', '上游连接断开或连接失败的次数')
+        self.reaped = metrics.counter('reaped_total', '心跳超时或空闲被关闭的连接数', 'reason')
+        metrics.gauge('timers', '时间轮中的定时器数', lambda: len(self.wheel))
+        metrics.gauge('outbox_dropped', '当前连接的发送队列溢出次数',
+                      lambda: sum(client.outbox.dropped for client in self.clients.values()))
+
+    def process_request(self, connection, request):
+        """GET /metrics 返回网关的指标"""
+        if request.path == '/metrics':
+            return connection.respond(HTTPStatus.OK, self.metrics.render())
+        return None
+
+    def start(self):
+        self.metrics.start_lag_monitor()
+        self.wheel.start()
+        for link in self.links:
+            link.task = asyncio.create_task(self.maintain(link))
+
+    def on_reap(self, client_id, reason):
+        self.reaped.inc(reason)
+
+    def pick_link(self):
+        """已连接的上游中客户端最少的一条, 都未连接时返回 None"""
+        live = [link for link in self.links if link.writer is not None]
+        return min(live, key=lambda link: len(link.clients), default=None)
+
+    async def maintain(self, link):
+        """保持一条上游连接, 断开时关闭其上的客户端并重连"""
+        delay = RECONNECT_MIN
+        while True:
+            try:
+                async with websockets.connect(
+                    self.upstream,
+                    subprotocols=[protocol.GATEWAY_SUBPROTOCOL],
+                    additional_headers={KEY_HEADER: self.key},
+                    compression=None,   # 压缩只在网关与客户端之间做
+                    max_size=None,
+                ) as websocket:
+                    if websocket.subprotocol != protocol.GATEWAY_SUBPROTOCOL:
+                        raise websockets.exceptions.InvalidHandshake('upstream does not accept gateways')
+                    link.writer = Writer(websocket)
+                    delay = RECONNECT_MIN
+                    log.info('link_up', link=link.index, uri=self.upstream)
+                    try:
+                        await self.relay(websocket)
+                    finally:
+                        link.writer.close()
+                        link.writer = None
+                        self.drop_clients(link)
+                log.warning('link_closed', link=link.index)
+            except asyncio.CancelledError:
+                raise
+            except (OSError, websockets.exceptions.WebSocketException) as e:
+                log.warning('link_failed', link=link.index, error=e)
+            self.link_failures.inc()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX)
+
+    async def relay(self, websocket):
+        """把上游发来的帧转给对应的客户端"""
+        clients = self.clients
+        count = 0
+        async for message in websocket:
+            for kind, conn_id, payload in frames(message):
+                client = clients.get(conn_id)
+                if client is None:
+                    continue  # 客户端已断开
+                if kind == DATA:
+                    client.outbox.put(payload)
+                    count += 1
+                elif kind == CLOSE:
+                    self.disconnect(client, *parse_close(payload))
+            self.relayed.inc('down', count)
+            count = 0
+
+    def disconnect(self, client, code, reason):
+        client.outbox.task.cancel()
+        asyncio.ensure_future(client.websocket.close(code, reason))
+
+    def drop_clients(self, link):
+        """上游断开: 关闭其上的客户端, 它们重连后凭令牌恢复座位"""
+        for conn_id in list(link.clients):
+            client = self.clients.get(conn_id)
+            if client is not None:
+                self.disconnect(client, 1012, 'upstream restart')
+        link.clients.clear()
+
+    async def handle_client(self, websocket):
+        link = self.pick_link()
+        if link is None:
+            await websocket.close(1013, 'upstream unavailable')
+            return
+        self.next_id = conn_id = (self.next_id + 1) & 0xFFFFFFFF
+        binary = websocket.subprotocol == protocol.BINARY_SUBPROTOCOL
+        client = self.clients[conn_id] = Client(
+            conn_id, websocket, Outbox(websocket, self.outbox_size, binary=binary), link)
+        link.clients.add(conn_id)
+        liveness = self.heartbeat.open(conn_id, websocket)
+        writer = link.writer
+        writer.send(OPEN, conn_id, bytes((FLAG_BINARY if binary else 0,)))
+        wheel = self.wheel
+        relayed = self.relayed
+        try:
+            while True:
+                # 不解码文本帧, 字节原样转发
+                message = await websocket.recv(decode=False)
+                liveness.touch(wheel.now)
+                writer.send(DATA, conn_id, message)
+                relayed.inc('up')
+                if writer.congested:
+                    await writer.drain()
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            self.heartbeat.close(conn_id)
+            client.outbox.task.cancel()
+            del self.clients[conn_id]
+            link.clients.discard(conn_id)
+            writer.send(CLOSE, conn_id, close_payload(1000))
+
+
+async def main(host, port, upstream, key, links=LINKS):
+    gateway = Gateway(upstream, key, links)
+    async with websockets.serve(
+        gateway.handle_client,
+        host,
+        port,
+        ping_timeout=None,  # 心跳由 Gateway.heartbeat 统一调度
+        ping_interval=None,
+        compression='deflate',
+        max_size=CLIENT_MAX_BYTES,
+        select_subprotocol=select_subprotocol,
+        process_request=gateway.process_request,
+    ):
+        log.info('gateway_started', uri=f"ws://{host}:{port}", upstream=upstream, links=links)
+        gateway.start()
+        stopped = asyncio.get_running_loop().create_future()
+        try:
+            asyncio.get_running_loop().add_signal_handler(
+                signal.SIGTERM, lambda: stopped.done() or stopped.set_result(None))
+        except NotImplementedError:
+            pass  # Windows 不支持
+        await stopped
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='五子棋连接网关')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--upstream', default='ws://localhost:8765', help='游戏服务器地址')
+    parser.add_argument('--links', type=int, default=LINKS, help='到游戏服务器的上游连接数')
+    parser.add_argument('--gateway-key', default=os.environ.get(KEY_ENV),
+                        help=f'与游戏服务器 --gateway-key 相同的密钥, 默认取环境变量 {KEY_ENV}')
+    parser.add_argument('--log-level', default=None, choices=sorted(log.LEVELS), help='日志级别, 默认 INFO')
+    parser.add_argument('--log-format', default=None, choices=['text', 'json'], help='日志格式')
+    args = parser.parse_args()
+    if not args.gateway_key:
+        parser.error('需要 --gateway-key 或环境变量 ' + KEY_ENV)
+    if args.links < 1:
+        parser.error('--links 至少为 1')
+    log.configure(args.log_level, args.log_format)
+    try:
+        asyncio.run(main(args.host, args.port, args.upstream, args.gateway_key, args.links))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,106 @@
+"""连接心跳与空闲回收
+
+每个连接在时间轮上只有一个定时器。收到消息只更新时间戳, 不动定时器;
+定时器到期时再看时间戳: 最近有数据就按剩余时间重新挂上, 否则发 ping,
+ping 超时没有回应就直接断开底层连接 (半开的 TCP 连接等不到关闭握手),
+长时间没有任何请求的连接正常关闭; 在座的玩家和观众只是在等待, 不发请求
+也不算空闲, 由调用方通过 busy 回调告知。
+"""
+import asyncio
+
+import log
+
+HEARTBEAT_INTERVAL = 20.0  # 这么久没有收到数据就发送 ping
+PING_TIMEOUT = 10.0        # ping 之后这么久没有回应视为死连接
+IDLE_TIMEOUT = 1800.0      # 不在房间里的连接这么久没有任何请求就关闭
+
+REAP_TIMEOUT = 'timeout'
+REAP_IDLE = 'idle'
+
+
+class Liveness:
+    """单个连接的心跳状态"""
+
+    __slots__ = ('client_id', 'websocket', 'last_seen', 'last_message', 'ping_sent', 'pong', 'closed')
+
+    def __init__(self, client_id, websocket, now):
+        self.client_id = client_id
+        self.websocket = websocket
+        self.last_seen = now      # 最近收到数据 (请求或 pong) 的时间
+        self.last_message = now   # 最近收到请求的时间
+        self.ping_sent = None
+        self.pong = None
+        self.closed = False
+
+    def touch(self, now):
+        self.last_seen = now
+        self.last_message = now
+
+
+class Heartbeat:
+    def __init__(self, wheel, interval=HEARTBEAT_INTERVAL, timeout=PING_TIMEOUT,
+                 idle_timeout=IDLE_TIMEOUT, on_reap=None, busy=None):
+        self.wheel = wheel
+        self.interval = interval
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.on_reap = on_reap  # on_reap(client_id, reason)
+        self.busy = busy        # busy(client_id) 为真时连接不会因空闲被关闭
+        self.connections = {}
+
+    def open(self, client_id, websocket):
+        """开始跟踪连接, 返回 Liveness, 收到消息时调用它的 touch(wheel.now)"""
+        liveness = self.connections[client_id] = Liveness(client_id, websocket, self.wheel.now)
+        self.wheel.schedule(self.interval, self._check, liveness)
+        return liveness
+
+    def close(self, client_id):
+        liveness = self.connections.pop(client_id, None)
+        if liveness is not None:
+            liveness.closed = True  # 定时器到期时直接丢弃
+
+    def _check(self, liveness):
+        if liveness.closed:
+            return
+        now = self.wheel.now
+        if self.idle_timeout and now - liveness.last_message >= self.idle_timeout:
+            if self.busy is None or not self.busy(liveness.client_id):
+                self._reap(liveness, REAP_IDLE)
+                return
+            liveness.last_message = now  # 仍在房间里, 重新开始计算空闲时间
+
+        if liveness.ping_sent is not None:
+            pong = liveness.pong
+            if pong is not None and pong.done():
+                liveness.last_seen = max(liveness.last_seen, liveness.ping_sent)
+            elif liveness.last_seen <= liveness.ping_sent:
+                self._reap(liveness, REAP_TIMEOUT)
+                return
+            liveness.ping_sent = None
+            liveness.pong = None
+
+        quiet = now - liveness.last_seen
+        if quiet < self.interval:
+            self.wheel.schedule(self.interval - quiet, self._check, liveness)
+            return
+        liveness.ping_sent = now
+        asyncio.ensure_future(self._ping(liveness))
+        self.wheel.schedule(self.timeout, self._check, liveness)
+
+    @staticmethod
+    async def _ping(liveness):
+        try:
+            liveness.pong = await liveness.websocket.ping()
+        except Exception:
+            pass  # 连接已关闭, 由连接处理协程清理
+
+    def _reap(self, liveness, reason):
+        self.close(liveness.client_id)
+        log.info('reaped', client=liveness.client_id, reason=reason)
+        if self.on_reap is not None:
+            self.on_reap(liveness.client_id, reason)
+        websocket = liveness.websocket
+        if reason == REAP_IDLE:
+            asyncio.ensure_future(websocket.close(1001, 'idle timeout'))
+        else:
+            websocket.transport.abort()
@@ -0,0 +1,280 @@
+"""对局日志
+
+只追加的二进制日志, 记录每一步落子和每局的结束。日志按段存放在一个目录中,
+每段以一条快照记录开头, 快照包含当时所有进行中的对局, 所以重启时只需读取
+最新一段就能恢复房间; 旧的段保留下来, 可以用 replay() 通过 mmap 流式回放。
+
+落子处理只把记录追加到内存缓冲区, 由后台任务定时在单独的线程里批量写入并
+fsync, 一次 fsync 覆盖这段时间内所有房间的落子, 不给 move 处理增加延迟。
+
+每条记录: 长度 (4 字节)、CRC32 (4 字节)、记录体。崩溃时写了一半的尾部记录
+长度或校验不符, 恢复时截掉。
+
+非默认尺寸或规则的对局在第一步落子记录之后跟一条规则记录, 默认的
+15 路自由规则对局不写, 旧日志仍可直接读取。
+"""
+import asyncio
+import mmap
+import os
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import log
+from board import SIZE, FREESTYLE, RULES
+
+FLUSH_INTERVAL = 0.05    # 批量写盘的间隔, 单位秒
+SNAPSHOT_EVERY = 50000   # 写入这么多条记录后换新段并写快照
+SEGMENT_SUFFIX = '.journal'
+
+REC_SNAPSHOT = 1
+REC_MOVE = 2
+REC_END = 3
+REC_RULES = 4
+
+NO_WINNER = 0  # 对局中途结束 (退出、断线、重置)
+
+_HEAD = struct.Struct('>II')    # 记录体长度, CRC32
+_MOVE = struct.Struct('>HBBB')  # seq, x, y, player
+_U8 = struct.Struct('B')
+_U16 = struct.Struct('>H')
+_U32 = struct.Struct('>I')
+
+
+def _pack_room(room_id):
+    raw = room_id.encode('utf-8')
+    return _U8.pack(len(raw)) + raw
+
+
+def _unpack_room(buf, pos):
+    n = buf[pos]
+    return buf[pos + 1:pos + 1 + n].decode('utf-8'), pos + 1 + n
+
+
+def _record(body):
+    return _HEAD.pack(len(body), zlib.crc32(body)) + body
+
+
+def _rules_record(room_id, size, rule):
+    return _record(bytes((REC_RULES,)) + _pack_room(room_id) + bytes((size, RULES.index(rule))))
+
+
+def _snapshot_record(games):
+    """games: 可迭代的 (room_id, moves, size, rule), moves 为 (x, y) 列表
+
+    返回快照记录, 后面跟着非默认对局的规则记录。
+    """
+    games = [game for game in games if game[1]]
+    body = bytearray((REC_SNAPSHOT,))
+    body += _U32.pack(len(games))
+    for room_id, moves, _, _ in games:
+        body += _pack_room(room_id) + _U16.pack(len(moves))
+        for x, y in moves:
+            body += bytes((x, y))
+    out = _record(bytes(body))
+    for room_id, _, size, rule in games:
+        if size != SIZE or rule != FREESTYLE:
+            out += _rules_record(room_id, size, rule)
+    return out
+
+
+def _records(buf):
+    """逐条解析记录体, 产出 (记录体, 该记录结束的偏移), 遇到残缺记录停止"""
+    pos = 0
+    end = len(buf)
+    while pos + _HEAD.size <= end:
+        length, crc = _HEAD.unpack_from(buf, pos)
+        start = pos + _HEAD.size
+        if start + length > end:
+            return
+        body = buf[start:start + length]
+        if zlib.crc32(body) != crc:
+            return
+        pos = start + length
+        yield body, pos
+
+
+def _apply(games, rules, body):
+    """把一条记录应用到进行中的对局表和规则表
+
+    返回结束的对局 (room_id, moves, winner, size, rule) 或 None。
+    """
+    kind = body[0]
+    if kind == REC_SNAPSHOT:
+        games.clear()
+        rules.clear()
+        (count,) = _U32.unpack_from(body, 1)
+        pos = 5
+        for _ in range(count):
+            room_id, pos = _unpack_room(body, pos)
+            (n,) = _U16.unpack_from(body, pos)
+            pos += 2
+            games[room_id] = [(body[pos + 2 * i], body[pos + 2 * i + 1]) for i in range(n)]
+            pos += 2 * n
+    elif kind == REC_MOVE:
+        room_id, pos = _unpack_room(body, 1)
+        seq, x, y, player = _MOVE.unpack_from(body, pos)
+        moves = games.setdefault(room_id, [])
+        if seq == 1:
+            moves.clear()  # 新的一局
+            rules.pop(room_id, None)
+        moves.append((x, y))
+    elif kind == REC_RULES:
+        room_id, pos = _unpack_room(body, 1)
+        rules[room_id] = (body[pos], RULES[body[pos + 1]])
+    elif kind == REC_END:
+        room_id, pos = _unpack_room(body, 1)
+        moves = games.pop(room_id, None)
+        size, rule = rules.pop(room_id, (SIZE, FREESTYLE))
+        if moves:
+            return room_id, moves, body[pos], size, rule
+    return None
+
+
+def segments(path):
+    """目录中的日志段, 按先后顺序"""
+    try:
+        names = os.listdir(path)
+    except FileNotFoundError:
+        return []
+    return sorted(os.path.join(path, name) for name in names if name.endswith(SEGMENT_SUFFIX))
+
+
+def replay(path, with_rules=False):
+    """按时间顺序回放已结束的对局, 产出 (room_id, moves, winner)
+
+    每段用 mmap 只读映射, 逐条解析, 不把整个文件读入内存。
+    winner 为 1 (黑)、2 (白) 或 NO_WINNER。with_rules 为真时产出
+    (room_id, moves, winner, size, rule)。
+    """
+    games = {}
+    rules = {}
+    for segment in segments(path):
+        with open(segment, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                continue
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                # 对 mmap 切片只复制单条记录
+                for body, _ in _records(buf):
+                    finished = _apply(games, rules, body)
+                    if finished is not None:
+                        yield finished if with_rules else finished[:3]
+
+
+class Journal:
+    """对局日志的写入端, 只能在事件循环线程中调用"""
+
+    def __init__(self, path, flush_interval=FLUSH_INTERVAL, snapshot_every=SNAPSHOT_EVERY):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.snapshot_every = snapshot_every
+        self.buffer = bytearray()
+        self.records = 0          # 当前段已追加的记录数
+        self.file = None
+        self.segment = 0
+        self.snapshot_source = None
+        self.recovered_rules = {}  # recover() 得到的非默认对局 room_id -> (size, rule)
+        self._task = None
+        # 单线程保证写入顺序
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='journal')
+
+    def recover(self):
+        """读取最新一段, 截掉残缺的尾部, 返回进行中的对局 {room_id: moves}"""
+        os.makedirs(self.path, exist_ok=True)
+        games = {}
+        self.recovered_rules = {}
+        existing = segments(self.path)
+        if existing:
+            latest = existing[-1]
+            self.segment = int(os.path.basename(latest)[:-len(SEGMENT_SUFFIX)])
+            with open(latest, 'rb') as f:
+                data = f.read()
+            valid = 0
+            for body, valid in _records(data):
+                _apply(games, self.recovered_rules, body)
+            if valid < len(data):
+                log.warning('journal_truncated', segment=latest, bytes=len(data) - valid)
+                with open(latest, 'r+b') as f:
+                    f.truncate(valid)
+        return games
+
+    def start(self, snapshot_source, games=()):
+        """开新段并启动后台写盘任务
+
+        snapshot_source() 返回当前所有进行中的对局 (room_id, moves, size, rule),
+        换段时调用; games 为开新段时写入的初始快照, 通常是恢复后的对局。
+        """
+        self.snapshot_source = snapshot_source
+        self._open_segment(_snapshot_record(games))
+        self._task = asyncio.create_task(self._flusher())
+
+    def move(self, room_id, seq, x, y, player):
+        self.buffer += _record(bytes((REC_MOVE,)) + _pack_room(room_id) + _MOVE.pack(seq, x, y, player))
+        self.records += 1
+
+    def rules(self, room_id, size, rule):
+        """记录非默认对局的尺寸和规则, 在第一步的落子记录之后调用"""
+        self.buffer += _rules_record(room_id, size, rule)
+        self.records += 1
+
+    def end(self, room_id, winner=NO_WINNER):
+        self.buffer += _record(bytes((REC_END,)) + _pack_room(room_id) + _U8.pack(winner))
+        self.records += 1
+
+    async def close(self):
+        """停止后台任务并写出剩余记录"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+        # 取消定时任务不会停下已提交到写盘线程的写入, 关闭文件也交给这个线程,
+        # 排在所有写入 (包括换段) 之后
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self._close_file)
+        self._executor.shutdown()
+
+    def _close_file(self):
+        self.file.close()
+
+    async def flush(self):
+        if not self.buffer:
+            return
+        data = self.buffer
+        self.buffer = bytearray()
+        snapshot = None
+        if self.records >= self.snapshot_every:
+            # 在交换缓冲区的同一时刻取快照, 保证快照与新段的记录衔接
+            snapshot = _snapshot_record(self.snapshot_source())
+            self.records = 0
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self._write, bytes(data), snapshot)
+
+    async def _flusher(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except OSError as e:
+                log.error('journal_write_failed', error=e)
+
+    def _write(self, data, snapshot):
+        self.file.write(data)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        if snapshot is not None:
+            self.file.close()
+            self._open_segment(snapshot)
+
+    def _open_segment(self, snapshot):
+        self.segment += 1
+        name = os.path.join(self.path, f'{self.segment:08d}{SEGMENT_SUFFIX}')
+        self.file = open(name, 'ab')
+        self.file.write(snapshot)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        # 新段的目录项也要落盘, 否则崩溃后可能找不到这一段
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
@@ -0,0 +1,95 @@
+"""大厅房间状态订阅
+
+房间人数变化时只把房间标记为脏, 在一个很短的合并窗口后
+把变化过的房间一次性推送给大厅订阅者。没有变化时不发送任何消息。
+"""
+import asyncio
+
+FLUSH_WINDOW = 0.1  # 合并窗口, 单位秒
+
+
+class Lobby:
+    def __init__(self, rooms, publish, window=FLUSH_WINDOW, on_flush=None):
+        """rooms 为 room_id -> Room 的映射, publish(client_ids, message) 负责发送
+
+        on_flush(changed) 在每次合并推送时调用, 多进程模式下用来把
+        本分片的变化转发给其他分片。
+        """
+        self.rooms = rooms
+        self.publish = publish
+        self.window = window
+        self.on_flush = on_flush
+        self.remote = {}  # 其他分片中有玩家的房间 room_id -> 状态
+        self.subscribers = set()
+        self.explicit = set()  # 通过 subscribe_lobby 显式订阅的连接
+        self.dirty = set()
+        self._flush_handle = None
+
+    @staticmethod
+    def room_status(room):
+        return {'player_count': len(room.players)}
+
+    def snapshot(self):
+        """有玩家的房间的当前状态, 只在订阅时发送一次
+
+        空房间不在快照中, 客户端按 0 人显示。
+        """
+        rooms = dict(self.remote)
+        for room_id, room in self.rooms.items():
+            if room.players:
+                rooms[room_id] = self.room_status(room)
+        return {'action': 'room_status', 'rooms': rooms}
+
+    def subscribe(self, client_id, explicit=False):
+        self.subscribers.add(client_id)
+        if explicit:
+            self.explicit.add(client_id)
+        return self.snapshot()
+
+    def unsubscribe(self, client_id):
+        self.subscribers.discard(client_id)
+        self.explicit.discard(client_id)
+
+    def release(self, client_id):
+        """连接进入对局: 取消默认订阅, 显式订阅的连接继续接收"""
+        if client_id not in self.explicit:
+            self.subscribers.discard(client_id)
+
+    def mark_dirty(self, room_id):
+        self.dirty.add(room_id)
+        if self._flush_handle is None:
+            loop = asyncio.get_running_loop()
+            self._flush_handle = loop.call_later(self.window, self._flush)
+
+    def _flush(self):
+        self._flush_handle = None
+        dirty, self.dirty = self.dirty, set()
+
+        if not self.subscribers and self.on_flush is None:
+            return
+
+        changed = {}
+        for room_id in dirty:
+            room = self.rooms.get(room_id)
+            changed[room_id] = self.room_status(room) if room else {'player_count': 0}
+
+        if self.on_flush is not None:
+            self.on_flush(changed)
+        if self.subscribers:
+            self.publish(self.subscribers, {
+                'action': 'room_status',
+                'rooms': changed
+            })
+
+    def apply_remote(self, changed):
+        """应用其他分片转发来的房间状态变化, 直接推送给订阅者"""
+        for room_id, status in changed.items():
+            if status['player_count']:
+                self.remote[room_id] = status
+            else:
+                self.remote.pop(room_id, None)
+        if self.subscribers:
+            self.publish(self.subscribers, {
+                'action': 'room_status',
+                'rooms': changed
+            })
@@ -0,0 +1,181 @@
+"""结构化日志
+
+用法: import log; log.info('event', key=value, ...)
+
+- 分级: debug / info / warning / error。关闭的级别对应的函数被换成空函数,
+  调用方不拼接字符串, 关闭的级别只剩一次空函数调用。
+- 延迟格式化: 记录以 (时间, 级别, 事件, 字段) 元组放入队列, 由后台线程
+  格式化并写出, 事件循环从不等待标准输出。
+- 队列满时丢弃记录并计数, 不阻塞调用方。
+- Sampler 对高频事件采样, 每 N 次只记录一次。
+- write(text) 把一段文本 (例如定时打印的指标) 原样交给同一个写线程。
+
+必须通过模块属性调用 (log.debug(...)), 不要 from log import debug,
+否则调整级别后拿到的仍是旧函数。
+"""
+import atexit
+import json
+import os
+import queue
+import sys
+import threading
+import time
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVELS = {'DEBUG': DEBUG, 'INFO': INFO, 'WARNING': WARNING, 'ERROR': ERROR}
+_NAMES = {value: name for name, value in LEVELS.items()}
+
+QUEUE_SIZE = 10000
+
+_level = INFO
+_format = 'text'
+_stream = None    # 为 None 时写到当前的 sys.stdout
+_queue = None
+_thread = None
+_pid = None       # 写线程所属的进程, fork 出的子进程需要重新启动
+_lock = threading.Lock()
+dropped = 0       # 因队列满丢弃的记录数
+
+
+def _noop(*args, **fields):
+    pass
+
+
+def _emit(level, event, fields):
+    global dropped
+    q = _queue if _pid == os.getpid() else _start()
+    try:
+        q.put_nowait((time.time(), level, event, fields))
+    except queue.Full:
+        dropped += 1
+
+
+def _debug(event, **fields):
+    _emit(DEBUG, event, fields)
+
+
+def _info(event, **fields):
+    _emit(INFO, event, fields)
+
+
+def _warning(event, **fields):
+    _emit(WARNING, event, fields)
+
+
+def _error(event, **fields):
+    _emit(ERROR, event, fields)
+
+
+debug = _noop
+info = _info
+warning = _warning
+error = _error
+
+
+def write(text):
+    """原样写出一段文本, 不加时间和级别, 不受级别控制"""
+    _emit(None, text, None)
+
+
+def enabled(level):
+    """字段本身计算代价较高时, 先用它判断"""
+    return _level <= level
+
+
+def configure(level=None, fmt=None, stream=None):
+    """设置级别 (数字或名称)、输出格式 ('text' 或 'json') 和输出流"""
+    global _level, _format, _stream, debug, info, warning, error
+    if level is not None:
+        _level = LEVELS[level.upper()] if isinstance(level, str) else level
+        debug = _debug if _level <= DEBUG else _noop
+        info = _info if _level <= INFO else _noop
+        warning = _warning if _level <= WARNING else _noop
+        error = _error if _level <= ERROR else _noop
+    if fmt is not None:
+        _format = fmt
+    if stream is not None:
+        _stream = stream
+
+
+class Sampler:
+    """高频事件采样: 每 every 次记录一次, 记录中带上 sampled=every"""
+
+    __slots__ = ('level', 'event', 'every', 'count')
+
+    def __init__(self, level, event, every):
+        self.level = level
+        self.event = event
+        self.every = every
+        self.count = 0
+
+    def __call__(self, **fields):
+        if _level > self.level:
+            return
+        self.count += 1
+        if self.count >= self.every:
+            self.count = 0
+            fields['sampled'] = self.every
+            _emit(self.level, self.event, fields)
+
+
+def _value(value):
+    text = value if isinstance(value, str) else str(value)
+    if not text or any(c in text for c in ' ="\n'):
+        return json.dumps(text, ensure_ascii=False)
+    return text
+
+
+def _format_record(record):
+    ts, level, event, fields = record
+    if level is None:
+        return event  # write() 的原样文本
+    if _format == 'json':
+        out = {'ts': round(ts, 6), 'level': _NAMES[level], 'event': event}
+        out.update(fields)
+        return json.dumps(out, ensure_ascii=False, default=str)
+    stamp = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(ts)) + f'.{int(ts * 1000) % 1000:03d}'
+    parts = [stamp, _NAMES[level], event]
+    parts.extend(f'{key}={_value(value)}' for key, value in fields.items())
+    return ' '.join(parts)
+
+
+def _writer(q):
+    while True:
+        record = q.get()
+        if record is None:
+            break
+        stream = _stream or sys.stdout
+        try:
+            stream.write(_format_record(record) + '\n')
+            # 队列里还有记录时攒着一起刷出
+            if q.empty():
+                stream.flush()
+        except Exception:
+            pass
+
+
+def _start():
+    global _queue, _thread, _pid
+    with _lock:
+        if _pid != os.getpid():
+            _queue = queue.Queue(QUEUE_SIZE)
+            _thread = threading.Thread(target=_writer, args=(_queue,), name='log-writer', daemon=True)
+            _thread.start()
+            _pid = os.getpid()
+    return _queue
+
+
+@atexit.register
+def flush():
+    """写完队列中的记录, 退出时自动调用"""
+    global _pid
+    if _pid == os.getpid() and _thread.is_alive():
+        _queue.put(None)
+        _thread.join(timeout=2)
+        _pid = None  # 之后再有记录时重新启动写线程
+
+
+configure(os.environ.get('GOBANG_LOG_LEVEL', 'INFO'))
@@ -0,0 +1,139 @@
+"""按等级分匹配
+
+等待的玩家按等级分放入宽度为 BUCKET_WIDTH 的桶, 桶内先到先得。非空桶的
+编号保存在有序列表中, 新玩家用二分查找找到两侧最近的非空桶, 匹配只看
+这几个桶里等得最久的玩家, 时间为 O(log 桶数), 与排队人数无关。
+
+可接受的分差 (窗口) 随等待时间变宽。同一个桶内的分差总在初始窗口以内,
+入队时就会配对, 所以每个桶里通常最多只有一人在等; 定时的 tick() 只需
+检查每个非空桶等得最久的玩家与相邻非空桶, 开销与桶数成正比。
+"""
+import time
+from bisect import bisect_left, insort
+from collections import OrderedDict
+
+DEFAULT_RATING = 1500
+MIN_RATING = 0
+MAX_RATING = 4000
+BUCKET_WIDTH = 50
+BASE_WINDOW = 100   # 刚开始等待时可接受的分差
+WIDEN_RATE = 25     # 每等待一秒窗口变宽的分数
+MAX_WINDOW = 1000
+TICK_INTERVAL = 1.0
+
+
+class Entry:
+    __slots__ = ('client_id', 'rating', 'since', 'bucket')
+
+    def __init__(self, client_id, rating, since, bucket):
+        self.client_id = client_id
+        self.rating = rating
+        self.since = since
+        self.bucket = bucket
+
+
+class Matchmaker:
+    def __init__(self, bucket_width=BUCKET_WIDTH, base_window=BASE_WINDOW,
+                 widen_rate=WIDEN_RATE, max_window=MAX_WINDOW):
+        self.bucket_width = bucket_width
+        self.base_window = base_window
+        self.widen_rate = widen_rate
+        self.max_window = max_window
+        self.waiting = {}   # client_id -> Entry
+        self.buckets = {}   # 桶编号 -> OrderedDict(client_id -> Entry), 先到的在前
+        self.keys = []      # 非空桶编号, 有序
+
+    def __len__(self):
+        return len(self.waiting)
+
+    def __contains__(self, client_id):
+        return client_id in self.waiting
+
+    @staticmethod
+    def clamp(rating):
+        """客户端给出的等级分, 不合法时使用默认值"""
+        if isinstance(rating, bool) or not isinstance(rating, (int, float)):
+            return DEFAULT_RATING
+        return int(min(max(rating, MIN_RATING), MAX_RATING))
+
+    def window(self, entry, now):
+        return min(self.max_window, self.base_window + self.widen_rate * (now - entry.since))
+
+    def enqueue(self, client_id, rating, now=None):
+        """加入队列, 能立即配对时返回对手的 Entry 且两人都不再排队, 否则返回 None"""
+        now = time.monotonic() if now is None else now
+        entry = Entry(client_id, rating, now, rating // self.bucket_width)
+        opponent = self._best(entry, now)
+        if opponent is not None:
+            self._remove(opponent)
+            return opponent
+        self._insert(entry)
+        return None
+
+    def cancel(self, client_id):
+        entry = self.waiting.get(client_id)
+        if entry is None:
+            return False
+        self._remove(entry)
+        return True
+
+    def tick(self, now=None):
+        """按变宽后的窗口重新配对, 返回配成的 (Entry, Entry) 列表, 先到的在前"""
+        now = time.monotonic() if now is None else now
+        pairs = []
+        for key in list(self.keys):
+            bucket = self.buckets.get(key)
+            if not bucket:
+                continue
+            entry = next(iter(bucket.values()))
+            self._remove(entry)
+            opponent = self._best(entry, now)
+            if opponent is None:
+                # 放回原位, 保持等待时间和先后顺序
+                self._restore(entry)
+                continue
+            self._remove(opponent)
+            pairs.append((opponent, entry) if opponent.since <= entry.since else (entry, opponent))
+        return pairs
+
+    def _best(self, entry, now):
+        """两侧最近的非空桶中, 分差在窗口内且最小的玩家"""
+        keys = self.keys
+        i = bisect_left(keys, entry.bucket)
+        candidates = []
+        if i < len(keys):
+            candidates.append(keys[i])
+            if keys[i] == entry.bucket and i + 1 < len(keys):
+                candidates.append(keys[i + 1])
+        if i > 0:
+            candidates.append(keys[i - 1])
+
+        window = self.window(entry, now)
+        best = None
+        best_diff = None
+        for key in candidates:
+            other = next(iter(self.buckets[key].values()))
+            diff = abs(other.rating - entry.rating)
+            if diff <= max(window, self.window(other, now)) and (best is None or diff < best_diff):
+                best, best_diff = other, diff
+        return best
+
+    def _remove(self, entry):
+        del self.waiting[entry.client_id]
+        bucket = self.buckets[entry.bucket]
+        del bucket[entry.client_id]
+        if not bucket:
+            del self.buckets[entry.bucket]
+            del self.keys[bisect_left(self.keys, entry.bucket)]
+
+    def _insert(self, entry):
+        self.waiting[entry.client_id] = entry
+        bucket = self.buckets.get(entry.bucket)
+        if bucket is None:
+            bucket = self.buckets[entry.bucket] = OrderedDict()
+            insort(self.keys, entry.bucket)
+        bucket[entry.client_id] = entry
+        return bucket
+
+    def _restore(self, entry):
+        self._insert(entry).move_to_end(entry.client_id, last=False)
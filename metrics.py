@@ -0,0 +1,145 @@
+"""运行指标
+
+计数器、延迟直方图和按需取值的仪表, 以 Prometheus 文本格式输出。
+服务器在 websocket 端口上响应 GET /metrics, 也可以定时打印到标准输出。
+所有记录操作只是几次整数加法, 可以放在落子路径上。
+"""
+import asyncio
+import time
+from bisect import bisect_left
+
+import log
+
+# 延迟直方图的桶上界, 单位秒
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+LAG_INTERVAL = 0.5  # 事件循环延迟的采样间隔, 单位秒
+PREFIX = 'gobang_'
+
+
+def _labels(label_name, label):
+    return f'{{{label_name}="{label}"}}' if label_name else ''
+
+
+class Counter:
+    """按一个标签分组的计数器"""
+
+    __slots__ = ('name', 'help', 'label_name', 'values')
+
+    def __init__(self, name, help, label_name=None):
+        self.name = PREFIX + name
+        self.help = help
+        self.label_name = label_name
+        self.values = {}
+
+    def inc(self, label=None, amount=1):
+        self.values[label] = self.values.get(label, 0) + amount
+
+    def render(self, out):
+        out.append(f'# HELP {self.name} {self.help}')
+        out.append(f'# TYPE {self.name} counter')
+        for label, value in self.values.items():
+            out.append(f'{self.name}{_labels(self.label_name, label)} {value}')
+
+
+class Histogram:
+    """按一个标签分组的直方图, 桶计数不累加, 输出时再累加"""
+
+    __slots__ = ('name', 'help', 'label_name', 'buckets', 'series')
+
+    def __init__(self, name, help, label_name=None, buckets=BUCKETS):
+        self.name = PREFIX + name
+        self.help = help
+        self.label_name = label_name
+        self.buckets = buckets
+        self.series = {}  # label -> [各桶计数..., 总和, 次数]
+
+    def observe(self, label, value):
+        series = self.series.get(label)
+        if series is None:
+            series = self.series[label] = [0] * (len(self.buckets) + 3)
+        series[bisect_left(self.buckets, value)] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self, out):
+        out.append(f'# HELP {self.name} {self.help}')
+        out.append(f'# TYPE {self.name} histogram')
+        for label, series in self.series.items():
+            prefix = f'{self.label_name}="{label}",' if self.label_name else ''
+            total = 0
+            for bound, count in zip(self.buckets, series):
+                total += count
+                out.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {total}')
+            total += series[len(self.buckets)]
+            out.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {total}')
+            labels = _labels(self.label_name, label)
+            out.append(f'{self.name}_sum{labels} {series[-2]}')
+            out.append(f'{self.name}_count{labels} {series[-1]}')
+
+
+class Gauge:
+    """输出时调用 fn 取当前值"""
+
+    __slots__ = ('name', 'help', 'fn')
+
+    def __init__(self, name, help, fn):
+        self.name = PREFIX + name
+        self.help = help
+        self.fn = fn
+
+    def render(self, out):
+        out.append(f'# HELP {self.name} {self.help}')
+        out.append(f'# TYPE {self.name} gauge')
+        out.append(f'{self.name} {self.fn()}')
+
+
+class Metrics:
+    def __init__(self):
+        self.items = []
+        self.loop_lag = 0.0  # 最近一次采样的事件循环延迟
+        self._lag_task = None
+        self._dump_task = None
+
+    def counter(self, name, help, label_name=None):
+        return self._add(Counter(name, help, label_name))
+
+    def histogram(self, name, help, label_name=None, buckets=BUCKETS):
+        return self._add(Histogram(name, help, label_name, buckets))
+
+    def gauge(self, name, help, fn):
+        return self._add(Gauge(name, help, fn))
+
+    def _add(self, item):
+        self.items.append(item)
+        return item
+
+    def render(self):
+        """Prometheus 文本格式"""
+        out = []
+        for item in self.items:
+            item.render(out)
+        out.append('')
+        return '\n'.join(out)
+
+    def start_lag_monitor(self, interval=LAG_INTERVAL):
+        """定时睡眠, 实际醒来比预期晚多少就是事件循环的延迟"""
+        lag = self.histogram('event_loop_lag_seconds', '事件循环延迟')
+        self.gauge('event_loop_lag_last_seconds', '最近一次采样的事件循环延迟', lambda: self.loop_lag)
+
+        async def monitor():
+            while True:
+                start = time.perf_counter()
+                await asyncio.sleep(interval)
+                self.loop_lag = max(0.0, time.perf_counter() - start - interval)
+                lag.observe(None, self.loop_lag)
+
+        self._lag_task = asyncio.create_task(monitor())
+
+    def start_dump(self, seconds):
+        """定时把全部指标打印到标准输出, 经日志写线程输出, 标准输出慢时不阻塞事件循环"""
+        async def dump():
+            while True:
+                await asyncio.sleep(seconds)
+                log.write(self.render())
+
+        self._dump_task = asyncio.create_task(dump())
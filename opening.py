@@ -0,0 +1,237 @@
+"""开局库
+
+开局库是一张存放在文件里的开放寻址哈希表, 键为局面在棋盘 8 种对称变换下
+的规范哈希, 值为该局面下对局中最好的一手及其局数、胜局数。服务器只读
+mmap 这个文件, 多进程模式下所有工作进程共用操作系统的同一份页缓存, 每个
+进程不额外占用内存; 查找只计算前几手的 8 个哈希再探测几个槽位, 与开局库
+大小无关。
+
+局面哈希是 Zobrist 哈希: 每个 (格子, 颜色) 一个固定的 64 位随机数, 局面的
+哈希为所有棋子对应随机数的异或。对每种对称变换先变换坐标再求哈希, 取最小
+值作为规范哈希, 库中的着法按取到最小值的变换存放, 查找时再变换回来。
+对称的局面 (例如空棋盘) 有多个变换同时取到最小值, 这时着法取这些变换下
+最小的格子下标, 对称的着法 (如空棋盘上的 7,8 和 8,7) 归为同一条。
+
+从对局日志 (server.py --journal) 生成开局库:
+
+    python opening.py build journal -o book.bin
+    python opening.py build journal/shard-0 journal/shard-1 -o book.bin --depth 12 --min-games 5
+    python opening.py show book.bin 7,7 8,8
+"""
+import argparse
+import mmap
+import os
+import random
+import struct
+import sys
+
+from board import SIZE, FREESTYLE, RULES, BLACK, WHITE
+
+DEPTH = 12       # 收录的开局手数
+MIN_GAMES = 3    # 着法至少出现在这么多局中才收录
+MAGIC = b'GBOOK1\x00\x00'
+SEED = 20240901  # Zobrist 随机数的种子, 生成和查找必须一致
+
+_HEADER = struct.Struct('<8sBBBxII')  # 标识, 尺寸, 规则编号, 收录手数, 局面数, 槽位数
+_ENTRY = struct.Struct('<QIII')       # 规范哈希 (0 为空槽), 规范坐标下的着法, 局数, 胜局数
+
+
+def transforms(size):
+    """8 种对称变换下每个格子的新下标, 以及对应的逆变换"""
+    m = size - 1
+    maps = (
+        lambda x, y: (x, y), lambda x, y: (m - x, y), lambda x, y: (x, m - y), lambda x, y: (m - x, m - y),
+        lambda x, y: (y, x), lambda x, y: (m - y, x), lambda x, y: (y, m - x), lambda x, y: (m - y, m - x),
+    )
+    forward = []
+    inverse = []
+    for f in maps:
+        table = [0] * (size * size)
+        back = [0] * (size * size)
+        for idx in range(size * size):
+            x, y = f(idx % size, idx // size)
+            table[idx] = y * size + x
+            back[y * size + x] = idx
+        forward.append(tuple(table))
+        inverse.append(tuple(back))
+    return forward, inverse
+
+
+def zobrist(size):
+    """每个 (格子, 颜色) 的随机数, 下标为 格子 * 2 + 颜色 - 1"""
+    rng = random.Random(SEED + size)
+    return tuple(rng.getrandbits(64) for _ in range(size * size * 2))
+
+
+class Hasher:
+    """某个尺寸的规范哈希"""
+
+    def __init__(self, size):
+        self.size = size
+        self.forward, self.inverse = transforms(size)
+        self.keys = zobrist(size)
+
+    def canonical(self, cells):
+        """cells 为按落子顺序的格子下标, 返回 (规范哈希, 取到它的所有变换编号)"""
+        keys = self.keys
+        best = None
+        syms = []
+        for sym, table in enumerate(self.forward):
+            h = 0
+            color = 0
+            for cell in cells:
+                h ^= keys[table[cell] * 2 + color]
+                color ^= 1
+            if best is None or h < best:
+                best = h
+                syms = [sym]
+            elif h == best:
+                syms.append(sym)
+        return best or 1, syms  # 0 表示空槽
+
+    def canonical_move(self, syms, cell):
+        """着法在规范坐标下的格子下标: 取到规范哈希的各变换下最小的一个"""
+        forward = self.forward
+        return min(forward[sym][cell] for sym in syms)
+
+
+class OpeningBook:
+    """只读的开局库, 文件以 mmap 映射, 不读入内存"""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.size, rule, self.depth, self.count, self.slots = _HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or self.slots & (self.slots - 1):
+            self._mmap.close()
+            raise ValueError(f'{path} 不是开局库文件')
+        if len(self._mmap) < _HEADER.size + self.slots * _ENTRY.size:
+            self._mmap.close()
+            raise ValueError(f'{path} 不完整')
+        self.rule = RULES[rule]
+        self.hasher = Hasher(self.size)
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self._mmap.close()
+
+    def _probe(self, key):
+        mask = self.slots - 1
+        buf = self._mmap
+        slot = key & mask
+        while True:
+            entry = _ENTRY.unpack_from(buf, _HEADER.size + slot * _ENTRY.size)
+            if entry[0] == key:
+                return entry
+            if entry[0] == 0:
+                return None
+            slot = (slot + 1) & mask
+
+    def lookup(self, moves):
+        """moves 为 (x, y) 落子序列, 返回库中的下一手 (x, y, 局数, 胜局数), 不在库中时返回 None"""
+        if len(moves) >= self.depth:
+            return None
+        size = self.size
+        cells = [y * size + x for x, y in moves]
+        key, syms = self.hasher.canonical(cells)
+        entry = self._probe(key)
+        if entry is None:
+            return None
+        _, move, games, wins = entry
+        # 取到规范哈希的变换把局面变成同一个规范局面, 用其中任一个变换回来都行
+        cell = self.hasher.inverse[syms[0]][move]
+        return cell % size, cell // size, games, wins
+
+
+def build(games, size=SIZE, rule=FREESTYLE, depth=DEPTH, min_games=MIN_GAMES):
+    """统计对局的前 depth 手, 返回 {规范哈希: (规范着法, 局数, 胜局数)}
+
+    games 产出 (moves, winner); 每个局面收录对落子方胜率最高的一手,
+    胜率按 (胜局 + 1) / (局数 + 2) 估计, 少于 min_games 局的着法不收录。
+    """
+    hasher = Hasher(size)
+    stats = {}  # (规范哈希, 规范着法) -> [局数, 胜局数]
+    for moves, winner in games:
+        cells = []
+        for ply, (x, y) in enumerate(moves[:depth]):
+            key, syms = hasher.canonical(cells)
+            cell = y * size + x
+            entry = stats.setdefault((key, hasher.canonical_move(syms, cell)), [0, 0])
+            entry[0] += 1
+            if winner == (BLACK if ply % 2 == 0 else WHITE):
+                entry[1] += 1
+            cells.append(cell)
+    book = {}
+    for (key, move), (count, wins) in stats.items():
+        if count < min_games:
+            continue
+        best = book.get(key)
+        if best is None or (wins + 1) / (count + 2) > (best[2] + 1) / (best[1] + 2):
+            book[key] = (move, count, wins)
+    return book
+
+
+def write(path, book, size=SIZE, rule=FREESTYLE, depth=DEPTH):
+    """把 build() 的结果写成开局库文件, 负载不超过一半"""
+    slots = 1
+    while slots < len(book) * 2:
+        slots *= 2
+    mask = slots - 1
+    table = bytearray(slots * _ENTRY.size)
+    used = bytearray(slots)
+    for key, (move, count, wins) in book.items():
+        slot = key & mask
+        while used[slot]:
+            slot = (slot + 1) & mask
+        used[slot] = 1
+        _ENTRY.pack_into(table, slot * _ENTRY.size, key, move, count, wins)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, size, RULES.index(rule), depth, len(book), slots))
+        f.write(table)
+    # 替换而不是覆盖, 正在使用旧文件的进程不受影响
+    os.replace(tmp, path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='五子棋开局库')
+    commands = parser.add_subparsers(dest='command', required=True)
+    p = commands.add_parser('build', help='从对局日志生成开局库')
+    p.add_argument('paths', nargs='+', metavar='DIR', help='对局日志目录')
+    p.add_argument('-o', '--output', required=True, help='开局库文件')
+    p.add_argument('--size', type=int, default=SIZE, help='只收录这个尺寸的对局')
+    p.add_argument('--rule', default=FREESTYLE, choices=RULES, help='只收录这个规则的对局')
+    p.add_argument('--depth', type=int, default=DEPTH, help='收录的开局手数')
+    p.add_argument('--min-games', type=int, default=MIN_GAMES, help='着法至少出现的局数')
+    p = commands.add_parser('show', help='查询局面在开局库中的下一手')
+    p.add_argument('book', help='开局库文件')
+    p.add_argument('moves', nargs='*', metavar='X,Y', help='落子序列')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        from journal import replay
+
+        def games():
+            for path in args.paths:
+                for _, moves, winner, size, rule in replay(path, with_rules=True):
+                    if size == args.size and rule == args.rule:
+                        yield moves, winner
+
+        book = build(games(), args.size, args.rule, args.depth, args.min_games)
+        write(args.output, book, args.size, args.rule, args.depth)
+        print(f'{len(book)} 个局面写入 {args.output}')
+    else:
+        book = OpeningBook(args.book)
+        moves = [tuple(int(v) for v in move.split(',')) for move in args.moves]
+        hit = book.lookup(moves)
+        if hit is None:
+            print('不在开局库中')
+            sys.exit(1)
+        x, y, games, wins = hit
+        print(f'{x},{y}  {games} 局, 落子方胜 {wins} 局')
+
+
+if __name__ == '__main__':
+    main()
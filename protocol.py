@@ -0,0 +1,385 @@
+"""二进制消息协议
+
+连接时通过 websocket 子协议协商: 客户端提供 BINARY_SUBPROTOCOL 且服务器
+接受时, 双方改用二进制帧; 否则沿用原来的 JSON 文本帧, 旧客户端不受影响。
+
+二进制帧第一个字节是操作码, 常用消息使用紧凑格式:
+- 落子请求 5 字节左右: 操作码、房间号、x、y
+- 落子广播带序号 (本局第几手), 棋盘按每格 2 位打包
+- 计时状态 (三个毫秒数) 按 3 个 u32 附在落子广播和棋盘状态后面
+其他消息, 或带有紧凑格式不认识的字段的消息, 使用 OP_JSON 原样携带 JSON。
+
+房间的棋盘状态以 GameState 放入消息, 其中的 Snapshot 按房间版本缓存,
+两种协议的编码结果各只计算一次, 之后拼接进每条消息, 不再逐条序列化。
+"""
+import json
+import struct
+
+from board import RULES
+
+BINARY_SUBPROTOCOL = 'gobang.bin1'
+GATEWAY_SUBPROTOCOL = 'gobang.gw1'  # 网关的上游连接, 帧格式见 gateway.py
+
+OP_JSON = 0x00
+OP_MOVE_REQ = 0x01
+OP_MOVE = 0x02
+OP_MOVE_FAILED = 0x03
+OP_ROOM_STATUS = 0x04
+OP_GAME_START = 0x05
+OP_GAME_STATE = 0x06
+OP_JOIN_SUCCESS = 0x07
+OP_GAME_OVER = 0x08
+OP_PLAYER_DISCONNECTED = 0x09
+OP_MOVE_CLOCK = 0x0A  # 带计时状态的落子广播
+
+MOVE_FAILED_REASONS = (
+    'room_not_found',
+    'game_not_started',
+    'waiting_for_player',
+    'not_in_room',
+    'not_your_turn',
+    'invalid_position',
+    'position_occupied',
+    'rate_limited',
+    'forbidden',
+)
+_REASON_CODES = {reason: i for i, reason in enumerate(MOVE_FAILED_REASONS)}
+
+WINNERS = ('黑棋', '白棋')
+
+NO_MOVE = 0xFF
+HAS_CLOCK = 0x80    # 棋盘状态中当前玩家字节的标志位
+HAS_VERSION = 0x40
+HAS_RULE = 0x20     # 后面带一个字节的规则编号, 即 board.RULES 中的下标
+_FLAGS = HAS_CLOCK | HAS_VERSION | HAS_RULE
+
+_U8 = struct.Struct('B')
+_U16 = struct.Struct('>H')
+_MOVE = struct.Struct('>HBBB')     # seq, x, y, player
+_CELL = struct.Struct('BB')        # x, y
+_CLOCK = struct.Struct('>III')     # 黑方剩余、白方剩余、当前一步剩余, 毫秒
+_U32 = struct.Struct('>I')
+
+
+class Unsupported(Exception):
+    """消息不能用紧凑格式表示"""
+
+
+def _keys_ok(message, required, optional=()):
+    keys = message.keys()
+    return all(k in keys for k in required) and len(keys) <= len(required) + sum(k in keys for k in optional)
+
+
+def _pack_room(room_id):
+    if room_id is None:
+        return b'\x00'
+    raw = room_id.encode('utf-8')
+    if len(raw) > 255:
+        raise Unsupported
+    return _U8.pack(len(raw)) + raw
+
+
+def _unpack_room(buf, pos):
+    n = buf[pos]
+    pos += 1
+    if n == 0:
+        return None, pos
+    return buf[pos:pos + n].decode('utf-8'), pos + n
+
+
+def _pack_state(state):
+    """game_state -> 尺寸、当前玩家、最后一步、可选的计时、版本和规则、每格 2 位的棋盘"""
+    if type(state) is GameState:
+        return state.packed()
+    if not _keys_ok(state, ('board', 'current_player', 'last_move'), ('clock', 'version', 'rule')):
+        raise Unsupported
+    rows = state['board']
+    size = len(rows)
+    last = state['last_move']
+    clock = state.get('clock')
+    version = state.get('version')
+    rule = state.get('rule')
+    if rule is not None and rule not in RULES:
+        raise Unsupported
+    flags = ((HAS_CLOCK if clock else 0) | (HAS_VERSION if version is not None else 0)
+             | (HAS_RULE if rule is not None else 0))
+    out = bytearray((size, state['current_player'] | flags))
+    out += _CELL.pack(*last) if last else bytes((NO_MOVE, NO_MOVE))
+    if clock:
+        out += _CLOCK.pack(*clock)
+    if version is not None:
+        out += _U32.pack(version)
+    if rule is not None:
+        out.append(RULES.index(rule))
+    packed = bytearray((size * size + 3) // 4)
+    i = 0
+    for row in rows:
+        for v in row:
+            if v:
+                packed[i >> 2] |= v << ((i & 3) << 1)
+            i += 1
+    return bytes(out + packed)
+
+
+def _unpack_state(buf, pos):
+    size, current = buf[pos], buf[pos + 1]
+    lx, ly = buf[pos + 2], buf[pos + 3]
+    pos += 4
+    clock = version = rule = None
+    if current & HAS_CLOCK:
+        clock = list(_CLOCK.unpack_from(buf, pos))
+        pos += _CLOCK.size
+    if current & HAS_VERSION:
+        (version,) = _U32.unpack_from(buf, pos)
+        pos += _U32.size
+    if current & HAS_RULE:
+        rule = RULES[buf[pos]]
+        pos += 1
+    current &= ~_FLAGS
+    rows = []
+    i = 0
+    for _ in range(size):
+        row = []
+        for _ in range(size):
+            row.append((buf[pos + (i >> 2)] >> ((i & 3) << 1)) & 3)
+            i += 1
+        rows.append(row)
+    pos += (size * size + 3) // 4
+    state = {
+        'board': rows,
+        'current_player': current,
+        'last_move': None if lx == NO_MOVE else [lx, ly]
+    }
+    if clock is not None:
+        state['clock'] = clock
+    if version is not None:
+        state['version'] = version
+    if rule is not None:
+        state['rule'] = rule
+    return state, pos
+
+
+class Snapshot:
+    """房间某个版本的棋盘状态, 两种协议的编码各在第一次用到时计算一次"""
+
+    __slots__ = ('version', 'state', '_json', '_packed')
+
+    def __init__(self, version, state):
+        self.version = version
+        self.state = state  # 含 version, 不含计时
+        self._json = None
+        self._packed = None
+
+    def json(self):
+        """不带结尾 '}' 的 JSON, 便于追加计时"""
+        if self._json is None:
+            self._json = json.dumps(self.state)[:-1]
+        return self._json
+
+    def packed(self):
+        if self._packed is None:
+            self._packed = _pack_state(self.state)
+        return self._packed
+
+
+class GameState:
+    """放入消息的棋盘状态: 缓存的快照加上发送时刻的计时"""
+
+    __slots__ = ('snapshot', 'clock')
+
+    def __init__(self, snapshot, clock=None):
+        self.snapshot = snapshot
+        self.clock = clock
+
+    def json(self):
+        body = self.snapshot.json()
+        if self.clock:
+            return f'{body}, "clock": {json.dumps(self.clock)}}}'
+        return body + '}'
+
+    def packed(self):
+        packed = self.snapshot.packed()
+        if not self.clock:
+            return packed
+        # 计时紧跟在 4 字节的头部之后
+        return (packed[:1] + bytes((packed[1] | HAS_CLOCK,)) + packed[2:4]
+                + _CLOCK.pack(*self.clock) + packed[4:])
+
+
+def _dumps(message):
+    """json.dumps, 消息中的 GameState 直接拼接缓存的编码"""
+    for key in ('game_state', 'state'):
+        value = message.get(key)
+        if type(value) is GameState:
+            rest = json.dumps({k: v for k, v in message.items() if k != key})
+            return f'{rest[:-1]}, "{key}": {value.json()}}}'
+    return json.dumps(message)
+
+
+def _encode_compact(message):
+    action = message.get('action')
+    room = message.get('room_id')
+
+    if action == 'move':
+        if 'clock' in message:
+            if not _keys_ok(message, ('action', 'x', 'y', 'player', 'seq', 'clock'), ('room_id',)):
+                raise Unsupported
+            return (bytes((OP_MOVE_CLOCK,)) + _pack_room(room)
+                    + _MOVE.pack(message['seq'], message['x'], message['y'], message['player'])
+                    + _CLOCK.pack(*message['clock']))
+        if 'player' in message:
+            if not _keys_ok(message, ('action', 'x', 'y', 'player', 'seq'), ('room_id',)):
+                raise Unsupported
+            return (bytes((OP_MOVE,)) + _pack_room(room)
+                    + _MOVE.pack(message['seq'], message['x'], message['y'], message['player']))
+        if not _keys_ok(message, ('action', 'room_id', 'x', 'y')):
+            raise Unsupported
+        return bytes((OP_MOVE_REQ,)) + _pack_room(room) + _CELL.pack(int(message['x']), int(message['y']))
+
+    if action == 'move_failed':
+        reason = message.get('reason')
+        if reason not in _REASON_CODES or not _keys_ok(message, ('action', 'reason'), ('room_id',)):
+            raise Unsupported
+        return bytes((OP_MOVE_FAILED,)) + _pack_room(room) + _U8.pack(_REASON_CODES[reason])
+
+    if action == 'room_status':
+        if not _keys_ok(message, ('action', 'rooms')):
+            raise Unsupported
+        out = bytearray((OP_ROOM_STATUS,))
+        out += _U16.pack(len(message['rooms']))
+        for room_id, status in message['rooms'].items():
+            if status.keys() != {'player_count'}:
+                raise Unsupported
+            out += _pack_room(room_id) + _U8.pack(status['player_count'])
+        return bytes(out)
+
+    if action == 'game_start':
+        if not _keys_ok(message, ('action', 'game_state'), ('room_id',)):
+            raise Unsupported
+        return bytes((OP_GAME_START,)) + _pack_room(room) + _pack_state(message['game_state'])
+
+    if action == 'game_state':
+        if not _keys_ok(message, ('action', 'state'), ('room_id',)):
+            raise Unsupported
+        return bytes((OP_GAME_STATE,)) + _pack_room(room) + _pack_state(message['state'])
+
+    if action == 'join_success':
+        if not _keys_ok(message, ('action', 'room_id', 'is_first', 'role', 'game_state'), ('token',)):
+            raise Unsupported
+        flags = (1 if message['is_first'] else 0) | (2 if message['role'] == 'white' else 0)
+        # 座位令牌与房间号同样按长度前缀打包, 没有令牌时长度为 0
+        return (bytes((OP_JOIN_SUCCESS,)) + _pack_room(room) + _U8.pack(flags)
+                + _pack_room(message.get('token')) + _pack_state(message['game_state']))
+
+    if action == 'game_over':
+        if message.get('winner') not in WINNERS or not _keys_ok(message, ('action', 'winner', 'winning_move'), ('room_id',)):
+            raise Unsupported
+        x, y = message['winning_move']
+        return (bytes((OP_GAME_OVER,)) + _pack_room(room)
+                + bytes((WINNERS.index(message['winner']) + 1, x, y)))
+
+    if action == 'player_disconnected':
+        if not _keys_ok(message, ('action',), ('room_id',)):
+            raise Unsupported
+        return bytes((OP_PLAYER_DISCONNECTED,)) + _pack_room(room)
+
+    raise Unsupported
+
+
+def encode_binary(message):
+    """把消息编码成二进制帧, 无法紧凑表示时用 OP_JSON 携带"""
+    try:
+        return _encode_compact(message)
+    except (Unsupported, struct.error, ValueError, TypeError, OverflowError):
+        return bytes((OP_JSON,)) + _dumps(message).encode('utf-8')
+
+
+def decode_binary(buf):
+    """把二进制帧解码成与 JSON 协议相同的消息字典"""
+    op = buf[0]
+    if op == OP_JSON:
+        return json.loads(buf[1:])
+
+    # 除大厅状态外, 操作码后紧跟房间号
+    if op == OP_ROOM_STATUS:
+        room, pos = None, 1
+    else:
+        room, pos = _unpack_room(buf, 1)
+    message = {}
+
+    if op == OP_MOVE_REQ:
+        x, y = _CELL.unpack_from(buf, pos)
+        message = {'action': 'move', 'x': x, 'y': y}
+    elif op == OP_MOVE:
+        seq, x, y, player = _MOVE.unpack_from(buf, pos)
+        message = {'action': 'move', 'x': x, 'y': y, 'player': player, 'seq': seq}
+    elif op == OP_MOVE_CLOCK:
+        seq, x, y, player = _MOVE.unpack_from(buf, pos)
+        clock = list(_CLOCK.unpack_from(buf, pos + _MOVE.size))
+        message = {'action': 'move', 'x': x, 'y': y, 'player': player, 'seq': seq, 'clock': clock}
+    elif op == OP_MOVE_FAILED:
+        message = {'action': 'move_failed', 'reason': MOVE_FAILED_REASONS[buf[pos]]}
+    elif op == OP_ROOM_STATUS:
+        (count,) = _U16.unpack_from(buf, 1)
+        pos = 3
+        rooms = {}
+        for _ in range(count):
+            room_id, pos = _unpack_room(buf, pos)
+            rooms[room_id] = {'player_count': buf[pos]}
+            pos += 1
+        return {'action': 'room_status', 'rooms': rooms}
+    elif op == OP_GAME_START:
+        state, pos = _unpack_state(buf, pos)
+        message = {'action': 'game_start', 'game_state': state}
+    elif op == OP_GAME_STATE:
+        state, pos = _unpack_state(buf, pos)
+        message = {'action': 'game_state', 'state': state}
+    elif op == OP_JOIN_SUCCESS:
+        flags = buf[pos]
+        token, pos = _unpack_room(buf, pos + 1)
+        state, pos = _unpack_state(buf, pos)
+        message = {
+            'action': 'join_success',
+            'is_first': bool(flags & 1),
+            'role': 'white' if flags & 2 else 'black',
+            'game_state': state
+        }
+        if token is not None:
+            message['token'] = token
+    elif op == OP_GAME_OVER:
+        winner, x, y = buf[pos], buf[pos + 1], buf[pos + 2]
+        message = {'action': 'game_over', 'winner': WINNERS[winner - 1], 'winning_move': [x, y]}
+    elif op == OP_PLAYER_DISCONNECTED:
+        message = {'action': 'player_disconnected'}
+    else:
+        raise ValueError(f'unknown opcode {op}')
+
+    if room is not None:
+        message['room_id'] = room
+    return message
+
+
+def select_subprotocol(connection, subprotocols):
+    """服务器端协商: 客户端提供二进制子协议时选用, 否则不选子协议, 使用 JSON
+
+    网关的上游连接提供 GATEWAY_SUBPROTOCOL, 由服务器校验网关密钥后按多路复用处理。
+    """
+    if GATEWAY_SUBPROTOCOL in subprotocols:
+        return GATEWAY_SUBPROTOCOL
+    if BINARY_SUBPROTOCOL in subprotocols:
+        return BINARY_SUBPROTOCOL
+    return None
+
+
+def encode(message, binary):
+    """按协商的协议编码, JSON 协议返回 UTF-8 字节, 以文本帧发送"""
+    if binary:
+        return encode_binary(message)
+    return _dumps(message).encode('utf-8')
+
+
+def decode(frame):
+    """解码收到的帧: bytes 为二进制协议, str 为 JSON 协议"""
+    if isinstance(frame, (bytes, bytearray, memoryview)):
+        return decode_binary(frame)
+    return json.loads(frame)
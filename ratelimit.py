@@ -0,0 +1,108 @@
+"""入站限流
+
+每个连接一个总的令牌桶, 另外按请求类型各一个令牌桶。总桶和长度检查在
+解析消息之前进行, 洪泛的连接只花一次减法就被拒绝, 不会占用 json.loads
+和请求处理的时间; 按类型的桶在解析后检查, 限制 move、join_room 等请求。
+
+令牌桶只在取令牌时按经过的时间补充, 不需要定时器。
+"""
+
+MAX_MESSAGE_BYTES = 4096      # 更长的消息不解析直接拒绝
+MESSAGE_RATE = (30.0, 60.0)   # 每个连接: 每秒令牌数, 桶容量
+# 按请求类型的限制, 未列出的类型只受连接总限制
+ACTION_RATES = {
+    'move': (20.0, 40.0),
+    'join_room': (2.0, 5.0),
+    'resume': (1.0, 5.0),
+    'spectate': (5.0, 10.0),
+    'sync': (5.0, 10.0),
+    'hint': (1.0, 3.0),
+    'find_match': (1.0, 3.0),
+    'subscribe_lobby': (1.0, 3.0),
+}
+MAX_STRIKES = 200  # 连续被拒绝这么多次后断开连接
+BURST_YIELD = 16   # 连续处理这么多条消息后让出事件循环
+
+REJECT_SIZE = 'size'
+REJECT_CONNECTION = 'connection'
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+
+    def take(self, now):
+        """取一个令牌, 没有时返回 False"""
+        tokens = self.tokens + (now - self.stamp) * self.rate
+        self.stamp = now
+        if tokens > self.burst:
+            tokens = self.burst
+        if tokens < 1.0:
+            self.tokens = tokens
+            return False
+        self.tokens = tokens - 1.0
+        return True
+
+
+def parse_rate(text):
+    """'RATE' 或 'RATE/BURST' -> (rate, burst), 省略容量时为两倍速率"""
+    rate, _, burst = text.partition('/')
+    rate = float(rate)
+    return rate, float(burst) if burst else rate * 2
+
+
+class Limits:
+    """限流配置, 所有连接共用"""
+
+    def __init__(self, message_rate=MESSAGE_RATE, action_rates=None, max_bytes=MAX_MESSAGE_BYTES,
+                 max_strikes=MAX_STRIKES):
+        self.message_rate = message_rate
+        self.action_rates = dict(ACTION_RATES if action_rates is None else action_rates)
+        self.max_bytes = max_bytes
+        self.max_strikes = max_strikes
+
+
+class Inbound:
+    """单个连接的入站限流状态"""
+
+    __slots__ = ('limits', 'bucket', 'actions', 'strikes')
+
+    def __init__(self, limits, now):
+        self.limits = limits
+        self.bucket = TokenBucket(*limits.message_rate, now)
+        self.actions = {}  # 请求类型 -> TokenBucket, 第一次出现时创建
+        self.strikes = 0   # 连续被拒绝的次数
+
+    def admit(self, message, now):
+        """解析前的检查, 通过时返回 None, 否则返回拒绝原因"""
+        if len(message) > self.limits.max_bytes:
+            self.strikes += 1
+            return REJECT_SIZE
+        if not self.bucket.take(now):
+            self.strikes += 1
+            return REJECT_CONNECTION
+        return None
+
+    def admit_action(self, action, now):
+        """解析后按请求类型检查"""
+        bucket = self.actions.get(action)
+        if bucket is None:
+            rate = self.limits.action_rates.get(action)
+            if rate is None:
+                self.strikes = 0
+                return True
+            bucket = self.actions[action] = TokenBucket(*rate, now)
+        if bucket.take(now):
+            self.strikes = 0
+            return True
+        self.strikes += 1
+        return False
+
+    @property
+    def abusive(self):
+        return self.strikes >= self.limits.max_strikes
@@ -0,0 +1,311 @@
+"""房间与房间注册表
+
+房间在第一次加入时创建, 棋盘在有玩家时才分配, 房间变空后
+归还棋盘并进入空闲队列, 超时或空闲房间过多时按 LRU 顺序淘汰。
+
+Room 和 Seat 使用 __slots__, 每个房间只有固定的两个座位, 按执子颜色
+直接下标访问, 查玩家的颜色只需比较两个座位。
+"""
+import secrets
+import time
+from collections import OrderedDict, deque
+
+from board import Board, SIZE, FREESTYLE, BLACK, WHITE
+from protocol import GameState, Snapshot
+
+MAX_ROOM_ID_LEN = 32
+IDLE_TTL = 300        # 空房间保留时间, 单位秒
+MAX_IDLE_ROOMS = 1024  # 最多保留的空房间数
+BOARD_POOL_SIZE = 1024
+BOT_ID = 'bot'         # 人机房间中 AI 座位使用的玩家 id
+HISTORY_SIZE = 64      # 每个房间保留的最近落子消息数, 供观众追赶
+
+
+class Seat:
+    """房间中一方的座位"""
+
+    __slots__ = ('color', 'client_id', 'token', 'hold')
+
+    def __init__(self, color):
+        self.color = color
+        self.client_id = None  # 坐在这里的玩家 id, AI 为 BOT_ID
+        self.token = None      # 座位令牌, 断线后凭令牌恢复
+        self.hold = None       # 断线保留座位的到期定时器
+
+    @property
+    def taken(self):
+        """有人坐着, 或为断线的玩家保留着"""
+        return self.client_id is not None or self.hold is not None
+
+
+class Room:
+    __slots__ = ('id', 'players', 'seats', 'bot_color', 'board', 'game_started', 'spectators', 'history',
+                 'clock', 'base', '_snapshot', 'size', 'rule')
+
+    def __init__(self, id: str):
+        self.id = id
+        self.players = set()   # 在座玩家的 id, 用于广播
+        self.seats = (None, Seat(BLACK), Seat(WHITE))  # 下标为执子颜色, 0 号不用
+        self.bot_color = None  # 人机房间中 AI 的颜色
+        self.board = None  # 有玩家加入时才分配
+        self.game_started = False
+        self.spectators = set()
+        self.history = ()      # 最近的 move 广播消息, 第一次落子时才分配环形缓冲区
+        self.clock = None      # 对局开始后的 GameClock
+        # 版本号: 每落一子加一, 重置时跳过本局用过的所有版本, 始终为 base + 手数
+        self.base = 0
+        self._snapshot = None  # 最近一次生成的 Snapshot
+        # 棋盘尺寸和规则, 由第一个加入的玩家选择
+        self.size = SIZE
+        self.rule = FREESTYLE
+
+    def free_color(self):
+        """空着的颜色, 优先黑棋, 断线保留的座位不算空"""
+        return WHITE if self.seats[BLACK].taken else BLACK
+
+    @property
+    def seats_taken(self):
+        return self.seats[BLACK].taken + self.seats[WHITE].taken
+
+    @property
+    def held(self):
+        """是否有为断线玩家保留的座位"""
+        return self.seats[BLACK].hold is not None or self.seats[WHITE].hold is not None
+
+    def color_of(self, client_id):
+        """玩家执子的颜色, 不在座时返回 None"""
+        if self.seats[BLACK].client_id == client_id:
+            return BLACK
+        if self.seats[WHITE].client_id == client_id:
+            return WHITE
+        return None
+
+    def seat_by_token(self, token):
+        for seat in self.seats[1:]:
+            if seat.token is not None and seat.token == token:
+                return seat
+        return None
+
+    def issue_token(self, color):
+        """为座位签发新令牌, 旧令牌作废"""
+        token = self.seats[color].token = secrets.token_hex(16)
+        return token
+
+    def reset_game_state(self):
+        """重置房间的游戏状态"""
+        self.game_started = False
+        if self.history:
+            self.history.clear()
+        self.base += self.seq + 1
+        self._snapshot = None
+        if self.clock is not None:
+            self.clock.stop()
+            self.clock = None
+        if self.board is not None:
+            self.board.reset()
+
+    def record(self, message):
+        """把落子广播记入环形缓冲区"""
+        history = self.history
+        if type(history) is tuple:
+            history = self.history = deque(maxlen=HISTORY_SIZE)
+        history.append(message)
+
+    @property
+    def seq(self):
+        """当前对局已下的手数"""
+        return len(self.board.moves) if self.board is not None else 0
+
+    @property
+    def version(self):
+        return self.base + self.seq
+
+    def moves_since_version(self, version):
+        """版本 version 之后的落子消息, 不是本局的版本或缓冲区不够时返回 None"""
+        if not isinstance(version, int) or version < self.base:
+            return None
+        return self.moves_since(version - self.base)
+
+    def moves_since(self, since):
+        """第 since 手之后的落子消息, 环形缓冲区已不包含这些消息时返回 None"""
+        seq = self.seq
+        if not isinstance(since, int) or not 0 <= since <= seq:
+            return None
+        if seq - since > len(self.history):
+            return None
+        return list(self.history)[len(self.history) - (seq - since):]
+
+    def snapshot(self):
+        """当前版本的棋盘快照, 版本不变时复用, 编码结果随之缓存"""
+        version = self.version
+        snapshot = self._snapshot
+        if snapshot is None or snapshot.version != version:
+            if self.board is None:
+                state = {
+                    'board': [[0] * self.size for _ in range(self.size)],
+                    'current_player': 1,
+                    'last_move': None
+                }
+            else:
+                state = {
+                    'board': self.board.to_rows(),
+                    'current_player': self.board.current_player,
+                    'last_move': self.board.last_move
+                }
+            state['version'] = version
+            state['rule'] = self.rule
+            snapshot = self._snapshot = Snapshot(version, state)
+        return snapshot
+
+    @property
+    def game_state(self):
+        """放入消息的游戏状态, 编码后与原有的消息格式相同, 另带 version 和计时"""
+        return GameState(self.snapshot(), self.clock.state() if self.clock is not None else None)
+
+
+class RoomRegistry:
+    def __init__(self, idle_ttl=IDLE_TTL, max_idle=MAX_IDLE_ROOMS):
+        self.rooms = {}             # room_id -> Room
+        self.idle = OrderedDict()   # 空房间 room_id -> 变空的时间, 最旧的在前
+        self.client_rooms = {}      # client_id -> 所在房间 id 的集合
+        self.client_watching = {}   # client_id -> 观战房间 id 的集合
+        self.idle_ttl = idle_ttl
+        self.max_idle = max_idle
+        self._board_pool = []
+
+    def __contains__(self, room_id):
+        return room_id in self.rooms
+
+    def __len__(self):
+        return len(self.rooms)
+
+    def get(self, room_id):
+        return self.rooms.get(room_id)
+
+    @staticmethod
+    def valid_id(room_id):
+        return isinstance(room_id, str) and 0 < len(room_id) <= MAX_ROOM_ID_LEN
+
+    def get_or_create(self, room_id):
+        """按需创建房间, room_id 不合法时返回 None"""
+        room = self.rooms.get(room_id)
+        if room is None:
+            if not self.valid_id(room_id):
+                return None
+            room = self.rooms[room_id] = Room(room_id)
+            self.idle[room_id] = time.monotonic()
+            self.evict()
+        return room
+
+    def rooms_of(self, client_id):
+        return self.client_rooms.get(client_id, ())
+
+    def watching(self, client_id):
+        return self.client_watching.get(client_id, ())
+
+    def spectate(self, client_id, room):
+        room.spectators.add(client_id)
+        self.client_watching.setdefault(client_id, set()).add(room.id)
+
+    def unspectate(self, client_id, room):
+        room.spectators.discard(client_id)
+        watching = self.client_watching.get(client_id)
+        if watching is not None:
+            watching.discard(room.id)
+            if not watching:
+                del self.client_watching[client_id]
+
+    def _board(self, room):
+        """为房间准备符合其尺寸和规则的空棋盘, 优先复用池中的棋盘"""
+        board = room.board
+        if board is None:
+            if not self._board_pool:
+                room.board = Board(room.size, room.rule)
+                return
+            board = room.board = self._board_pool.pop()
+        if board.size != room.size or board.rule != room.rule:
+            board.configure(room.size, room.rule)
+
+    def join(self, client_id, room, color):
+        self._board(room)
+        room.players.add(client_id)
+        room.seats[color].client_id = client_id
+        self.idle.pop(room.id, None)
+        self.client_rooms.setdefault(client_id, set()).add(room.id)
+
+    def restore(self, room_id, moves, size=SIZE, rule=FREESTYLE):
+        """重建从日志恢复的对局, 房间没有玩家, 仍按空房间参与淘汰"""
+        room = self.get_or_create(room_id)
+        if room is None:
+            return None
+        room.size = size
+        room.rule = rule
+        self._board(room)
+        room.reset_game_state()
+        player = 1
+        for x, y in moves:
+            room.board.place(x, y, player)
+            player = 3 - player
+        return room
+
+    def add_bot(self, room, color):
+        """让 AI 占据 color 一方的座位, AI 不进入反向索引"""
+        room.players.add(BOT_ID)
+        room.seats[color].client_id = BOT_ID
+        room.bot_color = color
+
+    def leave(self, client_id, room, hold=False):
+        """离开房间; hold 为真时座位仍保留, 房间不清理, 之后由 vacate 处理"""
+        room.players.discard(client_id)
+        color = room.color_of(client_id)
+        if color is not None:
+            seat = room.seats[color]
+            seat.client_id = None
+            if not hold:
+                seat.token = None
+        joined = self.client_rooms.get(client_id)
+        if joined is not None:
+            joined.discard(room.id)
+            if not joined:
+                del self.client_rooms[client_id]
+        if not hold:
+            self.vacate(room)
+
+    def vacate(self, room):
+        """没有玩家也没有保留的座位时清理房间"""
+        if room.held:
+            return
+        # 只剩 AI 时房间视为空房间
+        if room.bot_color is not None and room.players == {BOT_ID}:
+            room.players.clear()
+            room.seats[room.bot_color].client_id = None
+            room.bot_color = None
+
+        if not room.players:
+            self._release(room)
+
+    def _release(self, room):
+        """房间变空: 归还棋盘, 放入空闲队列末尾"""
+        room.reset_game_state()
+        for seat in room.seats[1:]:
+            seat.token = None
+        if room.board is not None:
+            if len(self._board_pool) < BOARD_POOL_SIZE:
+                self._board_pool.append(room.board)
+            room.board = None
+        self.idle[room.id] = time.monotonic()
+        self.idle.move_to_end(room.id)
+        self.evict()
+
+    def evict(self):
+        """淘汰超时的空房间, 以及超出数量上限的最旧空房间"""
+        deadline = time.monotonic() - self.idle_ttl
+        idle = self.idle
+        while idle:
+            room_id, since = next(iter(idle.items()))
+            if since > deadline and len(idle) <= self.max_idle:
+                break
+            idle.popitem(last=False)
+            room = self.rooms.pop(room_id)
+            for client_id in list(room.spectators):
+                self.unspectate(client_id, room)
@@ -1,273 +1,932 @@
+import argparse
 import asyncio
+import hmac
 import websockets
 import json
+import os
+import signal
+import time
+from http import HTTPStatus
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from dataclasses import dataclass
 from typing import Dict, Set
 
-class Room:
-    def __init__(self, id: str):
+import bot
+import cluster
+from clock import GameClock, TOTAL_TIME, MOVE_TIME
+import gateway
+import log
+from board import BLACK, WHITE, SIZE, MIN_SIZE, MAX_SIZE, FREESTYLE, RULES, valid_size
+from fanout import Fanout
+from heartbeat import Heartbeat
+from journal import NO_WINNER
+from lobby import Lobby
+from matchmaking import Matchmaker, TICK_INTERVAL
+from metrics import Metrics
+from opening import OpeningBook
+import protocol
+from ratelimit import BURST_YIELD, REJECT_CONNECTION, REJECT_SIZE, Inbound, Limits, parse_rate
+from rooms import RoomRegistry
+from timerwheel import TimerWheel
+
+# 请求分发表: action -> (处理方法, 必需字段及类型, 校验失败时的回复)
+# 指标也按这些请求分组, 其他请求归入 other, 避免客户端制造任意多的标签
+HANDLERS = {}
+INVALID_REQUEST = {'action': 'error', 'message': 'invalid_request'}
+# 解析前被拒绝的消息不知道请求类型, 只按原因回复, 客户端不会一直等待
+REJECTED = {
+    REJECT_SIZE: {'action': 'error', 'message': 'message_too_large'},
+    REJECT_CONNECTION: {'action': 'error', 'message': 'rate_limited'},
+}
+
+
+def handles(action, invalid=INVALID_REQUEST, **fields):
+    """把方法登记为 action 的处理方法, fields 为必需字段的类型, 类型不符时回复 invalid"""
+    def register(method):
+        HANDLERS[action] = (method, tuple(fields.items()), invalid)
+        return method
+    return register
+
+
+class Connection:
+    """一个客户端连接的状态"""
+
+    __slots__ = ('id', 'websocket', 'binary', 'liveness', 'inbound')
+
+    def __init__(self, id, websocket, binary, liveness, inbound):
         self.id = id
-        self.players = set()
-        self.reset_game_state()
-    
-    def reset_game_state(self):
-        """重置房间的游戏状态"""
-        self.game_started = False
-        self.game_state = {
-            'board': [[0]*15 for _ in range(15)],
-            'current_player': 1,
-            'last_move': None
-        }
+        self.websocket = websocket
+        self.binary = binary
+        self.liveness = liveness  # 心跳状态, 经网关转发的连接为 None
+        self.inbound = inbound    # 入站限流状态
+
+
+SEAT_GRACE = 60  # 断线后保留座位的秒数
+
+# 落子量大, 只按比例记录
+log_move = log.Sampler(log.INFO, 'move', every=1000)
 
 class GameServer:
-    def __init__(self):
+    def __init__(self, shard=0, shards=1, shard_uris=None, journal=None, time_control=(TOTAL_TIME, MOVE_TIME),
+                 limits=None, variant=(SIZE, FREESTYLE), book=None, gateway_key=None):
         self.connections = {}
-        self.rooms = {
-            str(i): Room(str(i)) for i in range(1, 6)
+        # 多进程模式下本进程负责的分片, 以及各分片的专用地址
+        self.shard = shard
+        self.shards = shards
+        self.shard_uris = shard_uris
+        self.registry = RoomRegistry()
+        self.rooms = self.registry.rooms
+        self.fanout = Fanout(resync=self.spectator_snapshot)
+        self.bot_pool = None  # AI 搜索用的进程池, 第一次需要时创建
+        self.lobby = Lobby(self.rooms, self.fanout.publish)
+        self.journal = journal  # 对局日志, 未启用时为 None
+        self.recovered = set()  # 从日志恢复、还没有玩家回来的房间
+        self.matchmaker = Matchmaker()
+        self.match_count = 0
+        # 心跳、空闲回收和保留座位的定时器共用一个时间轮
+        self.wheel = TimerWheel()
+        self.heartbeat = Heartbeat(self.wheel, on_reap=self.on_reap, busy=self.in_room)
+        # 每方总用时和每步用时, 总用时为 0 时不计时
+        self.total_time, self.move_time = time_control
+        self.limits = limits or Limits()
+        # 新房间默认的棋盘尺寸和规则, 第一个加入的玩家可以另选
+        self.board_size, self.rule = variant
+        # 只读映射的开局库, 供 AI 和提示使用, 多个工作进程共用同一份页缓存
+        self.book = OpeningBook(book) if book else None
+        # 网关的上游连接凭这个密钥接入, 为 None 时不接受网关
+        self.gateway_key = gateway_key
+        self.gateway_links = 0
+        self._tasks = []
+        self.bot_tasks = set()  # 进行中的 AI 落子任务, 保留引用以免被回收
+        self.setup_metrics()
+
+    def start(self, metrics_dump=None):
+        """在事件循环中启动后台任务"""
+        self.metrics.start_lag_monitor()
+        self.wheel.start()
+        if metrics_dump:
+            self.metrics.start_dump(metrics_dump)
+        self._tasks.append(asyncio.create_task(self.match_loop()))
+
+    def setup_metrics(self):
+        metrics = self.metrics = Metrics()
+        self.action_seconds = metrics.histogram('action_seconds', '处理请求的耗时, 含放入发送队列', 'action')
+        self.action_errors = metrics.counter('action_errors_total', '处理出错或无法解析的请求数', 'action')
+        self.broadcast_seconds = metrics.histogram('broadcast_seconds', '房间广播编码并放入发送队列的耗时', 'action')
+        self.broadcast_recipients = metrics.counter('broadcast_recipients_total', '房间广播的接收人次', 'action')
+        metrics.gauge('connections', '当前连接数', lambda: len(self.connections))
+        metrics.gauge('gateway_links', '网关的上游连接数', lambda: self.gateway_links)
+        metrics.gauge('rooms', '当前房间数 (含空闲房间)', lambda: len(self.rooms))
+        metrics.gauge('games_in_progress', '进行中的对局数',
+                      lambda: sum(1 for room in self.rooms.values() if room.game_started))
+        metrics.gauge('spectators', '观众人数',
+                      lambda: sum(len(room.spectators) for room in self.rooms.values()))
+        metrics.gauge('matchmaking_waiting', '排队匹配的人数', lambda: len(self.matchmaker))
+        self.matches = metrics.counter('matches_total', '匹配成功的对局数')
+        self.clock_timeouts = metrics.counter('clock_timeouts_total', '超时判负的对局数')
+        self.rate_limited = metrics.counter('rate_limited_total', '被限流或过长而拒绝的消息数', 'reason')
+        self.rate_disconnects = metrics.counter('rate_limit_disconnects_total', '持续超限被断开的连接数')
+        metrics.gauge('rate_limit_messages_per_second', '每个连接的消息速率上限',
+                      lambda: self.limits.message_rate[0])
+        self.book_lookups = metrics.counter('book_lookups_total', '开局库查询次数', 'result')
+        self.reaped = metrics.counter('reaped_total', '心跳超时或空闲被关闭的连接数', 'reason')
+        metrics.gauge('timers', '时间轮中的定时器数', lambda: len(self.wheel))
+        metrics.gauge('log_dropped', '日志队列满时丢弃的记录数', lambda: log.dropped)
+        metrics.gauge('outbox_dropped', '当前连接的发送队列溢出次数',
+                      lambda: sum(outbox.dropped for outbox in self.fanout.outboxes.values()))
+
+    def process_request(self, connection, request):
+        """普通 HTTP 请求 GET /metrics 返回指标, 其余请求照常握手"""
+        if request.path == '/metrics':
+            return connection.respond(HTTPStatus.OK, self.metrics.render())
+        return None
+
+    async def resume(self, client_id, data):
+        """凭令牌回到断线前的座位, 只补发错过的落子
+
+        重连可能落到公共端口上的任意工作进程, 房间不在本分片时重定向。
+        """
+        room_id = data.get('room_id')
+        redirect = self.redirect(room_id)
+        if redirect is not None:
+            return redirect
+        room = self.registry.get(room_id)
+        token = data.get('token')
+        seat = room.seat_by_token(token) if room is not None and isinstance(token, str) else None
+        if seat is None or seat.hold is None:
+            return {'action': 'resume_failed'}
+
+        seat.hold.cancel()
+        seat.hold = None
+        color = seat.color
+        self.registry.join(client_id, room, color)
+        self.lobby.release(client_id)
+        response = {
+            'action': 'resume_success',
+            'room_id': room_id,
+            'role': 'black' if color == BLACK else 'white',
+            'token': room.issue_token(color),
+            'seq': room.seq
         }
-        self.broadcast_task = None
-    
-    async def start_broadcast_task(self):
+        self.catch_up(room, data, response)
+        moves = response.get('moves')
+        # 回复先于通知放入队列, 客户端先同步局面
+        self.fanout.send(client_id, response)
+        log.info('resumed', room=room_id, client=client_id, missed=len(moves) if moves is not None else -1)
+
+        await self.broadcast_to_room(room_id, {'action': 'player_returned'}, exclude=client_id)
+        if len(room.players) == 2 and not room.game_started:
+            self.begin_game(room)
+            await self.broadcast_to_room(room_id, {
+                'action': 'game_start',
+                'game_state': room.game_state
+            })
+        elif room.bot_color is not None and room.bot_color == room.board.current_player and room.game_started:
+            self.start_bot(room)
+        return None
+
+    def on_reap(self, client_id, reason):
+        self.reaped.inc(reason)
+
+    def in_room(self, client_id):
+        """在座或观战的连接只是在等待, 不按空闲回收"""
+        return bool(self.registry.rooms_of(client_id) or self.registry.watching(client_id))
+
+    def begin_game(self, room):
+        """开局并开始为轮到的一方计时"""
+        room.game_started = True
+        if self.total_time:
+            room.clock = GameClock(self.wheel, self.total_time, self.move_time or self.total_time,
+                                   self._clock_timeout, room)
+            room.clock.start(room.board.current_player)
+
+    def _clock_timeout(self, room, color):
+        asyncio.ensure_future(self.clock_timeout(room, color))
+
+    async def clock_timeout(self, room, color):
+        """轮到的一方用完时间, 对方获胜"""
+        if not room.game_started:
+            return
+        winner = 3 - color
+        self.clock_timeouts.inc()
+        log.info('clock_timeout', room=room.id, color=color)
+        await self.broadcast_to_room(room.id, {
+            'action': 'game_over',
+            'winner': '黑棋' if winner == BLACK else '白棋',
+            'reason': 'timeout'
+        })
+        self.end_game(room, winner)
+
+    def variant_of(self, data, vs_bot=False):
+        """join_room 请求中的 size 和 rule, 缺省时用服务器的默认值, 不合法时返回 None"""
+        if vs_bot:
+            # AI 只会下 15 路自由规则
+            return SIZE, FREESTYLE
+        size = data.get('size', self.board_size)
+        rule = data.get('rule', self.rule)
+        if not valid_size(size) or rule not in RULES:
+            return None
+        return size, rule
+
+    @staticmethod
+    def catch_up(room, data, response):
+        """按请求中的 version (或本局手数 since) 补发落子, 缓冲区不够时附上完整棋盘"""
+        if 'version' in data:
+            moves = room.moves_since_version(data['version'])
+        else:
+            moves = room.moves_since(data.get('since', 0))
+        response['version'] = room.version
+        if moves is not None:
+            response['moves'] = moves
+            # 只补发落子时告诉客户端棋盘的尺寸和规则
+            response['size'] = room.size
+            response['rule'] = room.rule
+        else:
+            response['game_state'] = room.game_state
+        return response
+
+    def hold_seat(self, room, color):
+        """玩家断线: 保留座位 SEAT_GRACE 秒"""
+        room.seats[color].hold = self.wheel.schedule(SEAT_GRACE, self._expire_seat, room, color)
+
+    def _expire_seat(self, room, color):
+        asyncio.ensure_future(self.expire_seat(room, color))
+
+    async def expire_seat(self, room, color):
+        """保留期内没有回来, 按原来的断线处理结束对局"""
+        seat = room.seats[color]
+        if seat.hold is None:
+            return
+        seat.hold = None
+        seat.token = None
+        self.end_game(room)
+        self.registry.vacate(room)
+        self.lobby.mark_dirty(room.id)
+        await self.broadcast_to_room(room.id, {
+            'action': 'player_disconnected'
+        })
+
+    async def match_loop(self):
+        """定时按变宽的窗口重新配对"""
         while True:
-            await self.broadcast_room_status()
-            await asyncio.sleep(1)  # 每秒更新一次状态
-    
-    async def broadcast_room_status(self):
-        room_status = {
-            room_id: {
-                'player_count': len(room.players)
-            }
-            for room_id, room in self.rooms.items()
-        }
-        
-        for websocket in self.connections.values():
-            try:
-                await websocket.send(json.dumps({
-                    'action': 'room_status',
-                    'rooms': room_status
-                }))
-            except:
-                pass
+            await asyncio.sleep(TICK_INTERVAL)
+            for black, white in self.matchmaker.tick():
+                await self.start_match(black.client_id, black.rating, white.client_id, white.rating)
+
+    def new_match_room(self):
+        """为匹配成功的双方分配一个属于本分片的新房间"""
+        while True:
+            self.match_count += 1
+            room_id = f"match-{self.shard}-{self.match_count}"
+            if self.shards == 1 or cluster.shard_of(room_id, self.shards) == self.shard:
+                room = self.registry.get_or_create(room_id)
+                if not room.players:
+                    return room
+
+    async def start_match(self, black, black_rating, white, white_rating):
+        """让配对的两人进入新房间并开局"""
+        room = self.new_match_room()
+        room.reset_game_state()
+        room.size, room.rule = self.board_size, self.rule
+        for client_id, color, rating in ((black, BLACK, white_rating), (white, WHITE, black_rating)):
+            self.registry.join(client_id, room, color)
+            self.lobby.release(client_id)
+            # 客户端收到 match_found 后打开对局窗口, 之后的消息与加入房间相同
+            self.fanout.send(client_id, {
+                'action': 'match_found',
+                'room_id': room.id,
+                'opponent_rating': rating
+            })
+            self.fanout.send(client_id, {
+                'action': 'join_success',
+                'room_id': room.id,
+                'is_first': color == BLACK,
+                'role': 'black' if color == BLACK else 'white',
+                'token': room.issue_token(color),
+                'game_state': room.game_state
+            })
+        self.lobby.mark_dirty(room.id)
+        self.begin_game(room)
+        self.matches.inc()
+        log.info('match', room=room.id, black_rating=black_rating, white_rating=white_rating)
+        await self.broadcast_to_room(room.id, {
+            'action': 'game_start',
+            'game_state': room.game_state
+        })
+
+    async def close(self):
+        """退出前写完日志
+
+        在关闭连接之前调用, 关闭连接引起的离开不记为对局结束, 重启后可以恢复。
+        """
+        journal, self.journal = self.journal, None
+        if journal is not None:
+            await journal.close()
+
+    def restore(self, games, rules=None):
+        """用日志中的进行中对局重建房间, games 为 {room_id: moves}, rules 为 {room_id: (size, rule)}"""
+        rules = rules or {}
+        for room_id, moves in games.items():
+            room = self.registry.restore(room_id, moves, *rules.get(room_id, (SIZE, FREESTYLE)))
+            if room is not None:
+                self.recovered.add(room_id)
+        log.info('journal_restored', games=len(self.recovered))
+
+    def live_games(self):
+        """日志快照: 所有进行中的对局"""
+        for room in self.rooms.values():
+            if room.board is not None and room.board.moves:
+                yield room.id, room.board.moves, room.size, room.rule
+
+    def end_game(self, room, winner=NO_WINNER):
+        """结束并重置房间的对局, 有落子时记入日志"""
+        if self.journal is not None and room.board is not None and room.board.moves:
+            self.journal.end(room.id, winner)
+        room.reset_game_state()
     
-    async def handle_connection(self, websocket):
+    async def handle_connection(self, websocket, relayed=False):
+        """处理一个客户端连接, relayed 为真时连接经网关转发, 心跳由网关负责"""
+        if websocket.subprotocol == protocol.GATEWAY_SUBPROTOCOL:
+            await self.handle_link(websocket)
+            return
         client_id = str(id(websocket))
-        self.connections[client_id] = websocket
-        print(f"New client connected: {client_id}")
-        
-        await self.broadcast_room_status()
+        binary = websocket.subprotocol == protocol.BINARY_SUBPROTOCOL
+        wheel = self.wheel
+        conn = self.connections[client_id] = Connection(
+            client_id, websocket, binary,
+            None if relayed else self.heartbeat.open(client_id, websocket),
+            Inbound(self.limits, wheel.now)
+        )
+        self.fanout.open(client_id, websocket, binary)
+        liveness = conn.liveness
+        inbound = conn.inbound
+        burst = 0
+        log.info('connected', client=client_id, binary=binary, relayed=relayed)
         
-        if not self.broadcast_task:
-            self.broadcast_task = asyncio.create_task(self.start_broadcast_task())
+        # 新连接默认订阅大厅, 兼容不会发送 subscribe_lobby 的旧客户端
+        self.fanout.send(client_id, self.lobby.subscribe(client_id))
         
         try:
             async for message in websocket:
+                # 连续处理一批消息后让出事件循环, 缓冲区里积压的消息不会一直占用
+                burst += 1
+                if burst >= BURST_YIELD:
+                    burst = 0
+                    await asyncio.sleep(0)
+                now = wheel.now
+                if liveness is not None:
+                    liveness.touch(now)
+                # 解析之前先检查长度和连接的令牌桶, 洪泛的消息不解析
+                reason = inbound.admit(message, now)
+                if reason is not None:
+                    self.rate_limited.inc(reason)
+                    if inbound.abusive:
+                        await self.close_abusive(client_id, websocket)
+                        break
+                    self.fanout.send(client_id, REJECTED[reason])
+                    continue
+                start = time.perf_counter()
+                label = 'invalid'
                 try:
-                    data = json.loads(message)
+                    data = protocol.decode_binary(message) if binary else json.loads(message)
+                    action = data.get('action')
+                    label = action if action in HANDLERS else 'other'
+                    if not inbound.admit_action(action, now):
+                        self.rate_limited.inc(label)
+                        if inbound.abusive:
+                            await self.close_abusive(client_id, websocket)
+                            break
+                        self.fanout.send(client_id, self.rate_limited_response(action, data))
+                        continue
                     response = await self.handle_message(client_id, data)
                     if response:
-                        await websocket.send(json.dumps(response))
-                except json.JSONDecodeError:
-                    print(f"Invalid JSON from client {client_id}")
+                        # 一个连接可以同时在多个房间, 响应带上请求的房间号
+                        if 'room_id' in data and 'room_id' not in response:
+                            response['room_id'] = data['room_id']
+                        # 响应和广播走同一个队列, 保证顺序
+                        self.fanout.send(client_id, response)
+                    self.action_seconds.observe(label, time.perf_counter() - start)
+                except (json.JSONDecodeError, ValueError, IndexError, AttributeError):
+                    self.action_errors.inc(label)
+                    log.warning('invalid_message', client=client_id)
                 except Exception as e:
-                    print(f"Error handling message from {client_id}: {str(e)}")
+                    self.action_errors.inc(label)
+                    log.error('message_error', client=client_id, error=e)
         except websockets.exceptions.ConnectionClosed:
-            print(f"Client {client_id} connection closed")
+            log.info('disconnected', client=client_id)
         finally:
             await self.handle_disconnect(client_id)
     
+    async def handle_link(self, websocket):
+        """网关的上游连接: 校验密钥后把其中的每个客户端交给 handle_connection"""
+        key = websocket.request.headers.get(gateway.KEY_HEADER, '')
+        if self.gateway_key is None or not hmac.compare_digest(key.encode(), self.gateway_key.encode()):
+            log.warning('gateway_rejected', remote=websocket.remote_address)
+            await websocket.close(1008, 'gateway not allowed')
+            return
+        self.gateway_links += 1
+        log.info('gateway_connected', remote=websocket.remote_address)
+        try:
+            await gateway.serve_link(websocket, self.handle_connection)
+        finally:
+            self.gateway_links -= 1
+            log.info('gateway_disconnected', remote=websocket.remote_address)
+
+    async def close_abusive(self, client_id, websocket):
+        """持续超限, 按违反策略关闭连接"""
+        self.rate_disconnects.inc()
+        log.warning('rate_limit_disconnect', client=client_id)
+        await websocket.close(1008, 'rate limit exceeded')
+
+    @staticmethod
+    def rate_limited_response(action, data):
+        """被按类型限流的请求的回复, 落子沿用 move_failed 让客户端撤回棋子"""
+        if action == 'move':
+            response = {'action': 'move_failed', 'reason': 'rate_limited'}
+        else:
+            response = {'action': 'rate_limited', 'request': action}
+        if 'room_id' in data:
+            response['room_id'] = data['room_id']
+        return response
+
     async def handle_message(self, client_id: str, data: dict):
+        """按 action 查表分发, 先按登记的字段类型校验请求"""
+        action = data.get('action')
+        log.debug('message', action=action, client=client_id)
+        if not action:
+            return {'action': 'error', 'message': 'invalid_action'}
+        handler = HANDLERS.get(action)
+        if handler is None:
+            return None
+        method, fields, invalid = handler
+        for name, kind in fields:
+            if type(data.get(name)) is not kind:
+                return dict(invalid)
         try:
-            action = data.get('action')
-            print(f"处理消息: action={action}, client={client_id}")
-            
-            if not action:
-                return {'action': 'error', 'message': 'invalid_action'}
-
-            if action == 'join_room':
-                room_id = data.get('room_id')
-                if room_id in self.rooms:
-                    room = self.rooms[room_id]
-                    if len(room.players) < 2:
-                        is_first = len(room.players) == 0
-                        # 如果是第一个玩家加入，重置房间状态
-                        if is_first:
-                            room.reset_game_state()
-                        room.players.add(client_id)
-                        
-                        await self.broadcast_room_status()
-                        
-                        # 发送房间当前状态给新加入的玩家
-                        response = {
-                            'action': 'join_success',
-                            'room_id': room_id,
-                            'is_first': is_first,
-                            'role': 'black' if is_first else 'white',
-                            'game_state': room.game_state
-                        }
-                        
-                        if len(room.players) == 2:
-                            room.game_started = True
-                            # 重新发送游戏开始状态
-                            await self.broadcast_to_room(room_id, {
-                                'action': 'game_start',
-                                'game_state': room.game_state
-                            })
-                        
-                        return response
-                return {'action': 'join_failed'}
-
-            elif action == 'exit_room':
-                room_id = data.get('room_id')
-                if room_id in self.rooms:
-                    room = self.rooms[room_id]
-                    if client_id in room.players:
-                        room.players.remove(client_id)
-                        room.reset_game_state()
-                        await self.broadcast_room_status()
-                        await self.broadcast_to_room(room_id, {
-                            'action': 'player_disconnected'
-                        })
-                        return {'action': 'exit_success'}
-            
-            elif action == 'move':
-                try:
-                    room_id = data.get('room_id')
-                    x = int(data.get('x', -1))
-                    y = int(data.get('y', -1))
-                    
-                    print(f"收到移动请求: room={room_id}, x={x}, y={y}")
-                    
-                    room = self.rooms.get(room_id)
-                    if not room:
-                        return {'action': 'move_failed', 'reason': 'room_not_found'}
-                    
-                    if not room.game_started:
-                        return {'action': 'move_failed', 'reason': 'game_not_started'}
-                    
-                    if len(room.players) != 2:
-                        return {'action': 'move_failed', 'reason': 'waiting_for_player'}
-                    
-                    players = list(room.players)
-                    player_index = players.index(client_id) if client_id in players else -1
-                    current_player = room.game_state['current_player']
-                    
-                    print(f"移动验证: player_index={player_index}, current_player={current_player}")
-                    
-                    # 检查是否是当前玩家的回合
-                    expected_player = 1 if player_index == 0 else 2
-                    if current_player != expected_player:
-                        print(f"回合错误: expected={expected_player}, current={current_player}")
-                        return {'action': 'move_failed', 'reason': 'not_your_turn'}
-                    
-                    board = room.game_state['board']
-                    
-                    # 验证坐标和位置是否有效
-                    if not (0 <= x < 15 and 0 <= y < 15):
-                        print("无效位置")
-                        return {'action': 'move_failed', 'reason': 'invalid_position'}
-                    
-                    if board[y][x] != 0:
-                        print("位置已被占用")
-                        return {'action': 'move_failed', 'reason': 'position_occupied'}
-                    
-                    # 落子成功，更新状态
-                    board[y][x] = current_player
-                    room.game_state['current_player'] = 3 - current_player
-                    room.game_state['last_move'] = (x, y)
-                    
-                    print(f"落子成功: x={x}, y={y}, player={current_player}")
-                    
-                    # 广播移动消息
-                    await self.broadcast_to_room(room_id, {
-                        'action': 'move',
-                        'x': x,
-                        'y': y,
-                        'player': current_player
-                    })
-                    
-                    # 检查胜负
-                    if self.check_winner(board, x, y, current_player):
-                        await self.broadcast_to_room(room_id, {
-                            'action': 'game_over',
-                            'winner': '黑棋' if current_player == 1 else '白棋',
-                            'winning_move': (x, y)
-                        })
-                        room.reset_game_state()
-                    
-                except Exception as e:
-                    print(f"处理移动时出错: {e}")
-                    return {'action': 'move_failed', 'reason': str(e)}
-            
-            elif action == 'game_over':
-                room_id = data.get('room_id')
-                if room_id in self.rooms:
-                    room = self.rooms[room_id]
-                    room.reset_game_state()
-                    await self.broadcast_to_room(room_id, {
-                        'action': 'game_state',
-                        'state': room.game_state
-                    })
-            
+            return await method(self, client_id, data)
         except Exception as e:
-            print(f"Error handling message: {e}")
-            import traceback
-            traceback.print_exc()
+            log.error('handle_message_error', action=action, error=repr(e))
             return {'action': 'error', 'message': str(e)}
-    
+
+    def redirect(self, room_id):
+        """多进程模式下房间不属于本分片时, 返回让客户端改连房间所在工作进程的 join_redirect"""
+        if self.shards > 1:
+            owner = cluster.shard_of(room_id, self.shards)
+            if owner != self.shard:
+                return {
+                    'action': 'join_redirect',
+                    'room_id': room_id,
+                    'uri': self.shard_uris[owner]
+                }
+        return None
+
+    @handles('join_room', {'action': 'join_failed'}, room_id=str)
+    async def on_join_room(self, client_id, data):
+        room_id = data['room_id']
+        redirect = self.redirect(room_id)
+        if redirect is not None:
+            return redirect
+        room = self.registry.get_or_create(room_id)
+        vs_bot = data.get('mode') == 'bot'
+        # 人机房间必须是空房间, 玩家执黑先行
+        if (room is None or room.color_of(client_id) is not None
+                or room.seats_taken == 2 or (vs_bot and room.seats_taken)):
+            return {'action': 'join_failed'}
+        # 如果是第一个玩家加入，重置房间状态并选定尺寸和规则; 从日志恢复的对局保留棋盘
+        if not room.seats_taken and room_id not in self.recovered:
+            variant = self.variant_of(data, vs_bot)
+            if variant is None:
+                return {'action': 'join_failed', 'reason': 'invalid_rules'}
+            room.reset_game_state()
+            room.size, room.rule = variant
+        self.recovered.discard(room_id)
+        if client_id in room.spectators:
+            self.registry.unspectate(client_id, room)
+        color = room.free_color()
+        is_first = color == BLACK
+        self.registry.join(client_id, room, color)
+        if vs_bot:
+            self.registry.add_bot(room, WHITE)
+        # 进入对局后不再接收大厅状态, 显式订阅的连接除外
+        self.lobby.release(client_id)
+        self.lobby.mark_dirty(room_id)
+
+        # 发送房间当前状态给新加入的玩家
+        response = {
+            'action': 'join_success',
+            'room_id': room_id,
+            'is_first': is_first,
+            'role': 'black' if is_first else 'white',
+            'token': room.issue_token(color),
+            'game_state': room.game_state
+        }
+
+        if len(room.players) == 2:
+            self.begin_game(room)
+            # 重新发送游戏开始状态
+            await self.broadcast_to_room(room_id, {
+                'action': 'game_start',
+                'game_state': room.game_state
+            })
+            # 恢复的人机对局可能轮到 AI
+            if room.bot_color == room.board.current_player:
+                self.start_bot(room)
+
+        return response
+
+    @handles('exit_room', room_id=str)
+    async def on_exit_room(self, client_id, data):
+        room_id = data['room_id']
+        room = self.registry.get(room_id)
+        if room is not None and room.color_of(client_id) is not None:
+            self.end_game(room)
+            self.registry.leave(client_id, room)
+            self.lobby.mark_dirty(room_id)
+            await self.broadcast_to_room(room_id, {
+                'action': 'player_disconnected'
+            })
+            return {'action': 'exit_success'}
+        return None
+
+    @handles('resume', {'action': 'resume_failed'}, room_id=str, token=str)
+    async def on_resume(self, client_id, data):
+        return await self.resume(client_id, data)
+
+    @handles('spectate', {'action': 'spectate_failed'}, room_id=str)
+    async def on_spectate(self, client_id, data):
+        room_id = data['room_id']
+        redirect = self.redirect(room_id)
+        if redirect is not None:
+            return redirect
+        room = self.registry.get(room_id)
+        if room is None or room.color_of(client_id) is not None:
+            return {'action': 'spectate_failed'}
+        self.registry.spectate(client_id, room)
+        response = {
+            'action': 'spectate_success',
+            'room_id': room_id,
+            'seq': room.seq
+        }
+        return self.catch_up(room, data, response)
+
+    @handles('sync', {'action': 'sync_failed'}, room_id=str)
+    async def on_sync(self, client_id, data):
+        # 客户端已有某个版本的棋盘, 只补发之后的落子
+        room = self.registry.get(data['room_id'])
+        if room is None:
+            return {'action': 'sync_failed'}
+        return self.catch_up(room, data, {'action': 'sync', 'room_id': room.id})
+
+    @handles('hint', {'action': 'hint_failed', 'reason': 'not_your_turn'}, room_id=str)
+    async def on_hint(self, client_id, data):
+        # 开局库中这个局面的下一手, 只提示给轮到落子的玩家
+        room = self.registry.get(data['room_id'])
+        if room is None or not room.game_started or room.color_of(client_id) != room.board.current_player:
+            return {'action': 'hint_failed', 'reason': 'not_your_turn'}
+        move = self.book_move(room)
+        if move is None:
+            return {'action': 'hint_failed', 'reason': 'not_in_book'}
+        x, y, games, wins = move
+        return {'action': 'hint', 'x': x, 'y': y, 'games': games, 'wins': wins}
+
+    @handles('unspectate', room_id=str)
+    async def on_unspectate(self, client_id, data):
+        room = self.registry.get(data['room_id'])
+        if room is not None:
+            self.registry.unspectate(client_id, room)
+        return {'action': 'unspectate_success'}
+
+    @handles('find_match')
+    async def on_find_match(self, client_id, data):
+        if self.shards > 1 and self.shard != cluster.MATCH_SHARD:
+            # 匹配队列只在一个分片上, 否则不同工作进程上排队的玩家无法配对
+            return {'action': 'match_redirect', 'uri': self.shard_uris[cluster.MATCH_SHARD]}
+        if client_id in self.matchmaker:
+            return {'action': 'match_queued'}
+        rating = Matchmaker.clamp(data.get('rating'))
+        opponent = self.matchmaker.enqueue(client_id, rating)
+        if opponent is None:
+            return {'action': 'match_queued', 'rating': rating}
+        # 先排队的一方执黑
+        await self.start_match(opponent.client_id, opponent.rating, client_id, rating)
+        return None
+
+    @handles('cancel_match')
+    async def on_cancel_match(self, client_id, data):
+        if self.matchmaker.cancel(client_id):
+            return {'action': 'match_cancelled'}
+        return None
+
+    @handles('subscribe_lobby')
+    async def on_subscribe_lobby(self, client_id, data):
+        return self.lobby.subscribe(client_id, explicit=True)
+
+    @handles('unsubscribe_lobby')
+    async def on_unsubscribe_lobby(self, client_id, data):
+        self.lobby.unsubscribe(client_id)
+        return None
+
+    @handles('move', {'action': 'move_failed', 'reason': 'invalid_position'}, room_id=str, x=int, y=int)
+    async def on_move(self, client_id, data):
+        room_id = data['room_id']
+        x = data['x']
+        y = data['y']
+
+        room = self.rooms.get(room_id)
+        if not room:
+            return {'action': 'move_failed', 'reason': 'room_not_found'}
+
+        if not room.game_started:
+            return {'action': 'move_failed', 'reason': 'game_not_started'}
+
+        if len(room.players) != 2:
+            return {'action': 'move_failed', 'reason': 'waiting_for_player'}
+
+        # 按座位直接得到颜色, 不依赖集合的顺序
+        color = room.color_of(client_id)
+        if color is None:
+            return {'action': 'move_failed', 'reason': 'not_in_room'}
+
+        board = room.board
+        current_player = board.current_player
+
+        # 检查是否是当前玩家的回合
+        if current_player != color:
+            log.debug('move_rejected', reason='not_your_turn', room=room_id, color=color)
+            return {'action': 'move_failed', 'reason': 'not_your_turn'}
+
+        # 验证坐标和位置是否有效
+        if not board.in_bounds(x, y):
+            log.debug('move_rejected', reason='invalid_position', room=room_id, x=x, y=y)
+            return {'action': 'move_failed', 'reason': 'invalid_position'}
+
+        if not board.is_empty(x, y):
+            log.debug('move_rejected', reason='position_occupied', room=room_id, x=x, y=y)
+            return {'action': 'move_failed', 'reason': 'position_occupied'}
+
+        forbidden = board.forbidden(x, y, current_player)
+        if forbidden is not None:
+            log.debug('move_rejected', reason=forbidden, room=room_id, x=x, y=y)
+            return {'action': 'move_failed', 'reason': 'forbidden', 'forbidden': forbidden}
+
+        # 落子成功，更新状态
+        won = await self.apply_move(room, x, y, current_player)
+
+        # 轮到 AI 时在进程池中搜索, 不阻塞事件循环
+        if not won and room.bot_color == board.current_player:
+            self.start_bot(room)
+        return None
+
+    @handles('game_over', room_id=str)
+    async def on_game_over(self, client_id, data):
+        room_id = data['room_id']
+        room = self.registry.get(room_id)
+        if room is not None and room.color_of(client_id) is not None:
+            self.end_game(room)
+            await self.broadcast_to_room(room_id, {
+                'action': 'game_state',
+                'state': room.game_state
+            })
+        return None
+
     def check_winner(self, board, x, y, player):
-        directions = [(1, 0), (0, 1), (1, 1), (1, -1)]
-        for dx, dy in directions:
-            count = 1
-            count += self.count_pieces(board, x, y, dx, dy, player)
-            count += self.count_pieces(board, x, y, -dx, -dy, player)
-            if count >= 5:
-                return True
-        return False
+        """判断 player 在 (x, y) 落子后是否获胜, board 为 Board 实例"""
+        return board.check_win(x, y, player)
     
-    def count_pieces(self, board, x, y, dx, dy, player):
-        count = 0
-        nx, ny = x + dx, y + dy
-        while 0 <= nx < len(board) and 0 <= ny < len(board) and board[ny][nx] == player:
-            count += 1
-            nx += dx
-            ny += dy
-        return count
+    async def apply_move(self, room, x, y, player):
+        """落子、广播并处理胜负, 返回是否获胜"""
+        won = room.board.place(x, y, player)
+        seq = len(room.board.moves)
+        clock = room.clock
+        if clock is not None:
+            # 落子方停表, 未分胜负时开始为对方计时
+            if won:
+                clock.stop()
+            else:
+                clock.switch()
+        if self.journal is not None:
+            # 只追加到内存缓冲区, 由后台任务批量写盘
+            self.journal.move(room.id, seq, x, y, player)
+            if seq == 1 and (room.size != SIZE or room.rule != FREESTYLE):
+                self.journal.rules(room.id, room.size, room.rule)
+        
+        # 广播移动消息, 并记入环形缓冲区供观众追赶
+        message = {
+            'action': 'move',
+            'x': x,
+            'y': y,
+            'player': player,
+            'seq': seq
+        }
+        if clock is not None:
+            message['clock'] = clock.state()
+        await self.broadcast_to_room(room.id, message)
+        room.record(message)
+        log_move(room=room.id, seq=seq, x=x, y=y, player=player)
+        
+        # 检查胜负
+        if won:
+            await self.broadcast_to_room(room.id, {
+                'action': 'game_over',
+                'winner': '黑棋' if player == 1 else '白棋',
+                'winning_move': (x, y)
+            })
+            self.end_game(room, player)
+        return won
+    
+    def book_move(self, room):
+        """开局库中当前局面的下一手 (x, y, 局数, 胜局数), 没有或不能下时返回 None"""
+        book = self.book
+        if book is None or room.size != book.size or room.rule != book.rule:
+            return None
+        board = room.board
+        move = book.lookup(board.moves)
+        # 哈希冲突时库中的着法可能落在已有棋子上
+        if move is None or not board.in_bounds(move[0], move[1]) or not board.is_empty(move[0], move[1]) \
+                or board.forbidden(move[0], move[1], board.current_player):
+            self.book_lookups.inc('miss')
+            return None
+        self.book_lookups.inc('hit')
+        return move
+
+    def start_bot(self, room):
+        """启动 AI 落子任务, 任务出错时由 _bot_done 结束对局"""
+        task = asyncio.create_task(self.bot_move(room))
+        self.bot_tasks.add(task)
+        task.add_done_callback(lambda task: self._bot_done(room, task))
+
+    def _bot_done(self, room, task):
+        self.bot_tasks.discard(task)
+        if task.cancelled() or task.exception() is None:
+            return
+        error = task.exception()
+        log.error('bot_move_failed', room=room.id, error=repr(error))
+        if isinstance(error, BrokenProcessPool):
+            # 进程池已不可用, 下次需要时重建
+            self.bot_pool = None
+        if room.game_started and room.bot_color is not None:
+            asyncio.create_task(self.abort_bot_game(room))
+
+    async def abort_bot_game(self, room):
+        """AI 无法落子, 判玩家获胜并结束对局, 日志按中途结束记录"""
+        winner = 3 - room.bot_color
+        await self.broadcast_to_room(room.id, {
+            'action': 'game_over',
+            'winner': '黑棋' if winner == BLACK else '白棋',
+            'reason': 'bot_error'
+        })
+        self.end_game(room)
+
+    async def bot_move(self, room):
+        """在进程池中为 AI 搜索一步并落子, 开局库中有的局面直接按库落子"""
+        board = room.board
+        moves = list(board.moves)
+        player = board.current_player
+        move = self.book_move(room)
+        if move is not None:
+            await self.apply_move(room, move[0], move[1], player)
+            return
+        if self.bot_pool is None:
+            self.bot_pool = ProcessPoolExecutor()
+        
+        loop = asyncio.get_running_loop()
+        move = await loop.run_in_executor(
+            self.bot_pool, bot.search, moves, player, bot.TIME_BUDGET
+        )
+        
+        # 思考期间玩家可能已离开或对局已重置
+        if (move is None or room.bot_color != player or room.board is not board
+                or not room.game_started or len(board.moves) != len(moves)):
+            return
+        await self.apply_move(room, move[0], move[1], player)
     
     async def broadcast_to_room(self, room_id: str, message: dict, exclude=None):
-        """向房间内所有玩家广播消息"""
-        if room_id in self.rooms:
-            room = self.rooms[room_id]
-            for player_id in room.players:
-                if player_id != exclude and player_id in self.connections:
-                    try:
-                        await self.connections[player_id].send(json.dumps(message))
-                    except Exception as e:
-                        print(f"Error broadcasting to {player_id}: {e}")
+        """向房间内所有玩家和观众广播消息, 消息统一带上 room_id"""
+        room = self.rooms.get(room_id)
+        if room is not None:
+            start = time.perf_counter()
+            message.setdefault('room_id', room_id)
+            self.fanout.publish(room.players, message, exclude)
+            if room.spectators:
+                # 观众走单独的通道, 慢观众跳到最新快照, 不影响玩家
+                self.fanout.watch(room.spectators, room_id, message)
+            action = message['action']
+            self.broadcast_seconds.observe(action, time.perf_counter() - start)
+            self.broadcast_recipients.inc(action, len(room.players) + len(room.spectators))
+
+    def spectator_snapshot(self, room_id):
+        """慢观众跳过消息后补发的最新局面"""
+        room = self.rooms.get(room_id)
+        if room is None:
+            return None
+        return {'action': 'game_state', 'room_id': room_id, 'state': room.game_state}
     
     async def handle_disconnect(self, client_id: str):
         if client_id in self.connections:
             del self.connections[client_id]
+        self.heartbeat.close(client_id)
+        self.fanout.close(client_id)
+        self.lobby.unsubscribe(client_id)
+        self.matchmaker.cancel(client_id)
+        for room_id in list(self.registry.watching(client_id)):
+            self.registry.unspectate(client_id, self.registry.get(room_id))
         
-        for room in self.rooms.values():
-            if client_id in room.players:
-                room.players.remove(client_id)
-                room.reset_game_state()
-                await self.broadcast_room_status()
-                await self.broadcast_to_room(room.id, {
-                    'action': 'player_disconnected'
-                })
-
-async def main():
-    server = GameServer()
+        # 断线不立即结束对局, 座位保留一段时间等待凭令牌恢复
+        for room_id in list(self.registry.rooms_of(client_id)):
+            room = self.registry.get(room_id)
+            color = room.color_of(client_id)
+            self.registry.leave(client_id, room, hold=True)
+            self.hold_seat(room, color)
+            self.lobby.mark_dirty(room_id)
+            await self.broadcast_to_room(room_id, {
+                'action': 'player_away',
+                'grace': SEAT_GRACE
+            })
+
+def open_journal(path, server):
+    """恢复日志中的对局并开始记录, 返回 Journal"""
+    from journal import Journal
+    journal = Journal(path)
+    games = journal.recover()
+    server.journal = journal
+    server.restore(games, journal.recovered_rules)
+    journal.start(server.live_games, list(server.live_games()))
+    return journal
+
+async def main(host="localhost", port=8765, journal_dir=None, metrics_dump=None,
+               time_control=(TOTAL_TIME, MOVE_TIME), limits=None, variant=(SIZE, FREESTYLE), book=None,
+               gateway_key=None):
+    server = GameServer(time_control=time_control, limits=limits, variant=variant, book=book,
+                        gateway_key=gateway_key)
+    if journal_dir:
+        open_journal(journal_dir, server)
+    await serve(server, host, port, metrics_dump)
+
+async def serve(server, host, port, metrics_dump=None):
     async with websockets.serve(
         server.handle_connection,
-        "localhost",
-        8765,
-        ping_timeout=None,  # 禁用ping超时
-        ping_interval=None  # 禁用ping间隔
+        host,
+        port,
+        ping_timeout=None,  # 心跳由 GameServer.heartbeat 统一调度
+        ping_interval=None,
+        select_subprotocol=protocol.select_subprotocol,
+        process_request=server.process_request
     ) as websocket_server:
-        print("Server started on ws://localhost:8765")
-        await asyncio.Future()
+        log.info('server_started', uri=f"ws://{host}:{port}")
+        server.start(metrics_dump)
+        stopped = asyncio.get_running_loop().create_future()
+        try:
+            # SIGTERM 时正常退出, 让调用方写完日志
+            asyncio.get_running_loop().add_signal_handler(
+                signal.SIGTERM, lambda: stopped.done() or stopped.set_result(None))
+        except NotImplementedError:
+            pass  # Windows 不支持
+        try:
+            await stopped
+        finally:
+            await server.close()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description="五子棋联机服务器")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workers", type=int, default=1, help="工作进程数, 大于 1 时按房间分片")
+    parser.add_argument("--journal", metavar="DIR", help="对局日志目录, 重启时从中恢复进行中的对局")
+    parser.add_argument("--log-level", default=None, choices=sorted(log.LEVELS), help="日志级别, 默认 INFO")
+    parser.add_argument("--log-format", default=None, choices=["text", "json"], help="日志格式")
+    parser.add_argument("--metrics-dump", type=float, metavar="SECONDS", help="每隔 SECONDS 秒把指标打印到标准输出")
+    parser.add_argument("--total-time", type=float, default=TOTAL_TIME, metavar="SECONDS", help="每方总用时, 0 为不计时")
+    parser.add_argument("--move-time", type=float, default=MOVE_TIME, metavar="SECONDS", help="每步用时上限, 0 为不限")
+    parser.add_argument("--board-size", type=int, default=SIZE, choices=range(MIN_SIZE, MAX_SIZE + 1),
+                        metavar="N", help=f"新房间默认的棋盘路数, {MIN_SIZE} 到 {MAX_SIZE}, 默认 {SIZE}")
+    parser.add_argument("--rule", default=FREESTYLE, choices=RULES, help="新房间默认的规则")
+    parser.add_argument("--book", metavar="FILE", help="开局库文件 (opening.py build 生成), 供 AI 和提示使用")
+    parser.add_argument("--gateway-key", default=os.environ.get(gateway.KEY_ENV), metavar="KEY",
+                        help=f"接受持有这个密钥的网关 (gateway.py) 的上游连接, 默认取环境变量 {gateway.KEY_ENV}")
+    parser.add_argument("--rate-limit", type=parse_rate, metavar="RATE[/BURST]",
+                        help="每个连接每秒的消息数和桶容量, 默认 %s/%s" % Limits().message_rate)
+    parser.add_argument("--action-limit", action="append", default=[], metavar="ACTION=RATE[/BURST]",
+                        help="按请求类型限流, 可重复, 例如 move=5/10")
+    parser.add_argument("--max-message-bytes", type=int, metavar="BYTES", help="更长的消息直接拒绝")
+    args = parser.parse_args()
+    log.configure(args.log_level, args.log_format)
+    time_control = (args.total_time, args.move_time)
+    variant = (args.board_size, args.rule)
+    limits = Limits()
+    if args.rate_limit:
+        limits.message_rate = args.rate_limit
+    for item in args.action_limit:
+        name, _, rate = item.partition('=')
+        limits.action_rates[name] = parse_rate(rate)
+    if args.max_message_bytes:
+        limits.max_bytes = args.max_message_bytes
+    if args.workers > 1 and args.gateway_key:
+        # 加入其他分片的房间会重定向到分片端口, 绕过网关
+        parser.error("--gateway-key 只能用于单进程服务器")
+    if args.workers > 1:
+        cluster.run(args.host, args.port, args.workers, args.journal, args.metrics_dump, time_control, limits,
+                    variant, args.book)
+    else:
+        asyncio.run(main(args.host, args.port, args.journal, args.metrics_dump, time_control, limits, variant,
+                         args.book, args.gateway_key))
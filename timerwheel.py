@@ -0,0 +1,122 @@
+"""分层时间轮
+
+大量定时器共用一个时间轮, 由一个协程按固定刻度推进, 不为每个定时器
+创建任务或 asyncio 定时器。第 0 层每格一个刻度, 第 k 层每格是第 k-1 层
+转一圈的时长; 远期定时器先放在高层, 随着时间推进逐层下放到第 0 层。
+添加、取消都是 O(1), 每个刻度只处理到期的那一格。
+
+取消只做标记, 到期或下放时丢弃, 不需要在格子里查找。
+"""
+import asyncio
+import math
+import time
+
+import log
+
+TICK = 0.1      # 刻度, 单位秒
+SLOTS = 256     # 每层格数
+LEVELS = 3      # 256 ** 3 个刻度, 约 19 天
+
+
+class Timer:
+    __slots__ = ('deadline', 'callback', 'args', 'cancelled')
+
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline  # 到期的刻度
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerWheel:
+    def __init__(self, tick=TICK, slots=SLOTS, levels=LEVELS):
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self.wheels = [[[] for _ in range(slots)] for _ in range(levels)]
+        self.overflow = []  # 超出最高层范围的定时器
+        self.current = 0    # 已推进的刻度数
+        self.origin = time.monotonic()
+        self.now = self.origin  # 当前刻度对应的时间, 比调用 time.monotonic() 便宜
+        self.pending = 0    # 已添加、尚未到期或丢弃的定时器数
+        self._task = None
+
+    def __len__(self):
+        return self.pending
+
+    def schedule(self, delay, callback, *args):
+        """delay 秒后调用 callback(*args), 精度为一个刻度"""
+        ticks = max(1, math.ceil(delay / self.tick))
+        timer = Timer(self.current + ticks, callback, args)
+        self._place(timer)
+        self.pending += 1
+        return timer
+
+    def _place(self, timer):
+        delta = timer.deadline - self.current
+        span = 1
+        for level in range(self.levels):
+            if delta < span * self.slots:
+                self.wheels[level][(timer.deadline // span) % self.slots].append(timer)
+                return
+            span *= self.slots
+        self.overflow.append(timer)
+
+    def advance(self, now):
+        """推进到 now (time.monotonic() 的值), 依次调用到期的定时器"""
+        target = int((now - self.origin) / self.tick)
+        slots = self.slots
+        while self.current < target:
+            self.current += 1
+            current = self.current
+            self.now = self.origin + current * self.tick
+
+            # 低层转完一圈时, 把高层对应一格的定时器下放
+            span = slots
+            for level in range(1, self.levels):
+                if current % span:
+                    break
+                self._cascade(self.wheels[level], (current // span) % slots)
+                span *= slots
+            else:
+                if current % span == 0 and self.overflow:
+                    timers, self.overflow = self.overflow, []
+                    for timer in timers:
+                        self._place(timer)
+
+            index = current % slots
+            expired = self.wheels[0][index]
+            if not expired:
+                continue
+            self.wheels[0][index] = []
+            for timer in expired:
+                self.pending -= 1
+                if timer.cancelled:
+                    continue
+                try:
+                    timer.callback(*timer.args)
+                except Exception as e:
+                    log.error('timer_callback_failed', callback=getattr(timer.callback, '__name__', '?'), error=repr(e))
+
+    def _cascade(self, wheel, index):
+        timers = wheel[index]
+        if not timers:
+            return
+        wheel[index] = []
+        for timer in timers:
+            if timer.cancelled:
+                self.pending -= 1
+            else:
+                self._place(timer)
+
+    def start(self):
+        """启动推进时间轮的协程"""
+        async def run():
+            while True:
+                await asyncio.sleep(self.tick)
+                self.advance(time.monotonic())
+
+        self._task = asyncio.create_task(run())